@@ -1,25 +1,63 @@
 # app.py - 修复标签类型名称的Flask应用
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, send_from_directory
 from flask_cors import CORS
 import os
 import logging
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 import psycopg2
-from psycopg2.extras import RealDictCursor, Json
+from psycopg2.extras import RealDictCursor, Json, execute_values
+import io
 import json
+import re
+import html
+import base64
 import hashlib
+import hmac
 from functools import wraps
+from contextlib import contextmanager
+import click
 import uuid
 import time
 import threading
 from collections import OrderedDict
 import boto3
+from boto3.s3.transfer import TransferConfig
 
 # 导入自定义模块
 from image_validator import ImageValidator
 from embedding_service import embedding_service
-from s3_uploader import S3Uploader
+from s3_uploader import S3Uploader, s3_client_options
+from vector_codec import encode_vector_base64, parse_vector, pgvector_available, register_vector, to_vector_param
+from vector_index import VectorIndexRegistry
+from pg_copy import format_copy_row
+from metrics import (
+    metrics,
+    start_request,
+    finish_request,
+    query_operation,
+    record_query,
+    record_connect,
+    format_server_timing
+)
+from stage_executor import StageExecutor, check_cancelled
+from pg_listener import PgNotifyListener
+from http_compression import ResponseCompressor
+from static_assets import StaticAssetManifest, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+from profiling import (
+    QueryEvent,
+    SlowQueryLogger,
+    SamplingProfiler,
+    normalize_sql
+)
+from dataset_export import (
+    EXPORT_FORMATS,
+    PARQUET_AVAILABLE,
+    build_export_query,
+    resolve_export_row,
+    iter_ndjson,
+    iter_parquet
+)
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +68,21 @@ app = Flask(__name__,
             template_folder='templates')  # 模板文件夹CORS(app) 
 CORS(app)
 
+# env.template 等示例中出现过的占位密钥，视同未配置（公开的值不能用来签发令牌）
+PLACEHOLDER_SECRETS = frozenset({
+    'change_me_to_a_random_string', 'change_me', 'changeme', 'secret', 'your_secret_here'
+})
+
+def read_secret_env(name):
+    """读取密钥类环境变量；未设置、为空或为已知占位值时返回 None"""
+    value = (os.environ.get(name) or '').strip()
+    if not value:
+        return None
+    if value.lower() in PLACEHOLDER_SECRETS:
+        logger.warning(f"{name} is set to a placeholder value and is ignored; set a random secret to enable it")
+        return None
+    return value
+
 # 配置类
 class Config:
     # 数据库配置
@@ -45,6 +98,68 @@ class Config:
     # 嵌入功能配置
     ENABLE_EMBEDDINGS = os.environ.get('ENABLE_EMBEDDINGS', 'true').lower() in ('true', '1', 'yes')
     
+    # 向量检索配置（ivfflat.probes 越大召回越高、速度越慢，lists=100）
+    IVFFLAT_PROBES = int(os.environ.get('IVFFLAT_PROBES', '10'))
+    # 'pgvector'（默认）或 'numpy'（无 pgvector 的本地开发/测试环境，使用进程内索引）
+    VECTOR_SEARCH_BACKEND = os.environ.get('VECTOR_SEARCH_BACKEND', 'pgvector').lower()
+    VECTOR_INDEX_DIR = os.environ.get('VECTOR_INDEX_DIR', 'vector_index')
+    # 进程内索引每隔 VECTOR_INDEX_REFRESH_SECONDS 从数据库增量拉取其他 worker 写入的向量
+    VECTOR_INDEX_REFRESH_SECONDS = float(os.environ.get('VECTOR_INDEX_REFRESH_SECONDS', '60'))
+    # 快照由 flask build-vector-index 生成；开启自动保存时在后台线程中按间隔保存，不在请求内写盘
+    VECTOR_INDEX_AUTOSAVE = os.environ.get('VECTOR_INDEX_AUTOSAVE', 'false').lower() in ('true', '1', 'yes')
+    VECTOR_INDEX_AUTOSAVE_SECONDS = float(os.environ.get('VECTOR_INDEX_AUTOSAVE_SECONDS', '300'))
+    
+    # 批量导入配置
+    BULK_INGEST_MAX_ROWS = int(os.environ.get('BULK_INGEST_MAX_ROWS', '10000'))
+    # 请求体字节上限，在读取和解析之前检查（分块传输时边读边计）
+    BULK_INGEST_MAX_BYTES = int(os.environ.get('BULK_INGEST_MAX_BYTES', str(64 * 1024 * 1024)))
+    BULK_INGEST_CHUNK_SIZE = int(os.environ.get('BULK_INGEST_CHUNK_SIZE', '500'))
+    
+    # 请求耗时统计：是否返回 Server-Timing 响应头（指标汇总目录见 metrics.py 的 METRICS_DIR）
+    SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'true').lower() in ('true', '1', 'yes')
+    
+    # 慢查询阈值（毫秒，0 表示不记录）
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '500'))
+    
+    # 采样式性能分析：按比例抽取请求采集调用栈，超过延迟预算的请求输出折叠栈文件
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'false').lower() in ('true', '1', 'yes')
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', '0.01'))
+    PROFILER_BUDGET_MS = float(os.environ.get('PROFILER_BUDGET_MS', '1000'))
+    PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', '10'))
+    PROFILER_OUTPUT_DIR = os.environ.get('PROFILER_OUTPUT_DIR', 'profiles')
+    # 管理接口令牌（请求头 X-Admin-Token），未设置时管理接口不可用
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+    
+    # 数据集导出配置（服务端游标每批拉取行数，同时也是 Parquet row group 大小）
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+    # 标签结构缓存时间（秒）。tag_definitions / themes 的变更通过 LISTEN/NOTIFY 即时失效，
+    # 关闭监听（CACHE_LISTENER_ENABLED=false）时应调回 600 左右
+    TAG_CACHE_TTL = int(os.environ.get('TAG_CACHE_TTL', '21600'))
+    CACHE_LISTENER_ENABLED = os.environ.get('CACHE_LISTENER_ENABLED', 'true').lower() in ('true', '1', 'yes')
+    # 需与 tag_definitions.sql 中触发器使用的频道一致
+    CACHE_NOTIFY_CHANNEL = os.environ.get('CACHE_NOTIFY_CHANNEL', 'viba_cache_invalidation')
+
+    # 响应压缩（按 Accept-Encoding 协商 br/gzip，br 需安装 brotli），小于阈值（字节）的响应不压缩
+    COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() in ('true', '1', 'yes')
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+    COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+    COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+
+    # 请求内并发阶段（嵌入推理与标签查询）的线程池大小（每个 worker 进程共享）；
+    # 默认按 GUNICORN_THREADS × 每个请求的阶段数（2）配置，并发请求的阶段不会互相排队
+    STAGE_EXECUTOR_WORKERS = int(os.environ.get('STAGE_EXECUTOR_WORKERS',
+                                                int(os.environ.get('GUNICORN_THREADS', '1')) * 2))
+
+    # 异步（ASGI）模式配置，见 asgi_app.py
+    ASYNC_DB_POOL_MIN = int(os.environ.get('ASYNC_DB_POOL_MIN', '2'))
+    ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', '10'))
+    ASYNC_S3_MAX_CONNECTIONS = int(os.environ.get('ASYNC_S3_MAX_CONNECTIONS', '20'))
+    # 嵌入模型推理和图片解码使用的线程数（CPU 密集，不宜超过核数）
+    ASYNC_CPU_WORKERS = int(os.environ.get('ASYNC_CPU_WORKERS', '2'))
+    # 挂载的 Flask 路由（未异步化的接口）使用的线程数
+    ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', '10'))
+    
     # S3配置
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
@@ -52,16 +167,61 @@ class Config:
     S3_REGION = os.environ.get('S3_REGION') or os.environ.get('AWS_REGION', 'us-west-2')
     S3_PREFIX = os.environ.get('S3_PREFIX', 'viba-image-annotation/')
     CLOUDFRONT_DOMAIN = os.environ.get('CLOUDFRONT_DOMAIN')  # 可选CDN域名
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # 可选，S3兼容服务地址（如压测用的 MinIO）
+    # S3 客户端调优（同步客户端；异步模式的连接池见 ASYNC_S3_MAX_CONNECTIONS）
+    # 分片上传：不小于阈值的文件按分块并发上传
+    S3_MULTIPART_THRESHOLD_MB = int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', '8'))
+    S3_MULTIPART_CHUNKSIZE_MB = int(os.environ.get('S3_MULTIPART_CHUNKSIZE_MB', '8'))
+    S3_TRANSFER_CONCURRENCY = int(os.environ.get('S3_TRANSFER_CONCURRENCY', '4'))
+    # 连接池默认按并发上传数（gunicorn 线程数 × 分片并发）留余量
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS') or
+                                  max(10, int(os.environ.get('GUNICORN_THREADS', '1')) * S3_TRANSFER_CONCURRENCY + 2))
+    S3_RETRY_MODE = os.environ.get('S3_RETRY_MODE', 'adaptive')  # legacy / standard / adaptive
+    S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', '5'))
+    S3_TCP_KEEPALIVE = os.environ.get('S3_TCP_KEEPALIVE', 'true').lower() in ('true', '1', 'yes')
+    S3_CONNECT_TIMEOUT = float(os.environ.get('S3_CONNECT_TIMEOUT', '5'))
+    S3_READ_TIMEOUT = float(os.environ.get('S3_READ_TIMEOUT', '60'))
+    # 浏览器直传S3（预签名 PUT，见 /api/uploads/presign），需要存储桶允许前端域名跨域 PUT
+    DIRECT_UPLOAD_ENABLED = os.environ.get('DIRECT_UPLOAD_ENABLED', 'true').lower() in ('true', '1', 'yes')
+    UPLOAD_PRESIGN_EXPIRES = int(os.environ.get('UPLOAD_PRESIGN_EXPIRES', '300'))
+    # 确认直传上传时 ranged GET 读取的字节数（解析格式和尺寸只需文件头）
+    UPLOAD_CONFIRM_HEADER_BYTES = int(os.environ.get('UPLOAD_CONFIRM_HEADER_BYTES', '262144'))
+    # 直传确认令牌的 HMAC 密钥（各 worker 需相同）；未配置或为占位值时不提供直传，前端改用 upload-image
+    UPLOAD_TOKEN_SECRET = read_secret_env('UPLOAD_TOKEN_SECRET')
 
 app.config.from_object(Config)
 
+# 响应压缩与静态资源指纹
+compressor = ResponseCompressor(
+    min_size=app.config['COMPRESSION_MIN_SIZE'],
+    gzip_level=app.config['COMPRESSION_GZIP_LEVEL'],
+    brotli_quality=app.config['COMPRESSION_BROTLI_QUALITY']
+)
+if app.config['COMPRESSION_ENABLED']:
+    compressor.init_app(app)
+static_assets = StaticAssetManifest(app.static_folder)
+
 # 初始化S3上传器
 s3_uploader = S3Uploader(
     bucket_name=app.config['S3_BUCKET_NAME'],
     region=app.config['S3_REGION'],
     access_key_id=app.config['AWS_ACCESS_KEY_ID'],
     secret_access_key=app.config['AWS_SECRET_ACCESS_KEY'],
-    cloudfront_domain=app.config['CLOUDFRONT_DOMAIN']
+    cloudfront_domain=app.config['CLOUDFRONT_DOMAIN'],
+    endpoint_url=app.config['S3_ENDPOINT_URL'],
+    client_options=s3_client_options(
+        max_pool_connections=app.config['S3_MAX_POOL_CONNECTIONS'],
+        retry_mode=app.config['S3_RETRY_MODE'],
+        max_attempts=app.config['S3_MAX_ATTEMPTS'],
+        tcp_keepalive=app.config['S3_TCP_KEEPALIVE'],
+        connect_timeout=app.config['S3_CONNECT_TIMEOUT'],
+        read_timeout=app.config['S3_READ_TIMEOUT']
+    ),
+    transfer_config=TransferConfig(
+        multipart_threshold=app.config['S3_MULTIPART_THRESHOLD_MB'] * 1024 * 1024,
+        multipart_chunksize=app.config['S3_MULTIPART_CHUNKSIZE_MB'] * 1024 * 1024,
+        max_concurrency=app.config['S3_TRANSFER_CONCURRENCY']
+    )
 )
 
 # 关闭外部缓存（原本使用 Redis）。实现轻量的进程内 TTL 缓存。
@@ -120,6 +280,186 @@ class InMemoryTTLCache:
 
 in_memory_cache = InMemoryTTLCache(maxsize=512)
 
+
+class FacetCountCache:
+    """
+    未过滤全集的标签计数缓存
+    
+    首次读取时全量统计一次，之后每新增一张参考图就在进程内增量累加，读取无需访问数据库。
+    每个 gunicorn worker 各自维护一份，按 refresh_seconds 定期全量校准，
+    其他 worker 写入的数据在校准后可见。
+    """
+    def __init__(self, loader, refresh_seconds: int = 3600):
+        self._loader = loader
+        self._refresh_seconds = refresh_seconds
+        self._counts: Optional[Dict[str, Dict[int, int]]] = None
+        self._total = 0
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _snapshot_unlocked(self):
+        return self._total, {field: dict(counts) for field, counts in self._counts.items()}
+
+    def get(self):
+        """返回 (total, {field: {tag_id: count}})"""
+        with self._lock:
+            if self._counts is not None and time.time() - self._loaded_at < self._refresh_seconds:
+                return self._snapshot_unlocked()
+        
+        # 在锁外执行全量统计，避免阻塞增量写入
+        total, counts = self._loader()
+        with self._lock:
+            self._total = total
+            self._counts = counts
+            self._loaded_at = time.time()
+            return self._snapshot_unlocked()
+
+    def record_insert(self, tag_ids_by_field: Dict[str, List[int]]):
+        """新增一张参考图后累加计数（尚未加载时跳过，首次加载会包含这条数据）"""
+        with self._lock:
+            if self._counts is None:
+                return
+            self._total += 1
+            for field, tag_ids in tag_ids_by_field.items():
+                field_counts = self._counts.setdefault(field, {})
+                for tag_id in set(tag_ids or []):
+                    field_counts[tag_id] = field_counts.get(tag_id, 0) + 1
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = None
+
+
+class TagStructureCache:
+    """
+    标签结构缓存，值为 (result, stats)
+    
+    按 tag_type 分别缓存 build_tree_structure / build_flat_structure 的结果，每部分记录该类型的版本
+    （启用标签数 + 最近 updated_at）。整体过期或失效后先执行一次按类型分组的版本查询，
+    只重新查询和构建版本变化的类型，再由各部分组装完整结构。
+    tag_definitions 变更时由 LISTEN/NOTIFY 监听线程调用 refresh_type()，只重建受影响的类型。
+    
+    已发布的值不会被原地修改，读取方可以直接序列化。version 在每次内容变化时递增，
+    可作为派生缓存（序列化后的响应体）的键；加载期间如果发生了变更，store() 会丢弃这次的结果。
+    """
+    def __init__(self, version_loader, rows_loader, ttl_seconds: int):
+        """
+        Args:
+            version_loader: 返回 {tag_type: (启用标签数, 最近 updated_at)}
+            rows_loader: rows_loader(tag_types) 返回这些类型的启用标签行
+            ttl_seconds: 组装结果的过期时间（过期后只做版本查询，未变化的类型直接复用）
+        """
+        self._version_loader = version_loader
+        self._rows_loader = rows_loader
+        self._ttl_seconds = ttl_seconds
+        self._value = None
+        self._expire_at = 0.0
+        # tag_type -> (类型版本, 结构（未配置或无启用标签时为 None）, 启用标签数)
+        self._parts: Dict[str, tuple] = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def peek(self):
+        """返回 (value, version)，未缓存或已过期时 value 为 None"""
+        with self._lock:
+            if self._value is not None and self._expire_at <= time.time():
+                self._value = None
+            return self._value, self._version
+
+    def stale_types(self, type_versions: Dict[str, tuple]) -> List[str]:
+        """返回需要重新查询的已配置类型（没有缓存部分或版本已变化）"""
+        with self._lock:
+            parts = self._parts
+        return [
+            tag_type for tag_type, type_version in type_versions.items()
+            if tag_type in ALL_TAG_TYPES
+            and (tag_type not in parts or parts[tag_type][0] != type_version)
+        ]
+
+    def build(self, type_versions: Dict[str, tuple], rows):
+        """
+        由缓存部分和重新查询的行组装标签结构
+        
+        Args:
+            type_versions: 版本查询结果
+            rows: stale_types() 中各类型的启用标签行
+        
+        Returns:
+            ((result, stats), parts)，parts 交给 store() 一并写入
+        """
+        tags_by_type = {}
+        for tag in rows:
+            tags_by_type.setdefault(tag['tag_type'], []).append(tag)
+        
+        with self._lock:
+            cached_parts = self._parts
+        parts = {}
+        for tag_type, type_version in type_versions.items():
+            cached = cached_parts.get(tag_type)
+            if cached is not None and cached[0] == type_version:
+                parts[tag_type] = cached
+                continue
+            tags = tags_by_type.get(tag_type)
+            structure = build_tag_type_structure(tag_type, tags) if tags and tag_type in ALL_TAG_TYPES else None
+            parts[tag_type] = (type_version, structure, type_version[0])
+        return assemble_tag_structures(parts), parts
+
+    def store(self, value, version: int, parts: Optional[Dict[str, tuple]] = None) -> Optional[int]:
+        """
+        写入加载结果
+        
+        Args:
+            value: (result, stats)
+            version: 开始加载前 peek() 得到的版本
+            parts: build() 返回的各类型部分
+        
+        Returns:
+            新版本号；加载期间缓存已变化（结果可能过期）时不写入并返回 None
+        """
+        with self._lock:
+            if version != self._version:
+                return None
+            self._value = value
+            if parts is not None:
+                self._parts = parts
+            self._expire_at = time.time() + self._ttl_seconds
+            self._version += 1
+            return self._version
+
+    def _load(self, version: int):
+        type_versions = self._version_loader()
+        stale = self.stale_types(type_versions)
+        rows = self._rows_loader(stale) if stale else []
+        value, parts = self.build(type_versions, rows)
+        return value, self.store(value, version, parts)
+
+    def get_versioned(self):
+        """返回 ((result, stats), version)，未缓存时只重建版本变化的类型；结果未写入缓存时 version 为 None"""
+        value, version = self.peek()
+        if value is None:
+            value, version = self._load(version)
+        return value, version
+
+    def get(self):
+        """返回 (result, stats)"""
+        return self.get_versioned()[0]
+
+    def refresh_type(self, tag_type: str):
+        """丢弃单个 tag_type 的缓存部分并重新组装（未缓存时由下一次读取重建）"""
+        with self._lock:
+            self._parts = {t: part for t, part in self._parts.items() if t != tag_type}
+            self._version += 1
+            version = self._version
+            has_value = self._value is not None
+        if has_value:
+            self._load(version)
+
+    def invalidate(self):
+        """失效组装结果；各类型部分保留，下一次读取按版本决定是否重建"""
+        with self._lock:
+            self._value = None
+            self._version += 1
+
 # 数据库连接类
 class Database:
     def __init__(self):
@@ -132,6 +472,45 @@ class Database:
         }
         self.auth_mode = app.config['DB_AUTH_MODE']
         self.aws_region = app.config['AWS_REGION']
+        # 查询观察者：每条语句执行后以 QueryEvent 调用（慢查询日志等）
+        self.query_observers = []
+    
+    def add_query_observer(self, observer):
+        """注册查询观察者，observer(event: QueryEvent)"""
+        self.query_observers.append(observer)
+    
+    @contextmanager
+    def observe_query(self, query, operation=None):
+        """
+        统计一条语句：记录指标，并把归一化 SQL、耗时、行数、调用位置通知给观察者
+        
+        Args:
+            query: SQL 模板
+            operation: 操作类型，默认取 SQL 首个关键字
+        
+        Yields:
+            可写入 'rows' 的状态字典
+        """
+        operation = operation or query_operation(query)
+        state = {'rows': None}
+        start = time.perf_counter()
+        error = True
+        try:
+            yield state
+            error = False
+        finally:
+            duration = time.perf_counter() - start
+            record_query(operation, duration, error)
+            if self.query_observers:
+                event = QueryEvent(
+                    normalize_sql(query), operation, duration, state['rows'], error,
+                    DATABASE_FRAME_NAMES
+                )
+                for observer in self.query_observers:
+                    try:
+                        observer(event)
+                    except Exception as e:
+                        logger.debug(f"Query observer error: {str(e)}")
     
     def get_iam_token(self):
         """Generate RDS IAM authentication token"""
@@ -152,18 +531,77 @@ class Database:
             # Use traditional password authentication
             connection_config['password'] = app.config['DB_PASSWORD']
         
-        return psycopg2.connect(**connection_config)
+        start = time.perf_counter()
+        conn = psycopg2.connect(**connection_config)
+        record_connect(time.perf_counter() - start)
+        try:
+            # 首个连接上注册 pgvector 类型（之后全进程生效）
+            register_vector(conn)
+        except Exception as e:
+            conn.rollback()
+            logger.warning(f"Failed to register pgvector adapter: {str(e)}")
+        return conn
     
-    def execute_query(self, query, params=None, fetch=True):
+    def execute_query(self, query, params=None, fetch=True, settings=None):
         conn = None
         try:
             conn = self.get_connection()
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                if fetch:
-                    return cursor.fetchall()
+                # 事务级参数（等同 SET LOCAL），只对本次查询生效
+                for name, value in (settings or {}).items():
+                    cursor.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+                with self.observe_query(query) as event:
+                    cursor.execute(query, params)
+                    if fetch:
+                        rows = cursor.fetchall()
+                        event['rows'] = len(rows)
+                        return rows
+                    conn.commit()
+                    event['rows'] = cursor.rowcount
+                    return cursor.rowcount
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"Database error: {str(e)}")
+            raise
+        finally:
+            if conn:
+                conn.close()
+    
+    def copy_insert(self, table, columns, kinds, rows, after=None):
+        """
+        通过 COPY 批量写入：先 COPY 到同结构的临时表，再 INSERT ... SELECT 到目标表
+        
+        Args:
+            table: 目标表
+            columns: 字段列表
+            kinds: 各字段的 COPY 编码类型（见 pg_copy.format_copy_value）
+            rows: 行数据列表
+            after: 可选 after(cursor)，在同一事务内、提交前执行（如写入关联表），失败时整体回滚
+        
+        Returns:
+            写入的行数
+        """
+        column_list = ", ".join(columns)
+        
+        conn = None
+        try:
+            conn = self.get_connection()
+            # 在连接之后编码：vector 字段的文本格式取决于数据库是否安装了 pgvector
+            buffer = io.StringIO(''.join(format_copy_row(row, kinds) for row in rows))
+            with conn.cursor() as cursor, self.observe_query(f"COPY {table} ({column_list})", 'copy') as event:
+                cursor.execute(f"""
+                    CREATE TEMP TABLE bulk_staging ON COMMIT DROP AS
+                    SELECT {column_list} FROM {table} WITH NO DATA
+                """)
+                cursor.copy_expert(f"COPY bulk_staging ({column_list}) FROM STDIN", buffer)
+                cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM bulk_staging")
+                inserted = cursor.rowcount
+                if after is not None:
+                    after(cursor)
                 conn.commit()
-                return cursor.rowcount
+                event['rows'] = inserted
+            return inserted
         except Exception as e:
             if conn:
                 conn.rollback()
@@ -173,14 +611,97 @@ class Database:
             if conn:
                 conn.close()
     
-    def execute_insert(self, query, params=None):
+    def execute_values(self, table, columns, rows, template=None, on_conflict=None, page_size=1000):
+        """
+        多行写入：使用 execute_values 把多行合并为 INSERT ... VALUES (...), (...) 语句，
+        一个连接、一次提交完成（替代逐行 execute_query）
+        
+        Args:
+            table: 目标表
+            columns: 字段列表
+            rows: 行数据列表（元组或列表，与 columns 对应）
+            template: 单行模板，如 '(%s::uuid, %s::uuid)'，默认每个字段一个 %s
+            on_conflict: 追加在 VALUES 之后的子句，如 'ON CONFLICT DO NOTHING'
+            page_size: 每条语句包含的行数
+        
+        Returns:
+            写入的行数
+        """
+        if not rows:
+            return 0
+        
+        query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s {on_conflict or ''}"
         conn = None
         try:
             conn = self.get_connection()
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                result = cursor.fetchone()
+            with conn.cursor() as cursor, self.observe_query(query, 'insert') as event:
+                inserted = 0
+                # 按页执行并累加 rowcount（execute_values 自身只保留最后一页的 rowcount）
+                for start in range(0, len(rows), page_size):
+                    execute_values(cursor, query, rows[start:start + page_size],
+                                   template=template, page_size=page_size)
+                    inserted += cursor.rowcount
                 conn.commit()
+                event['rows'] = inserted
+            return inserted
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"Database error: {str(e)}")
+            raise
+        finally:
+            if conn:
+                conn.close()
+    
+    def stream_query(self, query, params=None, itersize=1000):
+        """
+        使用服务端命名游标流式读取查询结果，每次只从数据库拉取 itersize 行
+        
+        Args:
+            query: SQL查询
+            params: 查询参数
+            itersize: 每次网络往返拉取的行数
+        
+        Yields:
+            结果行（字典）
+        """
+        conn = None
+        try:
+            conn = self.get_connection()
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cursor:
+                cursor.itersize = itersize
+                # 只统计打开游标；后续分批拉取的耗时取决于调用方的消费速度
+                with self.observe_query(query):
+                    cursor.execute(query, params)
+                for row in cursor:
+                    yield row
+        except Exception as e:
+            logger.error(f"Database error: {str(e)}")
+            raise
+        finally:
+            if conn:
+                conn.close()
+    
+    def execute_insert(self, query, params=None, after=None):
+        """
+        执行带 RETURNING 的写入并返回第一行
+        
+        Args:
+            query: SQL
+            params: 参数
+            after: 可选 after(cursor, result)，在同一事务内、提交前执行，失败时整体回滚
+        """
+        conn = None
+        try:
+            conn = self.get_connection()
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                with self.observe_query(query) as event:
+                    cursor.execute(query, params)
+                    result = cursor.fetchone()
+                    event['rows'] = cursor.rowcount
+                    if after is not None:
+                        after(cursor, result)
+                    conn.commit()
                 return result
         except Exception as e:
             if conn:
@@ -191,7 +712,25 @@ class Database:
             if conn:
                 conn.close()
 
+# 查找慢查询调用位置时跳过的数据库封装层栈帧
+DATABASE_FRAME_NAMES = (
+    'observe_query', 'execute_query', 'execute_insert', 'copy_insert', 'execute_values', 'stream_query'
+)
+
 db = Database()
+db.add_query_observer(SlowQueryLogger(app.config['SLOW_QUERY_MS']))
+
+# 采样式性能分析（默认关闭；可用环境变量或 /api/admin/profiler 开启）
+profiler = SamplingProfiler(
+    output_dir=app.config['PROFILER_OUTPUT_DIR'],
+    enabled=app.config['PROFILER_ENABLED'],
+    sample_rate=app.config['PROFILER_SAMPLE_RATE'],
+    budget_ms=app.config['PROFILER_BUDGET_MS'],
+    interval_ms=app.config['PROFILER_INTERVAL_MS']
+)
+
+# 请求内互不依赖阶段的共享线程池
+stage_executor = StageExecutor(max_workers=app.config['STAGE_EXECUTOR_WORKERS'], name='stage')
 
 # 导入配置模块
 from tag_config import (
@@ -200,6 +739,7 @@ from tag_config import (
     MODEL_ATTRIBUTE_FIELDS,
     COMPOSITION_FIELDS,
     SPECIAL_TAG_TYPES,
+    REFERENCE_TAG_FIELDS,
     get_all_tag_types,
     is_multi_level,
     is_single_level,
@@ -222,16 +762,48 @@ ALL_TAG_TYPES = get_all_tag_types()
 
 # 缓存装饰器
 # 修复缓存装饰器
-def cache_decorator(expiration=300):
+def cache_decorator(expiration=300, etag=False):
+    """
+    缓存 200 JSON 响应
+    
+    Args:
+        expiration: 缓存秒数
+        etag: 为 True 时缓存序列化后的响应体及其内容哈希 ETag，支持 If-None-Match 条件请求（304）
+    """
     def decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
+        def make_cache_key(args, kwargs):
             # 生成缓存键（函数+参数）
             try:
                 key_data = f"{f.__module__}.{f.__name__}:{str(args)}:{str(sorted(kwargs.items()))}"
-                cache_key = f"cache:{hashlib.md5(key_data.encode()).hexdigest()}"
+                return f"cache:{hashlib.md5(key_data.encode()).hexdigest()}"
             except Exception:
-                cache_key = f"cache:{f.__module__}.{f.__name__}"
+                return f"cache:{f.__module__}.{f.__name__}"
+
+        def etag_wrapper(cache_key, args, kwargs):
+            cached_body = in_memory_cache.get(cache_key)
+            if isinstance(cached_body, tuple):
+                body, body_etag = cached_body
+                return make_conditional_response(Response(body, mimetype='application/json'), body_etag)
+
+            result = f(*args, **kwargs)
+            if isinstance(result, tuple):
+                response_obj, status_code = result[0], result[1]
+            else:
+                response_obj, status_code = result, getattr(result, 'status_code', 200)
+            if status_code != 200:
+                return result
+            if isinstance(response_obj, dict):
+                response_obj = jsonify(response_obj)
+            body = response_obj.get_data()
+            body_etag = hashlib.sha1(body).hexdigest()
+            in_memory_cache.set(cache_key, (body, body_etag), expiration)
+            return make_conditional_response(Response(body, mimetype='application/json'), body_etag)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache_key = make_cache_key(args, kwargs)
+            if etag:
+                return etag_wrapper(cache_key, args, kwargs)
 
             # 命中缓存则直接返回已序列化的 dict（Flask 会自动 jsonify）
             cached_payload = in_memory_cache.get(cache_key)
@@ -267,14 +839,123 @@ def cache_decorator(expiration=300):
                 logger.warning(f"In-memory cache error: {e}")
 
             return result
+
+        def invalidate(*args, **kwargs):
+            """删除以这组参数调用时的缓存（如 get_themes.invalidate()）"""
+            in_memory_cache.delete(make_cache_key(args, kwargs))
+
+        wrapper.invalidate = invalidate
         return wrapper
     return decorator
 
+def make_conditional_response(response, etag, last_modified=None):
+    """
+    为响应设置 ETag / Last-Modified，命中 If-None-Match / If-Modified-Since 时转为 304（无响应体）
+    
+    Cache-Control: no-cache 要求客户端每次都带条件请求验证，避免浏览器按 Last-Modified 启发式缓存。
+    
+    Args:
+        response: Flask Response
+        etag: 强 ETag（不含引号）
+        last_modified: 最后修改时间，可选
+    
+    Returns:
+        Response（200 或 304）
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+# ==================== 请求耗时统计 ====================
+
+@app.before_request
+def start_request_timing():
+    """开始记录本次请求的阶段耗时"""
+    request.environ['viba.metrics_token'] = start_request()
+    request.environ['viba.request_start'] = time.perf_counter()
+    if profiler.should_profile():
+        request.environ['viba.profiled'] = True
+        profiler.begin()
+
+@app.after_request
+def record_request_timing(response):
+    """记录请求指标，并通过 Server-Timing 返回各阶段耗时"""
+    token = request.environ.pop('viba.metrics_token', None)
+    if token is None:
+        return response
+    
+    elapsed = time.perf_counter() - request.environ['viba.request_start']
+    timings = finish_request(token)
+    # 使用路由模板而不是实际路径，避免 unique_id 等参数导致标签基数膨胀
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('viba_http_requests_total', method=request.method, endpoint=endpoint, status=response.status_code)
+    metrics.observe('viba_http_request_duration_seconds', elapsed, method=request.method, endpoint=endpoint)
+    metrics.flush()
+    
+    if request.environ.pop('viba.profiled', False):
+        profiler.end(elapsed, f"{request.method}_{endpoint}")
+    
+    if app.config['SERVER_TIMING_ENABLED']:
+        response.headers['Server-Timing'] = format_server_timing(timings, elapsed)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 指标（配置 METRICS_DIR 时汇总所有 gunicorn worker）"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/profiler', methods=['GET', 'POST'])
+def configure_profiler():
+    """
+    查看或调整采样式性能分析（需要 X-Admin-Token；只作用于处理本请求的 worker 进程）
+    
+    请求体（POST，均可选）:
+        enabled: 是否开启
+        sample_rate: 请求抽样比例（0-1）
+        budget_ms: 延迟预算，超过的请求输出折叠栈
+        interval_ms: 采样间隔
+    """
+    admin_token = app.config['ADMIN_TOKEN']
+    if not admin_token or request.headers.get('X-Admin-Token') != admin_token:
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            profiler.configure(
+                enabled=data.get('enabled'),
+                sample_rate=data.get('sample_rate'),
+                budget_ms=data.get('budget_ms'),
+                interval_ms=data.get('interval_ms')
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'data': dict(profiler.status(), pid=os.getpid())
+    })
+
 # ==================== API路由 ====================
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    # 页面每次协商，引用的静态文件带内容哈希指纹、可长期缓存
+    html = static_assets.rewrite_html(render_template('index.html'))
+    response = Response(html, mimetype='text/html')
+    response.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+    return response
+
+def serve_static(filename):
+    """静态文件：指纹与当前内容一致时 immutable 长缓存，否则每次验证"""
+    original, fingerprinted = static_assets.resolve(filename)
+    response = send_from_directory(app.static_folder, original)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if fingerprinted else REVALIDATE_CACHE_CONTROL
+    return response
+
+app.view_functions['static'] = serve_static
 
 @app.route('/api/status')
 def api_status():
@@ -290,7 +971,7 @@ def api_status():
 # ==================== 主题相关API ====================
 
 @app.route('/api/themes', methods=['GET'])
-@cache_decorator(expiration=600)
+@cache_decorator(expiration=600, etag=True)
 def get_themes():
     """获取所有主题"""
     try:
@@ -329,78 +1010,12 @@ def get_tag_config():
 
 
 @app.route('/api/tags/all', methods=['GET'])
-@cache_decorator(expiration=600)  # 缓存2小时
 def get_all_tags():
-    """一次性获取所有标签，区分多级和单级"""
+    """一次性获取所有标签，区分多级和单级（标签变更通过 LISTEN/NOTIFY 即时刷新缓存）"""
     try:
-        query = """
-            SELECT 
-                id,
-                tag_type,
-                tag_name,
-                tag_name_cn,
-                parent_tag_id,
-                level,
-                level1_code,
-                level2_code,
-                level3_code,
-                level4_code,
-                full_code,
-                is_leaf,
-                attributes
-            FROM viba.tag_definitions
-            WHERE is_active = TRUE
-            ORDER BY tag_type, level, 
-                     COALESCE(level1_code, '00'),
-                     COALESCE(level2_code, '00'),
-                     COALESCE(level3_code, '00'),
-                     COALESCE(level4_code, '00000000')
-        """
-        
-        all_tags = db.execute_query(query)
-        
-        # 按类型分组
-        tags_by_type = {}
-        for tag in all_tags:
-            tag_type = tag['tag_type']
-            if tag_type not in tags_by_type:
-                tags_by_type[tag_type] = []
-            tags_by_type[tag_type].append(tag)
-        
-        # 分别处理多级和单级标签（使用配置）
-        result = {
-            'multi_level': {},
-            'single_level': {},
-            'tag_types': {
-                'multi_level': TAG_TYPES['multi_level'],
-                'single_level': TAG_TYPES['single_level']
-            }
-        }
-        
-        # 处理多级标签
-        for tag_type in TAG_TYPES['multi_level']:
-            if tag_type in tags_by_type:
-                result['multi_level'][tag_type] = build_tree_structure(tags_by_type[tag_type])
-        
-        # 处理单级标签
-        for tag_type in TAG_TYPES['single_level']:
-            if tag_type in tags_by_type:
-                result['single_level'][tag_type] = build_flat_structure(tags_by_type[tag_type])
-        
-        # 添加特殊标签类型信息
-        result['special_types'] = SPECIAL_TAG_TYPES
-        
-        # 统计信息
-        stats = {
-            'total_count': len(all_tags),
-            'by_type': {tag_type: len(tags) for tag_type, tags in tags_by_type.items()}
-        }
-        
-        return jsonify({
-            'success': True,
-            'data': result,
-            'stats': stats
-        })
+        structures, version = tag_structure_cache.get_versioned()
+        body, etag = tags_response_body(structures, version)
+        return make_conditional_response(Response(body, mimetype='application/json'), etag)
     except Exception as e:
         logger.error(f"Error getting all tags: {str(e)}")
         return jsonify({
@@ -408,6 +1023,183 @@ def get_all_tags():
             'error': str(e)
         }), 500
 
+# 启用标签查询（同步/异步入口共用），只查询版本变化的 tag_type
+TAG_TYPES_STRUCTURE_QUERY = """
+    SELECT 
+        id,
+        tag_type,
+        tag_name,
+        tag_name_cn,
+        parent_tag_id,
+        level,
+        level1_code,
+        level2_code,
+        level3_code,
+        level4_code,
+        full_code,
+        is_leaf,
+        attributes
+    FROM viba.tag_definitions
+    WHERE is_active = TRUE AND tag_type = ANY(%s)
+    ORDER BY tag_type, level, 
+             COALESCE(level1_code, '00'),
+             COALESCE(level2_code, '00'),
+             COALESCE(level3_code, '00'),
+             COALESCE(level4_code, '00000000')
+"""
+
+# 各 tag_type 的版本：启用标签数 + 最近 updated_at（含停用行，停用/重命名由 updated_at 触发器体现）
+TAG_TYPE_VERSION_QUERY = """
+    SELECT 
+        tag_type,
+        COUNT(*) FILTER (WHERE is_active = TRUE) AS active_count,
+        MAX(updated_at) AS max_updated_at
+    FROM viba.tag_definitions
+    GROUP BY tag_type
+    ORDER BY tag_type
+"""
+
+def parse_tag_type_versions(rows):
+    """版本查询结果转换为 {tag_type: (启用标签数, 最近 updated_at)}"""
+    return {row['tag_type']: (row['active_count'], row['max_updated_at']) for row in rows}
+
+def load_tag_type_versions():
+    return parse_tag_type_versions(db.execute_query(TAG_TYPE_VERSION_QUERY))
+
+def load_tag_type_rows(tag_types):
+    return db.execute_query(TAG_TYPES_STRUCTURE_QUERY, (list(tag_types),))
+
+def assemble_tag_structures(parts):
+    """
+    由各 tag_type 的缓存部分组装多级（树状）和单级（扁平）结构
+    
+    Args:
+        parts: {tag_type: (类型版本, 结构, 启用标签数)}
+    
+    Returns:
+        (result, stats)
+    """
+    # 分别处理多级和单级标签（使用配置）
+    result = {
+        'multi_level': {},
+        'single_level': {},
+        'tag_types': {
+            'multi_level': TAG_TYPES['multi_level'],
+            'single_level': TAG_TYPES['single_level']
+        }
+    }
+    
+    # 按配置顺序组装多级和单级标签
+    for level in ('multi_level', 'single_level'):
+        for tag_type in TAG_TYPES[level]:
+            part = parts.get(tag_type)
+            if part is not None and part[1] is not None:
+                result[level][tag_type] = part[1]
+    
+    # 添加特殊标签类型信息
+    result['special_types'] = SPECIAL_TAG_TYPES
+    
+    # 统计信息
+    by_type = {tag_type: part[2] for tag_type, part in parts.items() if part[2]}
+    stats = {
+        'total_count': sum(by_type.values()),
+        'by_type': by_type
+    }
+    
+    return result, stats
+
+def build_tag_type_structure(tag_type, tags):
+    """多级类型构建树状结构，单级类型构建扁平列表"""
+    if tag_type in TAG_TYPES['multi_level']:
+        return build_tree_structure(tags)
+    return build_flat_structure(tags)
+
+def get_tag_structures():
+    """获取（带缓存的）标签结构，供需要标签树的内部逻辑使用"""
+    result, _ = tag_structure_cache.get()
+    return result
+
+# 序列化后的 /api/tags/all 响应体缓存键，值为 (标签结构版本, bytes, ETag)
+TAGS_RESPONSE_CACHE_KEY = 'tags_all_body'
+
+def tags_response_body(structures, version):
+    """
+    序列化 /api/tags/all 响应体（同步/异步入口共用），按标签结构版本缓存
+    
+    Args:
+        structures: (result, stats)
+        version: tag_structure_cache 的版本，None 表示结构未写入缓存（不缓存响应体）
+    
+    Returns:
+        (UTF-8 JSON bytes, 内容哈希 ETag)；ETag 由内容计算，各 worker 一致，压缩结果也按它缓存
+    """
+    if version is not None:
+        cached = in_memory_cache.get(TAGS_RESPONSE_CACHE_KEY)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+    result, stats = structures
+    body = json.dumps({'success': True, 'data': result, 'stats': stats}, ensure_ascii=False).encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    if version is not None:
+        in_memory_cache.set(TAGS_RESPONSE_CACHE_KEY, (version, body, etag), app.config['TAG_CACHE_TTL'])
+    return body, etag
+
+tag_structure_cache = TagStructureCache(
+    load_tag_type_versions, load_tag_type_rows, app.config['TAG_CACHE_TTL']
+)
+
+# ==================== 缓存变更通知 ====================
+
+def invalidate_tag_and_theme_caches():
+    """整体失效标签结构与主题缓存（监听连接建立/重连时调用，断开期间的通知可能已丢失）"""
+    tag_structure_cache.invalidate()
+    get_themes.invalidate()
+
+def handle_cache_notification(channel, payload):
+    """
+    处理 tag_definitions / themes 触发器发出的变更通知
+    
+    Args:
+        channel: 通知频道
+        payload: JSON，如 {"table": "tag_definitions", "tag_type": "style"}；
+                 TRUNCATE 等语句级通知不带 tag_type
+    """
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        event = {}
+    table = event.get('table')
+    tag_type = event.get('tag_type')
+    
+    if table == 'themes':
+        get_themes.invalidate()
+    elif table == 'tag_definitions' and tag_type:
+        try:
+            tag_structure_cache.refresh_type(tag_type)
+            logger.info(f"Tag cache refreshed for tag_type={tag_type}")
+        except Exception as e:
+            logger.warning(f"Failed to refresh tag_type {tag_type}, invalidating tag cache: {str(e)}")
+            tag_structure_cache.invalidate()
+    else:
+        invalidate_tag_and_theme_caches()
+
+# 每个 worker 进程一个监听线程（首个请求时启动）
+cache_listener = PgNotifyListener(
+    connect=db.get_connection,
+    channels=[app.config['CACHE_NOTIFY_CHANNEL']],
+    handler=handle_cache_notification,
+    on_connect=invalidate_tag_and_theme_caches
+)
+
+def start_cache_listener():
+    """启动本进程的缓存变更监听线程（CACHE_LISTENER_ENABLED=false 时不启动）"""
+    if app.config['CACHE_LISTENER_ENABLED']:
+        cache_listener.start()
+
+@app.before_request
+def ensure_cache_listener():
+    start_cache_listener()
+
 # @app.route('/api/tags/<tag_type>', methods=['GET'])
 # @cache_decorator(expiration=7200)
 # def get_tags_by_type(tag_type):
@@ -465,12 +1257,193 @@ def get_all_tags():
 
 # ==================== 图片上传API ====================
 
-@app.route('/api/upload-image', methods=['POST'])
-def upload_image():
-    """上传单张图片到S3"""
+# 已上传图片登记（按内容 SHA-256 去重，同一内容按 image_type 分别存放）
+UPLOADED_IMAGE_LOOKUP_QUERY = """
+    SELECT url, width, height
+    FROM viba.uploaded_images
+    WHERE sha256 = %s AND image_type = %s
+"""
+UPLOADED_IMAGE_INSERT_QUERY = """
+    INSERT INTO viba.uploaded_images (sha256, image_type, url, s3_key, width, height, byte_size, content_type)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (sha256, image_type) DO NOTHING
+"""
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def uploaded_image_payload(row):
+    """已登记图片的上传接口响应数据（cached=True 表示未重新上传）"""
+    return {
+        'url': row['url'],
+        'cached': True,
+        'image_info': {
+            'width': row['width'],
+            'height': row['height']
+        }
+    }
+
+def uploaded_image_params(sha256, image_type, url, validation_result, content_type):
+    """UPLOADED_IMAGE_INSERT_QUERY 的参数"""
+    return (
+        sha256, image_type, url, s3_uploader.extract_s3_key_from_url(url),
+        validation_result['width'], validation_result['height'],
+        validation_result['file_size'], content_type
+    )
+
+def find_uploaded_image(sha256, image_type):
+    """查找已登记的图片；查询失败（如登记表尚未创建）按未命中处理，不影响上传"""
     try:
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'error': 'No file provided'}), 400
+        rows = db.execute_query(UPLOADED_IMAGE_LOOKUP_QUERY, (sha256, image_type))
+    except Exception as e:
+        logger.warning(f"Failed to look up uploaded image {sha256}: {str(e)}")
+        return None
+    return rows[0] if rows else None
+
+def register_uploaded_image(sha256, image_type, url, validation_result, content_type):
+    """登记新上传的图片；失败只记录日志，不影响上传结果"""
+    try:
+        db.execute_query(
+            UPLOADED_IMAGE_INSERT_QUERY,
+            uploaded_image_params(sha256, image_type, url, validation_result, content_type),
+            fetch=False
+        )
+    except Exception as e:
+        logger.warning(f"Failed to register uploaded image {sha256}: {str(e)}")
+
+# 直传S3允许的类型（与 ImageValidator.ALLOWED_FORMATS 对应）
+DIRECT_UPLOAD_CONTENT_TYPES = ('image/jpeg', 'image/png')
+
+def sign_upload_token(s3_key, image_type, expires_at):
+    """
+    直传确认令牌：对 presign 签发的 key、图片类型和过期时间做 HMAC
+    
+    Returns:
+        '{expires_at}.{签名}'
+    """
+    message = f"{s3_key}\n{image_type}\n{expires_at}".encode('utf-8')
+    signature = hmac.new(app.config['UPLOAD_TOKEN_SECRET'].encode('utf-8'), message, hashlib.sha256).hexdigest()
+    return f"{expires_at}.{signature}"
+
+def verify_upload_token(token, s3_key, image_type):
+    """校验 confirm 请求的令牌：由 sign_upload_token 为同一 key 和图片类型签发且未过期"""
+    if not app.config['UPLOAD_TOKEN_SECRET'] or not isinstance(token, str):
+        return False
+    expires_at = token.split('.', 1)[0]
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(token, sign_upload_token(s3_key, image_type, int(expires_at)))
+
+@app.route('/api/uploads/presign', methods=['POST'])
+def presign_upload():
+    """
+    获取浏览器直传S3的预签名上传地址（文件不经过应用服务器）
+    
+    请求体:
+        sha256: 待上传文件的 SHA-256（小写十六进制），签入上传地址，S3 校验内容一致
+        image_type: 与 upload-image 相同的图片类型
+        content_type: image/jpeg 或 image/png
+    
+    内容已上传过时返回 exists=True 和已有地址（与 upload-image 的 cached 结果相同）；
+    否则返回 key、upload_url、PUT 时必须携带的 headers 和确认令牌 token，上传完成后调用 uploads/confirm。
+    关闭直传（DIRECT_UPLOAD_ENABLED=false 或未配置 UPLOAD_TOKEN_SECRET）时不返回 upload_url，
+    客户端改用 upload-image。
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        sha256 = str(data.get('sha256') or '').lower()
+        image_type = data.get('image_type', 'reference_image')
+        content_type = data.get('content_type', 'image/jpeg')
+        
+        if not SHA256_PATTERN.match(sha256):
+            return jsonify({'success': False, 'error': 'sha256 must be 64 hex characters'}), 400
+        if image_type not in s3_uploader.path_templates:
+            return jsonify({'success': False, 'error': f'Invalid image_type: {image_type}'}), 400
+        if content_type not in DIRECT_UPLOAD_CONTENT_TYPES:
+            return jsonify({'success': False, 'error': f'Unsupported content_type: {content_type}'}), 400
+        
+        existing = find_uploaded_image(sha256, image_type)
+        if existing is not None:
+            return jsonify({'success': True, 'data': dict(uploaded_image_payload(existing), exists=True)})
+        if not app.config['DIRECT_UPLOAD_ENABLED'] or not app.config['UPLOAD_TOKEN_SECRET']:
+            return jsonify({'success': True, 'data': {'exists': False}})
+        
+        expires_in = app.config['UPLOAD_PRESIGN_EXPIRES']
+        presigned = s3_uploader.create_presigned_upload(
+            file_type=image_type,
+            content_type=content_type,
+            sha256=sha256,
+            expires_in=expires_in
+        )
+        # 上传地址过期后再留同样长的时间用于确认
+        token = sign_upload_token(presigned['key'], image_type, int(time.time()) + 2 * expires_in)
+        return jsonify({'success': True, 'data': dict(presigned, token=token, exists=False)})
+    except Exception as e:
+        logger.error(f"Presign upload error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/uploads/confirm', methods=['POST'])
+def confirm_upload():
+    """
+    确认直传上传：ranged GET 读取文件头验证格式和尺寸，通过后登记并返回访问地址
+    
+    请求体:
+        key: presign 返回的 key
+        image_type: 与 presign 相同的图片类型
+        token: presign 返回的确认令牌（只能确认本次签发的 key）
+    
+    返回与 upload-image 相同的数据。预签名 PUT 无法限制大小，超过大小限制或验证失败的对象
+    在这里删除并返回 400；验证通过后移除待确认标签，对象不再被存储桶生命周期规则清理。
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        s3_key = data.get('key')
+        image_type = data.get('image_type', 'reference_image')
+        
+        if image_type not in s3_uploader.path_templates:
+            return jsonify({'success': False, 'error': f'Invalid image_type: {image_type}'}), 400
+        if not isinstance(s3_key, str) or not s3_uploader.is_upload_key(image_type, s3_key):
+            return jsonify({'success': False, 'error': 'Invalid upload key'}), 400
+        if not verify_upload_token(data.get('token'), s3_key, image_type):
+            return jsonify({'success': False, 'error': 'Invalid or expired upload token'}), 403
+        
+        head = s3_uploader.read_object_head(s3_key, app.config['UPLOAD_CONFIRM_HEADER_BYTES'])
+        if head is None:
+            return jsonify({'success': False, 'error': 'Uploaded object not found'}), 404
+        
+        # 验证图片（格式、尺寸和总大小），不下载整个文件
+        validation_result = ImageValidator.validate_image(head['data'], file_size=head['size'])
+        if not validation_result['valid']:
+            s3_uploader.delete_object(s3_key)
+            return jsonify({'success': False, 'error': validation_result['error']}), 400
+        
+        s3_uploader.clear_pending_tag(s3_key)
+        url = s3_uploader.build_object_url(s3_key)
+        # 哈希来自上传时签入的元数据（S3 已按 x-amz-checksum-sha256 校验过内容）
+        sha256 = head['metadata'].get('sha256', '')
+        if SHA256_PATTERN.match(sha256):
+            register_uploaded_image(sha256, image_type, url, validation_result,
+                                    head['content_type'] or 'image/jpeg')
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'url': url,
+                'cached': False,
+                'image_info': {
+                    'width': validation_result['width'],
+                    'height': validation_result['height']
+                }
+            }
+        })
+    except Exception as e:
+        logger.error(f"Confirm upload error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/upload-image', methods=['POST'])
+def upload_image():
+    """上传单张图片到S3（内容已上传过时直接返回已有地址）"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'error': 'No file provided'}), 400
         
         file = request.files['file']
         image_type = request.form.get('image_type', 'reference_image')
@@ -481,6 +1454,12 @@ def upload_image():
         # 读取文件数据
         file_data = file.read()
         
+        # 计算文件哈希（用于去重，与浏览器端对同一文件计算的结果一致）
+        file_hash = hashlib.sha256(file_data).hexdigest()
+        existing = find_uploaded_image(file_hash, image_type)
+        if existing is not None:
+            return jsonify({'success': True, 'data': uploaded_image_payload(existing)})
+        
         # 验证图片（竖屏要求）
         validation_result = ImageValidator.validate_image(file_data)
         if not validation_result['valid']:
@@ -490,19 +1469,14 @@ def upload_image():
         if validation_result['file_size_mb'] > 10:
             file_data = ImageValidator.compress_image(file_data, quality=85)
         
-        # 计算文件哈希（用于去重）
-        file_hash = hashlib.md5(file_data).hexdigest()
-        
-        # 无外部缓存
-        
         # 上传到S3
+        content_type = file.content_type or 'image/jpeg'
         url = s3_uploader.upload_file(
             file_data=file_data,
             file_type=image_type,
-            content_type=file.content_type or 'image/jpeg'
+            content_type=content_type
         )
-        
-        # 无外部缓存
+        register_uploaded_image(file_hash, image_type, url, validation_result, content_type)
         
         return jsonify({
             'success': True,
@@ -638,8 +1612,24 @@ def collect_all_tag_ids(data):
     # 过滤掉None和无效值
     return {tag_id for tag_id in all_tag_ids if tag_id is not None}
 
+def find_malformed_tag_ids(all_tag_ids, tag_data):
+    """
+    找出不是整数的标签ID（在查询数据库前校验，避免类型错误变成 500）
+    
+    Args:
+        all_tag_ids: collect_all_tag_ids 的结果
+        tag_data: prepare_tag_data_for_storage 的结果
+    
+    Returns:
+        不合法的标签ID列表
+    """
+    candidates = set(all_tag_ids)
+    for tag_ids in tag_data.values():
+        candidates.update(tag_ids or [])
+    return [tag_id for tag_id in candidates if isinstance(tag_id, bool) or not isinstance(tag_id, int)]
+
 
-def enrich_with_parent_tags(tag_ids_by_field):
+def enrich_with_parent_tags(tag_ids_by_field, cancel_event=None):
     """
     为每组标签ID添加所有父级标签ID
     确保存储的是完整的标签层级链
@@ -647,6 +1637,7 @@ def enrich_with_parent_tags(tag_ids_by_field):
     Args:
         tag_ids_by_field: 按字段分组的标签ID字典
                          如: {'style_tag_ids': [3, 4], 'occasion_tag_ids': [10, 11]}
+        cancel_event: 置位后在下一次查询前停止（抛出 StageCancelled）
     
     Returns:
         enriched_dict: 包含所有父级的标签ID字典
@@ -666,6 +1657,7 @@ def enrich_with_parent_tags(tag_ids_by_field):
         all_ids_with_parents = set()
         
         for tag_id in tag_ids:
+            check_cancelled(cancel_event, 'enrich_tags')
             try:
                 # 查询该标签及其所有父级
                 query = """
@@ -784,165 +1776,215 @@ def prepare_tag_data_for_storage(data):
 # ==================== 参考图管理API ====================
 # ==================== 修改后的 create_reference_image 函数 ====================
 
+# reference_images 插入字段（对齐最新字段命名）
+REFERENCE_INSERT_COLUMNS = [
+    'reference_image_url',
+    'reference_type',
+    'gen_pose_images', 'gen_pose_description',
+    'gen_product_images', 'gen_product_description',
+    'gen_occasion_images', 'gen_occasion_description',
+    'gen_composition_images', 'gen_composition_description',
+    'gen_style_images', 'gen_style_description',
+    'gen_content_prompt', 'gen_ml_model_source',
+    'product_item_ids', 'can_be_used_for_face_switching',
+    'pose_description', 'scene_description',
+    'style_tag_ids', 'pose_tag_ids', 'occasion_tag_ids', 'composition_tag_ids', 'product_type_tag_ids',
+    'model_attribute_tag_ids', 'fabric_tag_ids', 'silhouette_tag_ids',
+    'outfit_details',
+    'gen_content_embedding', 'gen_pose_embedding',
+    'gen_product_embedding', 'gen_occasion_embedding',
+    'gen_composition_embedding', 'pose_embedding', 'scene_embedding'
+]
+
+def get_reference_column_kind(column):
+    """字段在 COPY 编码时的类型：array / json / vector / scalar"""
+    if column in ('outfit_details',):
+        return 'json'
+    if column.endswith('_embedding'):
+        return 'vector'
+    if column.endswith('_images') or column.endswith('_ids'):
+        return 'array'
+    return 'scalar'
+
+def encode_reference_param(value, kind):
+    """按字段类型包装参数：JSON 字段用 Json，向量字段用 Vector，其余原样传给 psycopg2"""
+    if kind == 'json':
+        return Json(value)
+    if kind == 'vector':
+        return to_vector_param(value)
+    return value
+
+def build_reference_insert_query(columns):
+    """构建 reference_images 的单行插入语句"""
+    placeholders = ['%s::uuid[]' if column in ('product_item_ids',) else '%s' for column in columns]
+    return f"""
+        INSERT INTO viba.reference_images (
+            {", ".join(columns)}
+        ) VALUES (
+            {", ".join(placeholders)}
+        ) RETURNING id, unique_id
+    """
+
+def validate_reference_payload(data):
+    """
+    校验参考图的必填字段和类型相关字段
+    
+    Returns:
+        错误信息，校验通过时返回 None
+    """
+    if not isinstance(data, dict):
+        return 'Request body must be a JSON object'
+    
+    # 必填字段验证
+    required_fields = ['reference_image_url', 'reference_type']
+    
+    for field in required_fields:
+        if field not in data:
+            return f'Missing required field: {field}'
+    
+    # 根据类型验证特定字段
+    if data['reference_type'] == 1:  # 生成图
+        if not data.get('gen_content_prompt') or not data.get('gen_ml_model_source'):
+            return 'Generated images require gen_content_prompt and gen_ml_model_source'
+    elif data['reference_type'] == 2:  # 匹配图
+        if 'can_be_used_for_face_switching' not in data:
+            return 'Matching images require can_be_used_for_face_switching field'
+    
+    return None
+
+def parse_product_item_ids(data):
+    """将 product_item_ids 由文本转为 UUID，格式错误时抛出 ValueError"""
+    product_item_ids = []
+    for i, uid in enumerate(data.get('product_item_ids') or []):
+        try:
+            if uid.strip():  # Skip empty strings
+                product_item_ids.append(str(uuid.UUID(uid.strip())))
+        except (ValueError, AttributeError):
+            raise ValueError(f'Invalid UUID format at position {i+1}: "{uid}"')
+    return product_item_ids
+
+def build_reference_row(data, product_item_ids, enriched_tags, embeddings):
+    """
+    按 REFERENCE_INSERT_COLUMNS 的字段准备一行数据
+    
+    Returns:
+        {column: value}，值为原始 Python 对象（JSON 字段未包装）
+    """
+    row = {
+        # 基础字段
+        'reference_image_url': data['reference_image_url'],
+        'reference_type': data['reference_type'],
+        
+        # 生成图相关字段
+        'gen_pose_images': data.get('gen_pose_images', []),
+        'gen_pose_description': data.get('gen_pose_description'),
+        # 兼容旧命名（gen_outfit_* -> gen_product_*）
+        'gen_product_images': data.get('gen_product_images') if data.get('gen_product_images') is not None else data.get('gen_outfit_images', []),
+        'gen_product_description': data.get('gen_product_description') if data.get('gen_product_description') is not None else data.get('gen_outfit_description'),
+        # 兼容旧命名（gen_scene_* -> gen_occasion_*）
+        'gen_occasion_images': data.get('gen_occasion_images') if data.get('gen_occasion_images') is not None else data.get('gen_scene_images', []),
+        'gen_occasion_description': data.get('gen_occasion_description') if data.get('gen_occasion_description') is not None else data.get('gen_scene_description'),
+        'gen_composition_images': data.get('gen_composition_images', []),
+        'gen_composition_description': data.get('gen_composition_description'),
+        'gen_style_images': data.get('gen_style_images', []),
+        'gen_style_description': data.get('gen_style_description'),
+        'gen_content_prompt': data.get('gen_content_prompt'),
+        'gen_ml_model_source': data.get('gen_ml_model_source'),
+        
+        # 匹配图相关字段
+        'product_item_ids': product_item_ids,
+        'can_be_used_for_face_switching': data.get('can_be_used_for_face_switching'),
+        'pose_description': data.get('pose_description'),
+        'scene_description': data.get('scene_description'),
+        
+        # 服装详情JSON
+        'outfit_details': data.get('outfit_details', [])
+    }
+    
+    # 标签数组字段 - 使用enriched_tags中的映射后数据
+    for field in REFERENCE_TAG_FIELDS:
+        row[field] = enriched_tags.get(field, [])
+    
+    # 向量嵌入字段
+    for column in EMBEDDING_COLUMN_DIMENSIONS:
+        row[column] = embeddings.get(column)
+    
+    return row
+
 @app.route('/api/reference-images', methods=['POST'])
 def create_reference_image():
     """创建参考图标注"""
     try:
         data = request.json
-        logger.info(f"Received data keys: {list(data.keys())}")
-        
-        # 必填字段验证
-        required_fields = ['reference_image_url', 'reference_type']
-        
-        for field in required_fields:
-            if field not in data:
-                return jsonify({
-                    'success': False,
-                    'error': f'Missing required field: {field}'
-                }), 400
         
-        # 根据类型验证特定字段
-        if data['reference_type'] == 1:  # 生成图
-            if not data.get('gen_content_prompt') or not data.get('gen_ml_model_source'):
-                return jsonify({
-                    'success': False,
-                    'error': 'Generated images require gen_content_prompt and gen_ml_model_source'
-                }), 400
-        elif data['reference_type'] == 2:  # 匹配图
-            if 'can_be_used_for_face_switching' not in data:
-                return jsonify({
-                    'success': False,
-                    'error': 'Matching images require can_be_used_for_face_switching field'
-                }), 400
+        error = validate_reference_payload(data)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
         
-        # 生成向量嵌入（如果启用）
-        embeddings = generate_embeddings_for_reference(data) if app.config['ENABLE_EMBEDDINGS'] else {}
-
+        logger.info(f"Received data keys: {list(data.keys())}")
         logger.info(data)
         
-        # 收集并验证标签
+        ## 将product_item_id由text转为uuid
+        try:
+            product_item_ids = parse_product_item_ids(data)
+            theme_ids = parse_theme_ids(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        if theme_ids:
+            known_themes = load_existing_theme_ids([(1, {'theme_ids': theme_ids})])
+            invalid_themes = [theme_id for theme_id in theme_ids if theme_id not in known_themes]
+            if invalid_themes:
+                return jsonify({'success': False, 'error': f'Invalid theme IDs: {invalid_themes}'}), 400
+        
+        # 收集标签，准备标签数据（处理字段映射）
         all_tag_ids = collect_all_tag_ids(data)
-
-        if all_tag_ids:
-            invalid_tags = validate_tag_ids(all_tag_ids)
-            if invalid_tags:
-                return jsonify({
-                    'success': False,
-                    'error': f'Invalid tag IDs: {list(invalid_tags)}'
-                }), 400
-        
-        # 准备标签数据（处理字段映射）
         tag_data = prepare_tag_data_for_storage(data)
-        
-        # 添加父级标签
-        enriched_tags = enrich_with_parent_tags(tag_data)
-        
-        logger.info(f"Enriched tags: {list(enriched_tags.keys())}")
-        
-        # 构建插入查询（对齐最新字段命名）
-        insert_query = """
-            INSERT INTO viba.reference_images (
-                reference_image_url,
-                reference_type,
-                gen_pose_images, gen_pose_description,
-                gen_product_images, gen_product_description,
-                gen_occasion_images, gen_occasion_description,
-                gen_composition_images, gen_composition_description,
-                gen_style_images, gen_style_description,
-                gen_content_prompt, gen_ml_model_source,
-                product_item_ids, can_be_used_for_face_switching,
-                pose_description, scene_description,
-                style_tag_ids, pose_tag_ids, occasion_tag_ids, composition_tag_ids, product_type_tag_ids,
-                model_attribute_tag_ids, fabric_tag_ids, silhouette_tag_ids,
-                outfit_details,
-                gen_content_embedding, gen_pose_embedding,
-                gen_product_embedding, gen_occasion_embedding,
-                gen_composition_embedding, pose_embedding, scene_embedding
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s::uuid[], %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s
-            ) RETURNING id, unique_id
-        """
-        
-        # 准备参数 - 使用正确的映射
-        ## 将product_item_id由text转为uuid
-        product_item_ids = []
-        if data.get('product_item_ids'):
-            for i, uid in enumerate(data.get('product_item_ids', [])):
-                try:
-                    if uid.strip():  # Skip empty strings
-                        validated_uuid = str(uuid.UUID(uid.strip()))
-                        product_item_ids.append(validated_uuid)
-                except ValueError:
+        malformed_tags = find_malformed_tag_ids(all_tag_ids, tag_data)
+        if malformed_tags:
+            return jsonify({'success': False, 'error': f'Invalid tag IDs: {malformed_tags}'}), 400
+        
+        # 向量嵌入（CPU）、父级标签补全和标签校验（数据库）互不依赖，并发执行；
+        # 校验失败时取消其余阶段
+        with stage_executor.group() as stages:
+            embedding_stage = stages.submit(
+                'embedding', generate_embeddings_for_reference, data, cancel_event=stages.cancel_event
+            ) if app.config['ENABLE_EMBEDDINGS'] else None
+            enrich_stage = stages.submit(
+                'enrich_tags', enrich_with_parent_tags, tag_data, cancel_event=stages.cancel_event
+            )
+            
+            if all_tag_ids:
+                invalid_tags = validate_tag_ids(all_tag_ids)
+                if invalid_tags:
+                    stages.cancel()
                     return jsonify({
                         'success': False,
-                        'error': f'Invalid UUID format at position {i+1}: "{uid}"'
+                        'error': f'Invalid tag IDs: {list(invalid_tags)}'
                     }), 400
-                
-                
-        params = [
-            # 基础字段
-            data['reference_image_url'],
-            data['reference_type'],
-            
-            # 生成图相关字段
-            data.get('gen_pose_images', []),
-            data.get('gen_pose_description'),
-            # 兼容旧命名（gen_outfit_* -> gen_product_*）
-            data.get('gen_product_images') if data.get('gen_product_images') is not None else data.get('gen_outfit_images', []),
-            data.get('gen_product_description') if data.get('gen_product_description') is not None else data.get('gen_outfit_description'),
-            # 兼容旧命名（gen_scene_* -> gen_occasion_*）
-            data.get('gen_occasion_images') if data.get('gen_occasion_images') is not None else data.get('gen_scene_images', []),
-            data.get('gen_occasion_description') if data.get('gen_occasion_description') is not None else data.get('gen_scene_description'),
-            data.get('gen_composition_images', []),
-            data.get('gen_composition_description'),
-            data.get('gen_style_images', []),
-            data.get('gen_style_description'),
-            data.get('gen_content_prompt',[]),
-            data.get('gen_ml_model_source'),
-            
-            # 匹配图相关字段
-            product_item_ids,
-            data.get('can_be_used_for_face_switching'),
-            data.get('pose_description'),
-            data.get('scene_description'),
-            
-            # 标签数组字段 - 使用enriched_tags中的映射后数据
-            enriched_tags.get('style_tag_ids',[]),
-            enriched_tags.get('pose_tag_ids', []),
-            enriched_tags.get('occasion_tag_ids', []),
-            enriched_tags.get('composition_tag_ids',[]),
-            enriched_tags.get('product_type_tag_ids', []),
-            enriched_tags.get('model_attribute_tag_ids', []),
-            enriched_tags.get('fabric_tag_ids', []),
-            enriched_tags.get('silhouette_tag_ids', []),
             
-            # 服装详情JSON
-            Json(data.get('outfit_details', [])),
-            
-            # 向量嵌入字段
-            embeddings.get('gen_content_embedding'),
-            embeddings.get('gen_pose_embedding'),
-            embeddings.get('gen_product_embedding') if embeddings.get('gen_product_embedding') is not None else embeddings.get('gen_outfit_embedding'),
-            embeddings.get('gen_occasion_embedding') if embeddings.get('gen_occasion_embedding') is not None else embeddings.get('gen_scene_embedding'),
-            embeddings.get('gen_composition_embedding'),
-            embeddings.get('pose_embedding'),
-            embeddings.get('scene_embedding')
+            enriched_tags = enrich_stage.result()
+            embeddings = embedding_stage.result() if embedding_stage is not None else {}
+        
+        logger.info(f"Enriched tags: {list(enriched_tags.keys())}")
+        
+        row = build_reference_row(data, product_item_ids, enriched_tags, embeddings)
+        insert_query = build_reference_insert_query(REFERENCE_INSERT_COLUMNS)
+        params = [
+            encode_reference_param(row[column], get_reference_column_kind(column))
+            for column in REFERENCE_INSERT_COLUMNS
         ]
         
-        # 插入数据
-        result = db.execute_insert(insert_query, params)
+        # 插入数据，主题关联在同一事务内一条语句写入
+        result = db.execute_insert(
+            insert_query, params,
+            after=lambda cursor, row: insert_theme_links(
+                cursor, [(row['unique_id'], theme_id) for theme_id in theme_ids]
+            )
+        )
         
-        # 关联主题
-        if 'theme_ids' in data and data['theme_ids']:
-            for theme_id in data['theme_ids']:
-                theme_query = """
-                    INSERT INTO viba.ref_images_to_themes (ref_image_id, theme_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT DO NOTHING
-                """
-                db.execute_query(theme_query, (result['unique_id'], theme_id), fetch=False)
+        # 增量更新标签计数缓存和进程内向量索引
+        update_reference_caches([(str(result['unique_id']), enriched_tags, embeddings)])
         
         # 无外部缓存
         
@@ -959,20 +2001,296 @@ def create_reference_image():
 
 
         
+@app.route('/api/reference-images/bulk', methods=['POST'])
+def bulk_create_reference_images():
+    """
+    批量导入参考图标注（NDJSON，每行一个与单条接口相同的 JSON 对象）
+    
+    每批数据统一对照标签索引校验和补全父级标签，批量生成向量，
+    再通过 COPY 写入临时表后 INSERT ... SELECT 落库。按行返回结果（line 为行号，从 1 开始）。
+    """
+    try:
+        records = []
+        results = []
+        max_rows = app.config['BULK_INGEST_MAX_ROWS']
+        max_bytes = app.config['BULK_INGEST_MAX_BYTES']
+        
+        if request.content_length is not None and request.content_length > max_bytes:
+            return jsonify({
+                'success': False,
+                'error': f'Request body too large, maximum is {max_bytes} bytes'
+            }), 413
+        
+        # 逐行读取请求体，行数和字节数超限时在解析之前停止
+        received = 0
+        for line_number, raw_line in enumerate(request.stream, start=1):
+            received += len(raw_line)
+            if received > max_bytes:
+                return jsonify({
+                    'success': False,
+                    'error': f'Request body too large, maximum is {max_bytes} bytes'
+                }), 413
+            if not raw_line.strip():
+                continue
+            if len(records) + len(results) >= max_rows:
+                return jsonify({
+                    'success': False,
+                    'error': f'Too many rows, maximum is {max_rows}'
+                }), 413
+            try:
+                records.append((line_number, json.loads(raw_line)))
+            except ValueError as e:
+                results.append({'line': line_number, 'success': False, 'error': f'Invalid JSON: {str(e)}'})
+        
+        if not records and not results:
+            return jsonify({'success': False, 'error': 'No records provided'}), 400
+        
+        # 一次加载标签索引，整批校验和补全父级
+        parent_index = load_tag_parent_index()
+        
+        chunk_size = app.config['BULK_INGEST_CHUNK_SIZE']
+        for start in range(0, len(records), chunk_size):
+            results.extend(ingest_reference_chunk(records[start:start + chunk_size], parent_index))
+        
+        results.sort(key=lambda item: item['line'])
+        inserted = sum(1 for item in results if item['success'])
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'total': len(results),
+                'inserted': inserted,
+                'failed': len(results) - inserted,
+                'results': results
+            }
+        })
+    except Exception as e:
+        logger.error(f"Bulk ingest error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def ingest_reference_chunk(records, parent_index):
+    """
+    校验、补全并写入一批参考图
+    
+    Args:
+        records: [(line_number, data), ...]
+        parent_index: load_tag_parent_index 返回的 {tag_id: parent_tag_id}
+    
+    Returns:
+        按行的结果列表
+    """
+    results = []
+    prepared = []  # [(line_number, data, unique_id, row, enriched_tags, theme_ids)]
+    known_themes = load_existing_theme_ids(records)
+    
+    for line_number, data in records:
+        error = validate_reference_payload(data)
+        if not error:
+            tag_data = prepare_tag_data_for_storage(data)
+            try:
+                invalid_tags = find_unknown_tag_ids(data, tag_data, parent_index)
+                if invalid_tags:
+                    error = f'Invalid tag IDs: {invalid_tags}'
+            except TypeError:
+                # 标签字段里出现了列表、对象等不可哈希的值
+                error = 'Invalid tag IDs: tag IDs must be integers'
+        if not error:
+            try:
+                product_item_ids = parse_product_item_ids(data)
+                theme_ids = parse_theme_ids(data)
+            except ValueError as e:
+                error = str(e)
+        if not error:
+            invalid_themes = [theme_id for theme_id in theme_ids if theme_id not in known_themes]
+            if invalid_themes:
+                error = f'Invalid theme IDs: {invalid_themes}'
+        if error:
+            results.append({'line': line_number, 'success': False, 'error': error})
+            continue
+        
+        enriched_tags = {
+            field: sorted(expand_with_ancestors(tag_ids, parent_index))
+            for field, tag_ids in tag_data.items()
+        }
+        row = build_reference_row(data, product_item_ids, enriched_tags, {})
+        prepared.append((line_number, data, str(uuid.uuid4()), row, enriched_tags, theme_ids))
+    
+    if not prepared:
+        return results
+    
+    # 整批生成向量
+    if app.config['ENABLE_EMBEDDINGS']:
+        batch_embeddings = generate_embeddings_for_batch([item[1] for item in prepared])
+        for item, embeddings in zip(prepared, batch_embeddings):
+            item[3].update(embeddings)
+    
+    columns = ['unique_id'] + REFERENCE_INSERT_COLUMNS
+    kinds = [get_reference_column_kind(column) for column in columns]
+    rows = [[unique_id] + [row[column] for column in REFERENCE_INSERT_COLUMNS]
+            for _, _, unique_id, row, _, _ in prepared]
+    
+    # 主题关联与参考图在同一事务内写入，任何一步失败整批回滚
+    theme_links = [(unique_id, theme_id) for _, _, unique_id, _, _, theme_ids in prepared for theme_id in theme_ids]
+    
+    inserted = []
+    try:
+        db.copy_insert('viba.reference_images', columns, kinds, rows,
+                       after=lambda cursor: insert_theme_links(cursor, theme_links))
+        inserted = prepared
+    except Exception as e:
+        # 整批失败时逐行重试（每行连同其主题关联一个事务），定位具体出错的行
+        logger.warning(f"Bulk COPY failed, retrying row by row: {str(e)}")
+        insert_query = build_reference_insert_query(columns)
+        for item, values in zip(prepared, rows):
+            params = [encode_reference_param(value, kind) for value, kind in zip(values, kinds)]
+            row_links = [(item[2], theme_id) for theme_id in item[5]]
+            try:
+                db.execute_insert(insert_query, params,
+                                  after=lambda cursor, _, links=row_links: insert_theme_links(cursor, links))
+                inserted.append(item)
+            except Exception as row_error:
+                results.append({'line': item[0], 'success': False, 'error': str(row_error)})
+    
+    if not inserted:
+        return results
+    
+    update_reference_caches([
+        (unique_id, enriched_tags, {column: row[column] for column in EMBEDDING_COLUMN_DIMENSIONS if row[column] is not None})
+        for _, _, unique_id, row, enriched_tags, _ in inserted
+    ])
+    
+    for line_number, _, unique_id, _, _, _ in inserted:
+        results.append({'line': line_number, 'success': True, 'unique_id': unique_id})
+    
+    return results
+
+# 详情接口默认返回的字段（不含向量和生成列 search_text / search_tsv）
+REFERENCE_DETAIL_COLUMNS = [
+    'id', 'unique_id', 'reference_image_url', 'reference_type',
+    'gen_pose_images', 'gen_pose_description',
+    'gen_product_images', 'gen_product_description',
+    'gen_occasion_images', 'gen_occasion_description',
+    'gen_composition_images', 'gen_composition_description',
+    'gen_style_images', 'gen_style_description',
+    'gen_content_prompt', 'gen_ml_model_source',
+    'product_item_ids', 'can_be_used_for_face_switching',
+    'pose_description', 'scene_description'
+] + REFERENCE_TAG_FIELDS + ['outfit_details', 'created_at', 'updated_at']
+
+# 主题信息来自关联表的 LATERAL 聚合
+REFERENCE_THEME_FIELDS = ['theme_titles', 'theme_ids']
+
+# 详情接口的版本列（条件请求用，不返回给客户端）
+REFERENCE_VERSION_FIELDS = ['_row_version', '_updated_at', '_theme_version']
+
+def reference_version_columns(include_themes):
+    """
+    参考图详情的版本列 SQL
+    
+    _row_version 为行的 xmin，任何 UPDATE 都会改变（不依赖应用是否更新 updated_at）；
+    返回主题字段时 _theme_version 汇总关联主题及其行版本，关联或主题标题变化都会改变。
+    """
+    theme_version = """(
+                SELECT string_agg(rit.theme_id::text || ':' || t.xmin::text, ',' ORDER BY rit.theme_id)
+                FROM viba.ref_images_to_themes rit
+                JOIN viba.themes t ON rit.theme_id = t.unique_id
+                WHERE rit.ref_image_id = ri.unique_id
+            )""" if include_themes else "NULL"
+    return f"ri.xmin::text AS _row_version, ri.updated_at AS _updated_at, {theme_version} AS _theme_version"
+
+def reference_validators(unique_id, versions, fields, include_themes):
+    """
+    由版本列计算 (ETag, Last-Modified)
+    
+    Args:
+        unique_id: 参考图 ID
+        versions: 含 REFERENCE_VERSION_FIELDS 的查询行
+        fields: 返回的字段（不同字段组合是不同的表示，ETag 不同）
+        include_themes: 是否返回主题字段（此时不提供 Last-Modified）
+    """
+    key = f"{unique_id}:{versions['_row_version']}:{versions['_theme_version'] or ''}:{','.join(fields)}"
+    etag = hashlib.sha1(key.encode()).hexdigest()
+    last_modified = None if include_themes else versions['_updated_at']
+    return etag, last_modified
+
 @app.route('/api/reference-images/<unique_id>', methods=['GET'])
 def get_reference_image(unique_id):
-    """获取单个参考图详情"""
+    """
+    获取单个参考图详情
+    
+    Query参数:
+        fields: 逗号分隔的字段列表，默认返回除向量外的所有字段和主题信息
+        include_embeddings: 为 true 时附带全部向量字段
+    
+    向量字段以 base64 编码的小端 float32 字节返回（见 embedding_encoding）
+    
+    支持条件请求：ETag 由行版本（xmin）、所选字段和关联主题版本计算，Last-Modified 取 updated_at
+    （返回主题字段时不提供，主题关联的变化不体现在 updated_at 上）。带 If-None-Match / If-Modified-Since
+    的请求先只查版本（主键索引一次查找），未变化时直接返回 304。
+    """
     try:
-        query = """
-            SELECT 
-                ri.*,
-                array_agg(DISTINCT t.title) FILTER (WHERE t.title IS NOT NULL) as theme_titles,
-                array_agg(DISTINCT t.unique_id) FILTER (WHERE t.unique_id IS NOT NULL) as theme_ids
+        embedding_columns = list(EMBEDDING_COLUMN_DIMENSIONS)
+        allowed_fields = REFERENCE_DETAIL_COLUMNS + embedding_columns + REFERENCE_THEME_FIELDS
+        
+        fields_param = request.args.get('fields')
+        if fields_param:
+            fields = [field.strip() for field in fields_param.split(',') if field.strip()]
+            unknown = [field for field in fields if field not in allowed_fields]
+            if unknown:
+                return jsonify({
+                    'success': False,
+                    'error': f'Unknown fields: {unknown}'
+                }), 400
+        else:
+            fields = REFERENCE_DETAIL_COLUMNS + REFERENCE_THEME_FIELDS
+        
+        if request.args.get('include_embeddings', 'false').lower() in ('true', '1', 'yes'):
+            fields = fields + [column for column in embedding_columns if column not in fields]
+        
+        # 保持请求顺序并去重
+        fields = list(dict.fromkeys(fields))
+        select_list = []
+        for field in fields:
+            if field in REFERENCE_THEME_FIELDS:
+                select_list.append(f"themes.{field}")
+            elif field == 'product_item_ids':
+                # uuid[] 没有默认的类型转换，转为 text[] 以返回列表
+                select_list.append(f"ri.{field}::text[] AS {field}")
+            else:
+                select_list.append(f"ri.{field}")
+        
+        include_themes = any(field in REFERENCE_THEME_FIELDS for field in fields)
+        version_columns = reference_version_columns(include_themes)
+        
+        if request.if_none_match or request.if_modified_since:
+            versions = db.execute_query(
+                f"SELECT {version_columns} FROM viba.reference_images ri WHERE ri.unique_id = %s",
+                (unique_id,)
+            )
+            if versions:
+                etag, last_modified = reference_validators(unique_id, versions[0], fields, include_themes)
+                response = make_conditional_response(Response(), etag, last_modified)
+                if response.status_code == 304:
+                    return response
+        
+        theme_join = ""
+        if include_themes:
+            theme_join = """
+            LEFT JOIN LATERAL (
+                SELECT
+                    array_agg(DISTINCT t.title) AS theme_titles,
+                    array_agg(DISTINCT t.unique_id::text) AS theme_ids
+                FROM viba.ref_images_to_themes rit
+                JOIN viba.themes t ON rit.theme_id = t.unique_id
+                WHERE rit.ref_image_id = ri.unique_id
+            ) themes ON TRUE
+            """
+        
+        query = f"""
+            SELECT {', '.join(select_list)}, {version_columns}
             FROM viba.reference_images ri
-            LEFT JOIN viba.ref_images_to_themes rit ON ri.unique_id = rit.ref_image_id
-            LEFT JOIN viba.themes t ON rit.theme_id = t.unique_id
+            {theme_join}
             WHERE ri.unique_id = %s
-            GROUP BY ri.id, ri.unique_id
         """
         
         results = db.execute_query(query, (unique_id,))
@@ -983,81 +2301,407 @@ def get_reference_image(unique_id):
                 'error': 'Reference image not found'
             }), 404
         
-        return jsonify({
+        data = results[0]
+        etag, last_modified = reference_validators(unique_id, data, fields, include_themes)
+        for column in REFERENCE_VERSION_FIELDS:
+            data.pop(column, None)
+        returned_embeddings = [column for column in embedding_columns if column in data]
+        for column in returned_embeddings:
+            data[column] = encode_vector_base64(data[column])
+        
+        response = {
             'success': True,
-            'data': results[0]
-        })
+            'data': data
+        }
+        if returned_embeddings:
+            response['embedding_encoding'] = 'base64-float32-le'
+        return make_conditional_response(jsonify(response), etag, last_modified)
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+@app.route('/api/reference-images/export', methods=['GET'])
+def export_reference_images():
+    """
+    流式导出全部参考图标注（训练数据集）
+    
+    Query参数:
+        format: ndjson（默认）或 parquet
+        embeddings: 是否包含向量字段，默认 true
+    """
+    export_format = request.args.get('format', 'ndjson').lower()
+    include_embeddings = request.args.get('embeddings', 'true').lower() in ('true', '1', 'yes')
+    
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({
+            'success': False,
+            'error': f'Unsupported format: {export_format}, expected one of {list(EXPORT_FORMATS)}'
+        }), 400
+    if export_format == 'parquet' and not PARQUET_AVAILABLE:
+        return jsonify({
+            'success': False,
+            'error': 'Parquet export is not available (pyarrow is not installed)'
+        }), 501
+    
+    try:
+        chunks = iter_export_chunks(export_format, include_embeddings)
+        # 先取第一块，让查询错误在响应开始前以 JSON 形式返回
+        first_chunk = next(chunks, b'')
+    except Exception as e:
+        logger.error(f"Export error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    def generate():
+        yield first_chunk
+        yield from chunks
+    
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    extension = 'ndjson' if export_format == 'ndjson' else 'parquet'
+    mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'application/vnd.apache.parquet'
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=reference_images_{timestamp}.{extension}'}
+    )
+
+def iter_export_chunks(export_format, include_embeddings):
+    """
+    逐块生成导出内容：服务端游标分批读取，逐行解析标签名称和向量，内存占用与表大小无关
+    
+    Args:
+        export_format: 'ndjson' 或 'parquet'
+        include_embeddings: 是否包含向量字段
+    
+    Yields:
+        字节片段
+    """
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    # 导出历史数据，停用的标签也需要解析名称
+    tag_names = {
+        row['id']: row['tag_name']
+        for row in db.execute_query("SELECT id, tag_name FROM viba.tag_definitions")
+    }
+    
+    rows = db.stream_query(build_export_query(include_embeddings), itersize=batch_size)
+    records = (resolve_export_row(row, tag_names, include_embeddings) for row in rows)
+    
+    if export_format == 'parquet':
+        return iter_parquet(records, batch_size, EMBEDDING_COLUMN_DIMENSIONS, include_embeddings)
+    return iter_ndjson(records)
+
+@app.cli.command('export-references')
+@click.option('--format', 'export_format', type=click.Choice(EXPORT_FORMATS), default='ndjson')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), required=True,
+              help='输出文件路径')
+@click.option('--no-embeddings', is_flag=True, help='不导出向量字段')
+def export_references_command(export_format, output, no_embeddings):
+    """导出全部参考图标注到文件（flask --app app export-references -o data.parquet --format parquet）"""
+    if export_format == 'parquet' and not PARQUET_AVAILABLE:
+        raise click.ClickException('Parquet export requires pyarrow')
+    
+    written = 0
+    with open(output, 'wb') as f:
+        for chunk in iter_export_chunks(export_format, not no_embeddings):
+            f.write(chunk)
+            written += len(chunk)
+    click.echo(f'Exported {written} bytes to {output}')
+
 @app.route('/api/reference-images/search', methods=['POST'])
 def search_reference_images():
-    """搜索参考图"""
+    """
+    搜索参考图
+    
+    使用键集分页：首次请求不带 cursor，后续请求传入上一页返回的 next_cursor。
+    旧的 offset 参数仍然兼容，但深分页会随偏移量线性变慢。
+    
+    标签过滤（tag_filters）：
+        {'style_tag_ids': [3, 4]} 命中任意一个；
+        {'style_tag_ids': {'any': [3, 4], 'all': [7, 8]}} 同时支持任意/全部匹配，
+        选择父级标签会匹配其所有子孙标签
+    
+    文本搜索（search_text）：
+        search_mode='fulltext'（默认）：tsvector 分词匹配 + pg_trgm 子串匹配（中文无需分词），按相关度排序
+        search_mode='substring'：仅子串匹配（pg_trgm 索引），按时间排序
+        highlight=true：返回带 <mark> 标记的摘要
+    """
     try:
-        data = request.json
-        conditions = []
-        params = []
+        data = request.json or {}
         
         # 构建搜索条件
-        if 'reference_type' in data:
-            conditions.append("reference_type = %s")
-            params.append(data['reference_type'])
-        
-        if 'theme_ids' in data and data['theme_ids']:
-            conditions.append("""
-                EXISTS (
-                    SELECT 1 FROM viba.ref_images_to_themes 
-                    WHERE ref_image_id = ri.unique_id 
-                    AND theme_id = ANY(%s)
-                )
-            """)
-            params.append(data['theme_ids'])
+        try:
+            conditions, params = build_reference_filter_conditions(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        if 'search_text' in data and data['search_text']:
-            conditions.append("search_text ILIKE %s")
-            params.append(f"%{data['search_text']}%")
+        search_text = (data.get('search_text') or '').strip()
+        
+        # 相关度表达式，仅全文模式使用
+        rank_expr = None
+        rank_params = []
+        if search_text and data.get('search_mode', 'fulltext') == 'fulltext':
+            rank_expr = """(
+                ts_rank_cd(ri.search_tsv, websearch_to_tsquery('simple', %s))
+                + word_similarity(%s, ri.search_text)
+            )::float8"""
+            rank_params = [search_text, search_text]
+        
+        highlight = bool(data.get('highlight')) and bool(search_text)
+        
+        try:
+            limit = min(max(int(data.get('limit', 20)), 1), 100)
+            offset = max(int(data.get('offset', 0)), 0)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'limit and offset must be integers'}), 400
         
         where_clause = " AND ".join(conditions) if conditions else "1=1"
         
+        if rank_expr:
+            order_columns = ['rank', 'created_at', 'id']
+            order_clause = "matched.rank DESC, matched.created_at DESC, matched.id DESC"
+        else:
+            order_columns = ['created_at', 'id']
+            order_clause = "matched.created_at DESC, matched.id DESC"
+        
+        keyset_clause = "TRUE"
+        keyset_params = []
+        cursor = data.get('cursor')
+        if cursor:
+            try:
+                position = decode_search_cursor(cursor, with_rank=rank_expr is not None)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+            if rank_expr:
+                keyset_clause = "(matched.rank, matched.created_at, matched.id) < (%s::float8, %s::timestamp, %s)"
+                keyset_params = [position['rank'], position['created_at'], position['id']]
+            else:
+                keyset_clause = "(matched.created_at, matched.id) < (%s::timestamp, %s)"
+                keyset_params = [position['created_at'], position['id']]
+            offset = 0
+        
+        # 先取出本页的行，再只对这些行聚合主题标题
         query = f"""
+            WITH page AS (
+                SELECT * FROM (
+                    SELECT 
+                        ri.id,
+                        ri.unique_id,
+                        ri.reference_image_url,
+                        ri.reference_type,
+                        ri.gen_content_prompt,
+                        ri.created_at,
+                        {"ri.search_text," if highlight else ""}
+                        {rank_expr or "NULL::float8"} AS rank
+                    FROM viba.reference_images ri
+                    WHERE {where_clause}
+                ) matched
+                WHERE {keyset_clause}
+                ORDER BY {order_clause}
+                LIMIT %s OFFSET %s
+            )
             SELECT 
-                ri.unique_id,
-                ri.reference_image_url,
-                ri.reference_type,
-                ri.gen_content_prompt,
-                ri.created_at,
-                array_agg(DISTINCT t.title) FILTER (WHERE t.title IS NOT NULL) as theme_titles
-            FROM viba.reference_images ri
-            LEFT JOIN viba.ref_images_to_themes rit ON ri.unique_id = rit.ref_image_id
-            LEFT JOIN viba.themes t ON rit.theme_id = t.unique_id
-            WHERE {where_clause}
-            GROUP BY ri.unique_id, ri.reference_image_url, ri.reference_type, 
-                     ri.gen_content_prompt, ri.created_at
-            ORDER BY ri.created_at DESC
-            LIMIT %s OFFSET %s
+                page.*,
+                themes.theme_titles
+            FROM page
+            LEFT JOIN LATERAL (
+                SELECT array_agg(DISTINCT t.title) FILTER (WHERE t.title IS NOT NULL) AS theme_titles
+                FROM viba.ref_images_to_themes rit
+                JOIN viba.themes t ON rit.theme_id = t.unique_id
+                WHERE rit.ref_image_id = page.unique_id
+            ) themes ON TRUE
+            ORDER BY {order_clause.replace('matched.', 'page.')}
         """
         
-        limit = data.get('limit', 20)
-        offset = data.get('offset', 0)
-        params.extend([limit, offset])
+        # 多取一行用于判断是否还有下一页
+        query_params = rank_params + params + keyset_params + [limit + 1, offset]
+        
+        results = db.execute_query(query, query_params)
         
-        results = db.execute_query(query, params)
+        has_more = len(results) > limit
+        results = results[:limit]
+        next_cursor = None
+        if has_more and results:
+            last = results[-1]
+            position = {column: last[column] for column in order_columns}
+            position['created_at'] = position['created_at'].isoformat()
+            next_cursor = encode_search_cursor(position)
+        
+        for row in results:
+            row.pop('id', None)
+            if rank_expr is None:
+                row.pop('rank', None)
+            if highlight:
+                row['highlight'] = build_search_highlight(row.pop('search_text', None), search_text)
         
         return jsonify({
             'success': True,
             'data': {
                 'items': results,
                 'limit': limit,
-                'offset': offset
+                'offset': offset,
+                'has_more': has_more,
+                'next_cursor': next_cursor
             }
         })
     except Exception as e:
         logger.error(f"Search error: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/reference-images/facets', methods=['GET', 'POST'])
+def get_reference_image_facets():
+    """
+    标签分面计数
+    
+    请求体与 search 接口相同的过滤条件（reference_type / theme_ids / tag_filters / search_text），
+    不带过滤条件时直接读取进程内缓存。返回按字段的原始计数，以及按标签类型、按层级汇总的计数
+    （存储时已包含父级标签，父级计数即其所有子孙的并集）。
+    
+    额外参数：
+        include_zero: 是否返回计数为 0 的标签，默认 false
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        
+        try:
+            conditions, params = build_reference_filter_conditions(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        if conditions:
+            total, counts = count_tag_facets(conditions, params)
+            cached = False
+        else:
+            total, counts = facet_count_cache.get()
+            cached = True
+        
+        by_tag_type = rollup_facet_counts(
+            counts,
+            get_tag_structures(),
+            include_zero=bool(data.get('include_zero') or request.args.get('include_zero') == 'true')
+        )
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'total': total,
+                'fields': counts,
+                'by_tag_type': by_tag_type,
+                'cached': cached
+            }
+        })
+    except Exception as e:
+        logger.error(f"Facet count error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/reference-images/similar', methods=['POST'])
+def find_similar_reference_images():
+    """
+    语义相似参考图检索
+    
+    请求体：
+        query_text / unique_id: 二选一，文本查询或以已有参考图的向量作为查询
+        embedding_field: 检索的向量字段，默认 gen_content_embedding
+        k: 返回数量（1-100）
+        probes: ivfflat.probes，覆盖默认配置
+        reference_type / tag_filters: 可选过滤条件，与向量排序在同一条SQL中执行
+    """
+    try:
+        data = request.json or {}
+        
+        embedding_field = data.get('embedding_field', 'gen_content_embedding')
+        if embedding_field not in EMBEDDING_COLUMN_DIMENSIONS:
+            return jsonify({
+                'success': False,
+                'error': f'Invalid embedding_field. Valid fields are: {", ".join(EMBEDDING_COLUMN_DIMENSIONS)}'
+            }), 400
+        
+        query_text = data.get('query_text')
+        source_id = data.get('unique_id')
+        if bool(query_text) == bool(source_id):
+            return jsonify({
+                'success': False,
+                'error': 'Exactly one of query_text or unique_id is required'
+            }), 400
+        
+        try:
+            k = min(max(int(data.get('k', 20)), 1), 100)
+            probes = max(int(data.get('probes', app.config['IVFFLAT_PROBES'])), 1)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'k and probes must be integers'}), 400
+        
+        filter_conditions = []
+        filter_params = []
+        
+        if 'reference_type' in data:
+            filter_conditions.append("ri.reference_type = %s")
+            filter_params.append(data['reference_type'])
+        
+        tag_conditions, tag_params = build_tag_filter_conditions(data.get('tag_filters'))
+        filter_conditions.extend(tag_conditions)
+        filter_params.extend(tag_params)
+        
+        if source_id:
+            try:
+                source_id = str(uuid.UUID(str(source_id)))
+            except ValueError:
+                return jsonify({'success': False, 'error': f'Invalid unique_id: {source_id}'}), 400
+            
+            # 直接复用已存储的向量，无需重新计算嵌入
+            if vector_indexes is not None:
+                query_vector = vector_indexes.get(embedding_field).get_vector(source_id)
+                if query_vector is None:
+                    return jsonify({
+                        'success': False,
+                        'error': f'Reference image has no indexed {embedding_field}'
+                    }), 404
+            else:
+                rows = db.execute_query(
+                    f"SELECT {embedding_field} AS embedding FROM viba.reference_images WHERE unique_id = %s",
+                    (source_id,)
+                )
+                if not rows:
+                    return jsonify({'success': False, 'error': 'Reference image not found'}), 404
+                if rows[0]['embedding'] is None:
+                    return jsonify({
+                        'success': False,
+                        'error': f'Reference image has no {embedding_field}'
+                    }), 400
+                query_vector = rows[0]['embedding']
+        else:
+            if not embedding_service.available:
+                # mock 零向量没有检索意义
+                return jsonify({'success': False, 'error': 'Embedding model not available'}), 503
+            query_vector = embedding_service.generate_embedding(
+                query_text, EMBEDDING_COLUMN_DIMENSIONS[embedding_field]
+            )
+            if query_vector is None:
+                return jsonify({'success': False, 'error': 'Failed to embed query_text'}), 400
+        
+        if vector_indexes is not None:
+            results = search_similar_in_process(
+                embedding_field, query_vector, filter_conditions, filter_params, k, exclude_id=source_id
+            )
+        else:
+            results = search_similar_pgvector(
+                embedding_field, query_vector, filter_conditions, filter_params, k, probes, exclude_id=source_id
+            )
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'items': results,
+                'embedding_field': embedding_field,
+                'k': k,
+                'probes': probes
+            }
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Similarity search error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ==================== 健康检查 ====================
 
 @app.route('/api/health', methods=['GET'])
@@ -1186,54 +2830,587 @@ def build_flat_structure(tags):
         'flat': tag_by_id
     }
 
-def generate_embeddings_for_reference(data):
-    """生成参考图的向量嵌入"""
-    embeddings = {}
+# 各向量列的存储维度（与 reference_images.sql 中的 vector(n) 定义保持一致）
+EMBEDDING_COLUMN_DIMENSIONS = {
+    'gen_content_embedding': 384,
+    'gen_pose_embedding': 384,
+    'gen_product_embedding': 384,
+    'gen_occasion_embedding': 384,
+    'gen_composition_embedding': 384,
+    'pose_embedding': 384,
+    'scene_embedding': 384
+}
+
+# 未过滤全集的标签计数缓存
+facet_count_cache = FacetCountCache(lambda: count_tag_facets([], []))
+
+def load_vector_index_rows(field, since=None):
+    """
+    读取某个向量字段的 (unique_id, 向量, updated_at)，供进程内索引全量构建和增量同步
     
-    # 检查是否启用嵌入功能
-    if not app.config.get('ENABLE_EMBEDDINGS', True):
-        logger.info("Embeddings disabled by configuration")
-        return embeddings
+    Args:
+        field: 向量字段名（EMBEDDING_COLUMN_DIMENSIONS 中的键）
+        since: 只返回 updated_at 不早于该时间的行，None 时返回全部
+    """
+    if field not in EMBEDDING_COLUMN_DIMENSIONS:
+        raise ValueError(f"Unknown embedding field: {field}")
+    conditions = [f"{field} IS NOT NULL"]
+    params = []
+    if since is not None:
+        conditions.append("updated_at >= %s")
+        params.append(since)
+    # 以文本读出再直接解析为 float32：pgvector 的 vector 列和无 pgvector 时的 real[] 列都适用
+    query = f"""
+        SELECT unique_id, {field}::text AS embedding, updated_at
+        FROM viba.reference_images
+        WHERE {" AND ".join(conditions)}
+    """
+    for row in db.stream_query(query, params):
+        yield str(row['unique_id']), parse_vector(row['embedding']), row['updated_at']
+
+# 进程内向量索引（仅 VECTOR_SEARCH_BACKEND=numpy 时启用）
+vector_indexes = (
+    VectorIndexRegistry(
+        app.config['VECTOR_INDEX_DIR'],
+        EMBEDDING_COLUMN_DIMENSIONS,
+        row_loader=load_vector_index_rows,
+        refresh_interval=app.config['VECTOR_INDEX_REFRESH_SECONDS'],
+        autosave_interval=app.config['VECTOR_INDEX_AUTOSAVE_SECONDS'] if app.config['VECTOR_INDEX_AUTOSAVE'] else None
+    )
+    if app.config['VECTOR_SEARCH_BACKEND'] == 'numpy' else None
+)
+
+@app.cli.command('build-vector-index')
+@click.option('--field', 'fields', multiple=True, type=click.Choice(sorted(EMBEDDING_COLUMN_DIMENSIONS)),
+              help='只重建指定字段，可重复；默认全部')
+def build_vector_index_command(fields):
+    """从数据库全量重建进程内向量索引快照（flask --app app build-vector-index）"""
+    registry = VectorIndexRegistry(
+        app.config['VECTOR_INDEX_DIR'], EMBEDDING_COLUMN_DIMENSIONS, mmap=False,
+        row_loader=load_vector_index_rows
+    )
+    for field in fields or sorted(EMBEDDING_COLUMN_DIMENSIONS):
+        count = registry.rebuild(field)
+        registry.save(field)
+        click.echo(f'{field}: {count} rows')
+
+def update_reference_caches(inserted):
+    """
+    参考图写入后增量更新进程内的标签计数缓存和向量索引
+    
+    Args:
+        inserted: [(unique_id, enriched_tags, embeddings), ...]
+    """
+    for unique_id, enriched_tags, embeddings in inserted:
+        facet_count_cache.record_insert(enriched_tags)
+        # 快照保存（开启 autosave 时）由索引在后台线程限频执行
+        if vector_indexes is not None and embeddings:
+            vector_indexes.add(unique_id, embeddings)
+
+def collect_embedding_texts(data):
+    """
+    按向量字段收集需要嵌入的文本
+    
+    Returns:
+        {embedding_name: text}
+    """
+    texts = {}
     
     if data['reference_type'] == 1:  # 生成图
         if data.get('gen_content_prompt'):
-            embeddings['gen_content_embedding'] = embedding_service.generate_embedding(
-                data['gen_content_prompt'], 768
-            )
+            texts['gen_content_embedding'] = data['gen_content_prompt']
         
         # 兼容旧的新字段对：
         # gen_outfit_description -> gen_product_description
         # gen_scene_description  -> gen_occasion_description
-        fields_384 = [
-            ('gen_pose_description', 'gen_pose_embedding'),
-            ('gen_product_description', 'gen_product_embedding'),
-            ('gen_occasion_description', 'gen_occasion_embedding'),
-            ('gen_composition_description', 'gen_composition_embedding')
+        description_fields = [
+            ('gen_pose_description', 'gen_pose_embedding', None),
+            ('gen_product_description', 'gen_product_embedding', 'gen_outfit_description'),
+            ('gen_occasion_description', 'gen_occasion_embedding', 'gen_scene_description'),
+            ('gen_composition_description', 'gen_composition_embedding', None)
         ]
         
-        for field_name, embedding_name in fields_384:
-            if data.get(field_name):
-                embeddings[embedding_name] = embedding_service.generate_embedding(data[field_name], 384)
-            else:
-                # 兼容旧字段名
-                if field_name == 'gen_product_description' and data.get('gen_outfit_description'):
-                    embeddings['gen_product_embedding'] = embedding_service.generate_embedding(data['gen_outfit_description'], 384)
-                if field_name == 'gen_occasion_description' and data.get('gen_scene_description'):
-                    embeddings['gen_occasion_embedding'] = embedding_service.generate_embedding(data['gen_scene_description'], 384)
+        for field_name, embedding_name, legacy_field_name in description_fields:
+            text = data.get(field_name) or (data.get(legacy_field_name) if legacy_field_name else None)
+            if text:
+                texts[embedding_name] = text
     
     elif data['reference_type'] == 2:  # 匹配图
         if data.get('pose_description'):
-            embeddings['pose_embedding'] = embedding_service.generate_embedding(
-                data['pose_description'], 384
-            )
+            texts['pose_embedding'] = data['pose_description']
         
         if data.get('scene_description'):
-            embeddings['scene_embedding'] = embedding_service.generate_embedding(
-                data['scene_description'], 384
-            )
+            texts['scene_embedding'] = data['scene_description']
+    
+    return texts
+
+def generate_embeddings_for_reference(data, cancel_event=None):
+    """
+    生成参考图的向量嵌入
+    
+    Args:
+        data: 请求数据
+        cancel_event: 置位后在下一个字段前停止（抛出 StageCancelled）
+    """
+    embeddings = {}
+    
+    # 检查是否启用嵌入功能
+    if not app.config.get('ENABLE_EMBEDDINGS', True):
+        logger.info("Embeddings disabled by configuration")
+        return embeddings
+    
+    for embedding_name, text in collect_embedding_texts(data).items():
+        check_cancelled(cancel_event, 'embedding')
+        embeddings[embedding_name] = embedding_service.generate_embedding(
+            text, EMBEDDING_COLUMN_DIMENSIONS[embedding_name]
+        )
     
     return embeddings
 
+def generate_embeddings_for_batch(records):
+    """
+    批量生成多条参考图的向量嵌入，相同维度的文本合并为一次模型调用
+    
+    Returns:
+        与 records 一一对应的 embeddings 字典列表
+    """
+    results = [{} for _ in records]
+    
+    jobs_by_dimension = {}
+    for index, data in enumerate(records):
+        for embedding_name, text in collect_embedding_texts(data).items():
+            dimension = EMBEDDING_COLUMN_DIMENSIONS[embedding_name]
+            jobs_by_dimension.setdefault(dimension, []).append((index, embedding_name, text))
+    
+    for dimension, jobs in jobs_by_dimension.items():
+        vectors = embedding_service.generate_batch_embeddings([text for _, _, text in jobs], dimension)
+        for (index, embedding_name, _), vector in zip(jobs, vectors):
+            results[index][embedding_name] = vector
+    
+    return results
+
+def search_similar_pgvector(embedding_field, query_vector, filter_conditions, filter_params,
+                            k, probes, exclude_id=None):
+    """使用 pgvector 的 ivfflat 索引做 top-k 检索，过滤条件在同一条SQL中执行"""
+    if not pgvector_available():
+        # 进程内尚未建立过连接时先完成检测
+        db.get_connection().close()
+        if not pgvector_available():
+            raise RuntimeError('pgvector is not installed; set VECTOR_SEARCH_BACKEND=numpy')
+    conditions = [f"ri.{embedding_field} IS NOT NULL"] + list(filter_conditions)
+    params = list(filter_params)
+    if exclude_id:
+        conditions.append("ri.unique_id <> %s")
+        params.append(exclude_id)
+    
+    # 包装为 Vector，由 vector 适配器直接编码为 pgvector 文本
+    query_vector = to_vector_param(query_vector)
+    query = f"""
+        SELECT 
+            ri.unique_id,
+            ri.reference_image_url,
+            ri.reference_type,
+            ri.gen_content_prompt,
+            ri.created_at,
+            ri.{embedding_field} <=> %s::vector AS distance
+        FROM viba.reference_images ri
+        WHERE {" AND ".join(conditions)}
+        ORDER BY ri.{embedding_field} <=> %s::vector
+        LIMIT %s
+    """
+    
+    results = db.execute_query(
+        query,
+        [query_vector] + params + [query_vector, k],
+        settings={'ivfflat.probes': probes}
+    )
+    for row in results:
+        row['similarity'] = 1 - row['distance']
+    return results
+
+def search_similar_in_process(embedding_field, query_vector, filter_conditions, filter_params,
+                              k, exclude_id=None):
+    """使用进程内 numpy 索引检索候选，再按 unique_id 回表补全字段并应用过滤条件"""
+    # 有过滤条件时多取一些候选，避免过滤后不足 k 条
+    candidate_count = k * 4 if filter_conditions else k
+    candidates = vector_indexes.get(embedding_field).search(query_vector, candidate_count, exclude=exclude_id)
+    if not candidates:
+        return []
+    
+    conditions = ["ri.unique_id = ANY(%s::uuid[])"] + list(filter_conditions)
+    query = f"""
+        SELECT 
+            ri.unique_id,
+            ri.reference_image_url,
+            ri.reference_type,
+            ri.gen_content_prompt,
+            ri.created_at
+        FROM viba.reference_images ri
+        WHERE {" AND ".join(conditions)}
+    """
+    rows = db.execute_query(query, [[unique_id for unique_id, _ in candidates]] + list(filter_params))
+    rows_by_id = {str(row['unique_id']): row for row in rows}
+    
+    results = []
+    for unique_id, similarity in candidates:
+        row = rows_by_id.get(unique_id)
+        if row is None:
+            continue
+        row['distance'] = 1 - similarity
+        row['similarity'] = similarity
+        results.append(row)
+        if len(results) >= k:
+            break
+    return results
+
+def encode_search_cursor(position):
+    """将分页位置编码为不透明的游标字符串"""
+    raw = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_search_cursor(cursor, with_rank=False):
+    """解析游标字符串，格式错误（或排序方式与游标不匹配）时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        datetime.fromisoformat(position['created_at'])
+        position['id'] = int(position['id'])
+        if with_rank:
+            position['rank'] = float(position['rank'])
+        return position
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def escape_like(text):
+    """转义 LIKE/ILIKE 模式中的通配符"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def build_search_highlight(text, search_text, context_chars=40):
+    """
+    生成搜索结果摘要，用 <mark> 标记命中的关键词
+    
+    在 Python 中按子串匹配，中文描述无需分词也能高亮；只对当前页的行执行。
+    
+    Args:
+        text: 参考图的 search_text
+        search_text: 用户输入的搜索词（按空白拆分为多个关键词）
+        context_chars: 命中位置前后保留的字符数
+    
+    Returns:
+        HTML 摘要（原文已转义），没有命中时返回 None
+    """
+    if not text:
+        return None
+    
+    terms = [term for term in search_text.split() if term]
+    if not terms:
+        return None
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    
+    match = pattern.search(text)
+    if not match:
+        return None
+    
+    start = max(match.start() - context_chars, 0)
+    end = min(match.end() + context_chars, len(text))
+    snippet = text[start:end]
+    
+    parts = []
+    last = 0
+    for m in pattern.finditer(snippet):
+        parts.append(html.escape(snippet[last:m.start()]))
+        parts.append(f"<mark>{html.escape(m.group(0))}</mark>")
+        last = m.end()
+    parts.append(html.escape(snippet[last:]))
+    
+    return ('…' if start > 0 else '') + ''.join(parts).strip() + ('…' if end < len(text) else '')
+
+def count_tag_facets(conditions, params):
+    """
+    统计过滤结果中每个标签字段下各标签的出现次数
+    
+    一次扫描过滤结果，把所有标签数组展开（unnest）后分组计数。
+    
+    Returns:
+        (total, {field: {tag_id: count}})
+    """
+    where_clause = " AND ".join(conditions) if conditions else "1=1"
+    tag_arrays = ",\n                ".join(
+        f"('{field}', filtered.{field})" for field in REFERENCE_TAG_FIELDS
+    )
+    
+    query = f"""
+        WITH filtered AS (
+            SELECT {", ".join("ri." + field for field in REFERENCE_TAG_FIELDS)}
+            FROM viba.reference_images ri
+            WHERE {where_clause}
+        )
+        SELECT tag_arrays.field, tag.tag_id, count(*) AS count
+        FROM filtered
+        CROSS JOIN LATERAL (VALUES
+                {tag_arrays}
+        ) AS tag_arrays(field, tag_ids)
+        CROSS JOIN LATERAL unnest(tag_arrays.tag_ids) AS tag(tag_id)
+        GROUP BY tag_arrays.field, tag.tag_id
+        UNION ALL
+        SELECT NULL, NULL, count(*) FROM filtered
+    """
+    
+    rows = db.execute_query(query, params)
+    
+    total = 0
+    counts = {field: {} for field in REFERENCE_TAG_FIELDS}
+    for row in rows:
+        if row['field'] is None:
+            total = row['count']
+        else:
+            counts[row['field']][row['tag_id']] = row['count']
+    
+    return total, counts
+
+def rollup_facet_counts(counts, tag_structures, include_zero=False):
+    """
+    把按字段的标签计数挂到标签结构上
+    
+    多级标签按层级输出（每一级即该层级的汇总），单级标签输出列表，均按计数降序。
+    
+    Args:
+        counts: {field: {tag_id: count}}
+        tag_structures: get_tag_structures 返回的标签结构
+        include_zero: 是否保留计数为 0 的标签
+    
+    Returns:
+        {tag_type: {'levels': {level: [...]}} 或 {'list': [...]}}
+    """
+    tag_counts = {}
+    for field_counts in counts.values():
+        for tag_id, count in field_counts.items():
+            tag_counts[tag_id] = max(tag_counts.get(tag_id, 0), count)
+    
+    def with_counts(tags, extra_keys=()):
+        items = []
+        for tag in tags:
+            count = tag_counts.get(tag['id'], 0)
+            if count or include_zero:
+                item = {
+                    'id': tag['id'],
+                    'name': tag['name'],
+                    'name_cn': tag['name_cn'],
+                    'count': count
+                }
+                for key in extra_keys:
+                    item[key] = tag.get(key)
+                items.append(item)
+        items.sort(key=lambda item: item['count'], reverse=True)
+        return items
+    
+    result = {}
+    for tag_type, structure in tag_structures.get('multi_level', {}).items():
+        levels = {}
+        for level, tags in structure['levels'].items():
+            items = with_counts(tags, extra_keys=('parent_id',))
+            if items:
+                levels[level] = items
+        result[tag_type] = {'levels': levels}
+    
+    for tag_type, structure in tag_structures.get('single_level', {}).items():
+        result[tag_type] = {'list': with_counts(structure['list'])}
+    
+    return result
+
+def build_reference_filter_conditions(data):
+    """
+    根据请求构建参考图的过滤条件（search 和 facets 接口共用）
+    
+    支持 reference_type、theme_ids、tag_filters、search_text/search_mode，
+    参数不合法时抛出 ValueError。
+    
+    Returns:
+        (conditions, params)
+    """
+    conditions = []
+    params = []
+    
+    if 'reference_type' in data:
+        conditions.append("ri.reference_type = %s")
+        params.append(data['reference_type'])
+    
+    if 'theme_ids' in data and data['theme_ids']:
+        conditions.append("""
+            EXISTS (
+                SELECT 1 FROM viba.ref_images_to_themes 
+                WHERE ref_image_id = ri.unique_id 
+                AND theme_id = ANY(%s)
+            )
+        """)
+        params.append(data['theme_ids'])
+    
+    # 标签过滤（GIN索引上的 && / @> 谓词）
+    tag_conditions, tag_params = build_tag_filter_conditions(data.get('tag_filters'))
+    conditions.extend(tag_conditions)
+    params.extend(tag_params)
+    
+    search_text = (data.get('search_text') or '').strip()
+    search_mode = data.get('search_mode', 'fulltext')
+    if search_mode not in ('fulltext', 'substring'):
+        raise ValueError(f'Invalid search_mode: {search_mode}')
+    
+    if search_text:
+        like_pattern = f"%{escape_like(search_text)}%"
+        if search_mode == 'fulltext':
+            conditions.append(
+                "(ri.search_tsv @@ websearch_to_tsquery('simple', %s) OR ri.search_text ILIKE %s)"
+            )
+            params.extend([search_text, like_pattern])
+        else:
+            conditions.append("ri.search_text ILIKE %s")
+            params.append(like_pattern)
+    
+    return conditions, params
+
+def build_tag_filter_conditions(tag_filters):
+    """
+    将标签过滤条件转换为可以命中GIN索引的数组谓词
+    
+    由于存储时已经补全了所有父级标签，选择父级标签即可匹配其全部子孙标签，无需关联标签表。
+    
+    Args:
+        tag_filters: 按字段分组的标签ID，每个字段可以是：
+                     - 列表：命中任意一个即可，如 {'style_tag_ids': [3, 4]}
+                     - 字典：{'any': [...], 'all': [...]}，any 转为 &&，all 转为 @>
+    
+    Returns:
+        (conditions, params)
+    """
+    conditions = []
+    params = []
+    
+    if not tag_filters:
+        return conditions, params
+    if not isinstance(tag_filters, dict):
+        raise ValueError('tag_filters must be an object keyed by tag field')
+    
+    for field, spec in tag_filters.items():
+        if field not in REFERENCE_TAG_FIELDS:
+            raise ValueError(f'Invalid tag filter field: {field}')
+        if not spec:
+            continue
+        
+        if isinstance(spec, dict):
+            unknown_keys = set(spec) - {'any', 'all'}
+            if unknown_keys:
+                raise ValueError(f'Invalid tag filter keys for {field}: {sorted(unknown_keys)}')
+            any_of = spec.get('any') or []
+            all_of = spec.get('all') or []
+        else:
+            any_of = spec
+            all_of = []
+        
+        for tag_ids, operator in ((any_of, '&&'), (all_of, '@>')):
+            if not tag_ids:
+                continue
+            if not isinstance(tag_ids, list):
+                tag_ids = [tag_ids]
+            conditions.append(f"ri.{field} {operator} %s::bigint[]")
+            params.append(sorted({int(tag_id) for tag_id in tag_ids}))
+    
+    return conditions, params
+
+def parse_theme_ids(data):
+    """将 theme_ids 规范为 UUID 字符串列表，格式错误时抛出 ValueError"""
+    theme_ids = data.get('theme_ids') or []
+    if not isinstance(theme_ids, list):
+        raise ValueError('theme_ids must be a list')
+    parsed = []
+    for theme_id in theme_ids:
+        try:
+            parsed.append(str(uuid.UUID(str(theme_id))))
+        except ValueError:
+            raise ValueError(f'Invalid theme ID: {theme_id}')
+    return parsed
+
+def load_existing_theme_ids(records):
+    """
+    一次查询一批记录引用的主题中实际存在的部分
+    
+    Args:
+        records: [(line_number, data), ...]
+    
+    Returns:
+        存在的主题 unique_id（字符串）集合；格式不合法的ID忽略，由逐行校验报错
+    """
+    requested = set()
+    for _, data in records:
+        theme_ids = data.get('theme_ids') if isinstance(data, dict) else None
+        for theme_id in theme_ids if isinstance(theme_ids, list) else []:
+            try:
+                requested.add(str(uuid.UUID(str(theme_id))))
+            except ValueError:
+                continue
+    if not requested:
+        return set()
+    rows = db.execute_query(
+        "SELECT unique_id FROM viba.themes WHERE unique_id = ANY(%s::uuid[])",
+        (sorted(requested),)
+    )
+    return {str(row['unique_id']) for row in rows}
+
+def insert_theme_links(cursor, links):
+    """在调用方的事务内写入参考图-主题关联（links 为 [(ref_image_id, theme_id), ...]）"""
+    if links:
+        execute_values(
+            cursor,
+            "INSERT INTO viba.ref_images_to_themes (ref_image_id, theme_id) VALUES %s ON CONFLICT DO NOTHING",
+            links,
+            template='(%s::uuid, %s::uuid)',
+            page_size=1000
+        )
+
+def load_tag_parent_index():
+    """
+    加载启用标签的父级索引，用于批量校验和补全父级标签
+    
+    Returns:
+        {tag_id: parent_tag_id}
+    """
+    rows = db.execute_query("""
+        SELECT id, parent_tag_id FROM viba.tag_definitions WHERE is_active = TRUE
+    """)
+    return {row['id']: row['parent_tag_id'] for row in rows}
+
+def find_unknown_tag_ids(data, tag_data, parent_index):
+    """
+    找出一行参考图中格式错误或不在标签索引里的标签ID
+    
+    覆盖写入的全部标签字段（collect_all_tag_ids 加上 prepare_tag_data_for_storage 的结果，
+    包括旧字段 scene_tag_ids）；expand_with_ancestors 会静默丢弃未知ID，所以必须在这里拒绝。
+    
+    Args:
+        data: 单行请求数据
+        tag_data: prepare_tag_data_for_storage(data) 的结果
+        parent_index: load_tag_parent_index 返回的 {tag_id: parent_tag_id}
+    
+    Returns:
+        不合法的标签ID列表
+    """
+    candidates = set(collect_all_tag_ids(data))
+    for tag_ids in tag_data.values():
+        candidates.update(tag_ids or [])
+    return [
+        tag_id for tag_id in candidates
+        if isinstance(tag_id, bool) or not isinstance(tag_id, int) or tag_id not in parent_index
+    ]
+
+def expand_with_ancestors(tag_ids, parent_index):
+    """在内存中为标签ID补全所有（启用的）父级，与 enrich_with_parent_tags 结果一致"""
+    expanded = set()
+    for tag_id in tag_ids or []:
+        current = tag_id
+        while current is not None and current in parent_index and current not in expanded:
+            expanded.add(current)
+            current = parent_index[current]
+    return expanded
+
 def validate_tag_ids(tag_ids):
     """验证标签ID是否存在"""
     if not tag_ids:
@@ -0,0 +1,544 @@
+# asgi_app.py - 异步（ASGI）服务入口：热点接口使用 asyncpg + aioboto3，其余路由挂载原 Flask 应用
+"""
+启动:
+    gunicorn -k uvicorn.workers.UvicornWorker --workers 3 --bind 0.0.0.0:5001 asgi_app:app
+    uvicorn asgi_app:app --port 5001              # 本地开发
+
+以下接口原生异步实现，一个 worker 可同时处理多个慢请求（S3 上传、模型推理不再独占 worker）:
+    GET  /api/tags/all
+    POST /api/upload-image
+    POST /api/reference-images   标签校验与父级补全、向量嵌入并发执行
+其余路由经 a2wsgi 在线程池中调用 app.py 的 Flask 应用，行为与同步模式一致。
+
+依赖见 requirements-async.txt。
+"""
+import asyncio
+import contextvars
+import hashlib
+import io
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Dict, List, Optional, Set, Tuple
+
+import aioboto3
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from aiobotocore.config import AioConfig
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_etags
+
+from app import (
+    app as flask_app,
+    db,
+    s3_uploader,
+    compressor,
+    TAG_TYPES_STRUCTURE_QUERY,
+    TAG_TYPE_VERSION_QUERY,
+    REFERENCE_INSERT_COLUMNS,
+    UPLOADED_IMAGE_LOOKUP_QUERY,
+    UPLOADED_IMAGE_INSERT_QUERY,
+    uploaded_image_payload,
+    uploaded_image_params,
+    tag_structure_cache,
+    tags_response_body,
+    start_cache_listener,
+    parse_tag_type_versions,
+    collect_all_tag_ids,
+    prepare_tag_data_for_storage,
+    find_malformed_tag_ids,
+    validate_reference_payload,
+    parse_product_item_ids,
+    parse_theme_ids,
+    build_reference_row,
+    build_reference_insert_query,
+    generate_embeddings_for_batch,
+    update_reference_caches
+)
+from image_validator import ImageValidator
+from s3_uploader import instrument_s3_client
+from metrics import metrics, start_request, finish_request, timed_stage, format_server_timing
+from vector_codec import format_vector, parse_vector
+
+logger = logging.getLogger(__name__)
+
+config = flask_app.config
+
+_PLACEHOLDER = re.compile(r'%s')
+
+# 模型推理、图片解码等 CPU 密集任务的线程池（不占用事件循环）
+cpu_executor = ThreadPoolExecutor(max_workers=config['ASYNC_CPU_WORKERS'], thread_name_prefix='asgi-cpu')
+
+
+def to_asyncpg_query(query: str) -> str:
+    """把 psycopg2 风格的 %s 占位符转换为 asyncpg 的 $1, $2 ..."""
+    counter = iter(range(1, 10000))
+    return _PLACEHOLDER.sub(lambda _: f"${next(counter)}", query)
+
+
+def run_blocking(fn, *args):
+    """
+    在 CPU 线程池中执行同步函数，并带上当前请求的 contextvars（阶段耗时仍计入 Server-Timing）
+
+    Returns:
+        asyncio Future
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return loop.run_in_executor(cpu_executor, context.run, fn, *args)
+
+
+class AsyncDatabase:
+    """
+    asyncpg 连接池，接口与 app.Database 对应（SQL 使用 %s 占位符）
+
+    每条语句同样经过 db.observe_query，指标、慢查询日志与同步模式共用。
+    """
+
+    def __init__(self):
+        self.pool: Optional[asyncpg.Pool] = None
+
+    async def open(self):
+        password = self._iam_password if db.auth_mode == 'iam' else config['DB_PASSWORD']
+        self.pool = await asyncpg.create_pool(
+            host=config['DB_HOST'],
+            port=int(config['DB_PORT'] or 5432),
+            database=config['DB_NAME'],
+            user=config['DB_USER'],
+            password=password,
+            ssl=config['DB_SSLMODE'],
+            min_size=config['ASYNC_DB_POOL_MIN'],
+            max_size=config['ASYNC_DB_POOL_MAX'],
+            init=self._init_connection
+        )
+        logger.info(
+            f"Async database pool ready ({config['ASYNC_DB_POOL_MIN']}-{config['ASYNC_DB_POOL_MAX']} connections)"
+        )
+
+    @staticmethod
+    async def _iam_password():
+        """每个新连接的 IAM 令牌（boto3 同步生成，放到线程中执行，不阻塞事件循环）"""
+        return await asyncio.to_thread(db.get_iam_token)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    @staticmethod
+    async def _init_connection(conn):
+        """注册 json/jsonb 和 pgvector 的编解码（与 psycopg2 侧的类型转换保持一致）"""
+        for type_name in ('json', 'jsonb'):
+            await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+        vector_schema = await conn.fetchval(
+            "SELECT typnamespace::regnamespace::text FROM pg_type WHERE oid = to_regtype('vector')"
+        )
+        if vector_schema:
+            await conn.set_type_codec(
+                'vector', encoder=format_vector, decoder=parse_vector, schema=vector_schema, format='text'
+            )
+
+    async def execute_query(self, query, params=None, fetch=True):
+        async with self.pool.acquire() as conn:
+            with db.observe_query(query) as event:
+                if fetch:
+                    rows = await conn.fetch(to_asyncpg_query(query), *(params or ()))
+                    event['rows'] = len(rows)
+                    return [dict(row) for row in rows]
+                status = await conn.execute(to_asyncpg_query(query), *(params or ()))
+                # 状态形如 'INSERT 0 1' / 'UPDATE 3'
+                rowcount = int(status.rsplit(' ', 1)[-1]) if status[-1:].isdigit() else None
+                event['rows'] = rowcount
+                return rowcount
+
+    async def execute_insert(self, query, params=None, after=None):
+        """
+        执行带 RETURNING 的写入并返回第一行
+
+        Args:
+            query: SQL
+            params: 参数
+            after: 可选 async after(conn, result)，在同一事务内、提交前执行，失败时整体回滚
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                with db.observe_query(query) as event:
+                    row = await conn.fetchrow(to_asyncpg_query(query), *(params or ()))
+                    event['rows'] = 1 if row is not None else 0
+                result = dict(row) if row is not None else None
+                if after is not None:
+                    await after(conn, result)
+                return result
+
+
+class AsyncS3Uploader:
+    """aioboto3 客户端，路径规则和 URL 格式沿用 s3_uploader（同一个 S3Uploader 实例）"""
+
+    def __init__(self):
+        self.client = None
+
+    async def open(self, stack: AsyncExitStack):
+        # 重试、keepalive、超时与同步客户端一致，连接池按异步并发单独配置
+        client_options = dict(s3_uploader.client_options, max_pool_connections=config['ASYNC_S3_MAX_CONNECTIONS'])
+        client_config = AioConfig(
+            s3={'addressing_style': 'path'} if s3_uploader.endpoint_url else None,
+            **client_options
+        )
+        session = aioboto3.Session(
+            aws_access_key_id=config['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=config['AWS_SECRET_ACCESS_KEY'],
+            region_name=config['S3_REGION']
+        )
+        self.client = await stack.enter_async_context(
+            session.client('s3', endpoint_url=s3_uploader.endpoint_url, config=client_config)
+        )
+        instrument_s3_client(self.client)
+
+    async def upload_file(self, file_data: bytes, file_type: str, content_type: str = 'image/jpeg') -> str:
+        """上传文件并返回URL（与 S3Uploader.upload_file 相同）"""
+        s3_path = s3_uploader.generate_s3_path(file_type)
+        metadata = {
+            'upload_time': datetime.now().isoformat(),
+            'file_type': file_type
+        }
+        transfer_config = s3_uploader.transfer_config
+        with timed_stage('s3'):
+            if len(file_data) < transfer_config.multipart_threshold:
+                await self.client.put_object(
+                    Bucket=s3_uploader.bucket_name,
+                    Key=s3_path,
+                    Body=file_data,
+                    ContentType=content_type,
+                    Metadata=metadata
+                )
+            else:
+                # 大文件分片并发上传（分块大小和并发数与同步模式相同）
+                await self.client.upload_fileobj(
+                    io.BytesIO(file_data),
+                    s3_uploader.bucket_name,
+                    s3_path,
+                    ExtraArgs={'ContentType': content_type, 'Metadata': metadata},
+                    Config=transfer_config
+                )
+        logger.info(f"Successfully uploaded file to S3: {s3_path}")
+        return s3_uploader.build_object_url(s3_path)
+
+
+adb = AsyncDatabase()
+async_s3 = AsyncS3Uploader()
+
+
+def json_response(payload, status_code=200):
+    return JSONResponse(payload, status_code=status_code)
+
+
+def timed_endpoint(rule):
+    """
+    记录请求指标并返回 Server-Timing（对应 app.py 的 before/after_request 钩子）
+
+    Args:
+        rule: 与 Flask 路由相同的模板，保证两种模式的指标标签一致
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request: Request):
+            token = start_request()
+            start = time.perf_counter()
+            response = None
+            try:
+                response = await handler(request)
+                return response
+            finally:
+                elapsed = time.perf_counter() - start
+                timings = finish_request(token)
+                status = response.status_code if response is not None else 500
+                metrics.inc('viba_http_requests_total', method=request.method, endpoint=rule, status=status)
+                metrics.observe('viba_http_request_duration_seconds', elapsed, method=request.method, endpoint=rule)
+                metrics.flush()
+                if response is not None and config['SERVER_TIMING_ENABLED']:
+                    response.headers['Server-Timing'] = format_server_timing(timings, elapsed)
+        return wrapper
+    return decorator
+
+
+# ==================== 标签 ====================
+
+@timed_endpoint('/api/tags/all')
+async def get_all_tags(request: Request):
+    """一次性获取所有标签，区分多级和单级（与同步模式共用标签结构缓存和响应体缓存）"""
+    try:
+        structures, version = tag_structure_cache.peek()
+        if structures is None:
+            # 只重新查询版本变化的 tag_type，其余使用缓存部分
+            type_versions = parse_tag_type_versions(await adb.execute_query(TAG_TYPE_VERSION_QUERY))
+            stale = tag_structure_cache.stale_types(type_versions)
+            rows = await adb.execute_query(TAG_TYPES_STRUCTURE_QUERY, (stale,)) if stale else []
+            structures, parts = tag_structure_cache.build(type_versions, rows)
+            version = tag_structure_cache.store(structures, version, parts)
+        body, etag = tags_response_body(structures, version)
+        # 与 make_conditional_response 一致：no-cache 要求客户端每次带 If-None-Match 验证
+        headers = {'ETag': f'"{etag}"', 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+            return Response(status_code=304, headers=headers)
+        if config['COMPRESSION_ENABLED']:
+            # 压缩结果按 ETag 缓存，与同步模式的 after_request 压缩一致
+            body, encoding = compressor.encode(body, request.headers.get('accept-encoding'), etag)
+            if encoding:
+                headers['Content-Encoding'] = encoding
+                headers['ETag'] = f'W/"{etag}"'
+        return Response(body, media_type='application/json', headers=headers)
+    except Exception as e:
+        logger.error(f"Error getting all tags: {str(e)}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+# ==================== 图片上传 ====================
+
+async def find_uploaded_image(sha256: str, image_type: str) -> Optional[Dict]:
+    """查找已登记的图片；查询失败按未命中处理（与 app.find_uploaded_image 一致）"""
+    try:
+        rows = await adb.execute_query(UPLOADED_IMAGE_LOOKUP_QUERY, (sha256, image_type))
+    except Exception as e:
+        logger.warning(f"Failed to look up uploaded image {sha256}: {str(e)}")
+        return None
+    return rows[0] if rows else None
+
+
+@timed_endpoint('/api/upload-image')
+async def upload_image(request: Request):
+    """上传单张图片到S3（内容已上传过时直接返回已有地址）"""
+    try:
+        form = await request.form()
+        file = form.get('file')
+        if file is None or isinstance(file, str):
+            return json_response({'success': False, 'error': 'No file provided'}, 400)
+
+        image_type = form.get('image_type', 'reference_image')
+        if file.filename == '':
+            return json_response({'success': False, 'error': 'No file selected'}, 400)
+
+        file_data = await file.read()
+
+        # 内容已上传过时直接返回已有地址（哈希与浏览器端对同一文件计算的结果一致）
+        file_hash = hashlib.sha256(file_data).hexdigest()
+        existing = await find_uploaded_image(file_hash, image_type)
+        if existing is not None:
+            return json_response({'success': True, 'data': uploaded_image_payload(existing)})
+
+        # 验证图片（竖屏要求），解码在线程池中执行
+        validation_result = await run_blocking(ImageValidator.validate_image, file_data)
+        if not validation_result['valid']:
+            return json_response({'success': False, 'error': validation_result['error']}, 400)
+
+        # 压缩大图片
+        if validation_result['file_size_mb'] > 10:
+            file_data = await run_blocking(ImageValidator.compress_image, file_data, 85)
+
+        content_type = file.content_type or 'image/jpeg'
+        url = await async_s3.upload_file(
+            file_data=file_data,
+            file_type=image_type,
+            content_type=content_type
+        )
+        try:
+            await adb.execute_query(
+                UPLOADED_IMAGE_INSERT_QUERY,
+                uploaded_image_params(file_hash, image_type, url, validation_result, content_type),
+                fetch=False
+            )
+        except Exception as e:
+            logger.warning(f"Failed to register uploaded image {file_hash}: {str(e)}")
+
+        return json_response({
+            'success': True,
+            'data': {
+                'url': url,
+                'cached': False,
+                'image_info': {
+                    'width': validation_result['width'],
+                    'height': validation_result['height']
+                }
+            }
+        })
+    except Exception as e:
+        logger.error(f"Upload error: {str(e)}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+# ==================== 参考图 ====================
+
+# 一次查询同时完成标签校验和父级补全：返回每个（启用的）起始标签及其所有父级
+TAG_ANCESTRY_QUERY = """
+    WITH RECURSIVE tag_path AS (
+        SELECT id AS root_id, id, parent_tag_id
+        FROM viba.tag_definitions
+        WHERE id = ANY(%s::bigint[]) AND is_active = TRUE
+
+        UNION
+
+        SELECT tp.root_id, t.id, t.parent_tag_id
+        FROM viba.tag_definitions t
+        INNER JOIN tag_path tp ON t.id = tp.parent_tag_id
+        WHERE t.is_active = TRUE
+    )
+    SELECT root_id, id FROM tag_path
+"""
+
+
+THEME_EXISTS_QUERY = """
+    SELECT unique_id::text AS unique_id FROM viba.themes WHERE unique_id = ANY(%s::uuid[])
+"""
+
+# 一条语句写入一张参考图的全部主题关联
+THEME_LINK_INSERT_QUERY = """
+    INSERT INTO viba.ref_images_to_themes (ref_image_id, theme_id)
+    SELECT %s::uuid, unnest(%s::uuid[])
+    ON CONFLICT DO NOTHING
+"""
+
+
+async def insert_theme_links(conn, ref_image_id, theme_ids: List[str]):
+    """在调用方的事务内写入主题关联（与同步侧 insert_theme_links 对应）"""
+    if not theme_ids:
+        return
+    with db.observe_query(THEME_LINK_INSERT_QUERY) as event:
+        status = await conn.execute(to_asyncpg_query(THEME_LINK_INSERT_QUERY), ref_image_id, theme_ids)
+        event['rows'] = int(status.rsplit(' ', 1)[-1])
+
+
+async def validate_and_enrich_tags(all_tag_ids: Set[int], tag_data: Dict[str, List[int]]) -> Tuple[Set[int], Dict]:
+    """
+    校验标签ID并补全父级（结果与 validate_tag_ids + enrich_with_parent_tags 一致）
+
+    标签ID需已由 find_malformed_tag_ids 确认均为整数。
+
+    Returns:
+        (无效的标签ID集合, 补全父级后的标签字典)
+    """
+    requested = set(all_tag_ids)
+    for tag_ids in tag_data.values():
+        requested.update(tag_ids or [])
+    if not requested:
+        return set(), {field: [] for field in tag_data}
+
+    rows = await adb.execute_query(TAG_ANCESTRY_QUERY, (sorted(requested),))
+    ancestry: Dict[int, Set[int]] = {}
+    for row in rows:
+        ancestry.setdefault(row['root_id'], set()).add(row['id'])
+
+    invalid = {tag_id for tag_id in all_tag_ids if tag_id not in ancestry}
+    enriched = {}
+    for field, tag_ids in tag_data.items():
+        ids = set()
+        for tag_id in tag_ids or []:
+            ids.update(ancestry.get(tag_id, ()))
+        enriched[field] = list(ids)
+    return invalid, enriched
+
+
+def generate_embeddings(data):
+    """单条参考图的所有向量文本合并为一次模型调用"""
+    return generate_embeddings_for_batch([data])[0]
+
+
+@timed_endpoint('/api/reference-images')
+async def create_reference_image(request: Request):
+    """创建参考图标注（标签校验与向量嵌入并发执行）"""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            return json_response({'success': False, 'error': 'Invalid JSON body'}, 400)
+
+        error = validate_reference_payload(data)
+        if error:
+            return json_response({'success': False, 'error': error}, 400)
+
+        ## 将product_item_id由text转为uuid
+        try:
+            product_item_ids = parse_product_item_ids(data)
+            theme_ids = parse_theme_ids(data)
+        except ValueError as e:
+            return json_response({'success': False, 'error': str(e)}, 400)
+
+        if theme_ids:
+            known_themes = {row['unique_id'] for row in await adb.execute_query(THEME_EXISTS_QUERY, (theme_ids,))}
+            invalid_themes = [theme_id for theme_id in theme_ids if theme_id not in known_themes]
+            if invalid_themes:
+                return json_response({'success': False, 'error': f'Invalid theme IDs: {invalid_themes}'}, 400)
+
+        all_tag_ids = collect_all_tag_ids(data)
+        tag_data = prepare_tag_data_for_storage(data)
+        malformed_tags = find_malformed_tag_ids(all_tag_ids, tag_data)
+        if malformed_tags:
+            return json_response({'success': False, 'error': f'Invalid tag IDs: {malformed_tags}'}, 400)
+
+        # 两个互不依赖的阶段同时开始：嵌入在线程池中计算，标签校验为数据库 I/O
+        embedding_future = run_blocking(generate_embeddings, data) if config['ENABLE_EMBEDDINGS'] else None
+        tag_task = asyncio.ensure_future(validate_and_enrich_tags(all_tag_ids, tag_data))
+
+        try:
+            invalid_tags, enriched_tags = await tag_task
+            if invalid_tags:
+                return json_response({'success': False, 'error': f'Invalid tag IDs: {list(invalid_tags)}'}, 400)
+
+            embeddings = await embedding_future if embedding_future is not None else {}
+        finally:
+            # 校验失败提前返回时取消其余阶段（尚未开始的嵌入任务不会再执行）
+            for pending in (embedding_future, tag_task):
+                if pending is not None and not pending.done():
+                    pending.cancel()
+
+        row = build_reference_row(data, product_item_ids, enriched_tags, embeddings)
+        # json / vector 字段由连接上注册的编解码处理，直接传 Python 对象
+        params = [row[column] for column in REFERENCE_INSERT_COLUMNS]
+        # 参考图与主题关联在同一事务内写入
+        result = await adb.execute_insert(
+            build_reference_insert_query(REFERENCE_INSERT_COLUMNS), params,
+            after=lambda conn, row: insert_theme_links(conn, row['unique_id'], theme_ids)
+        )
+
+        # 缓存更新会加锁并写向量索引，放到线程中执行
+        await asyncio.to_thread(update_reference_caches, [(str(result['unique_id']), enriched_tags, embeddings)])
+
+        return json_response({
+            'success': True,
+            'data': {
+                'id': result['id'],
+                'unique_id': str(result['unique_id'])
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error creating reference image: {str(e)}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    async with AsyncExitStack() as stack:
+        await adb.open()
+        stack.push_async_callback(adb.close)
+        await async_s3.open(stack)
+        # 原生异步路由不经过 Flask 的 before_request，在这里启动缓存变更监听
+        start_cache_listener()
+        yield
+    cpu_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/api/tags/all', get_all_tags, methods=['GET']),
+        Route('/api/upload-image', upload_image, methods=['POST']),
+        Route('/api/reference-images', create_reference_image, methods=['POST']),
+        # 其余路由（以及上面路由的其他方法）交给 Flask
+        Mount('/', app=WSGIMiddleware(flask_app, workers=config['ASYNC_WSGI_THREADS']))
+    ],
+    lifespan=lifespan
+)
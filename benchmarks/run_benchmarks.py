@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# run_benchmarks.py - 标注热点路径的可复现基准测试
+"""
+用法:
+    python benchmarks/run_benchmarks.py                      # 运行全部套件
+    python benchmarks/run_benchmarks.py --suite tags image   # 只运行部分套件
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<旧结果>.json
+
+套件:
+    tags       build_tree_structure / build_flat_structure（合成标签体系，默认 1k/10k/100k）
+    payload    collect_all_tag_ids + prepare_tag_data_for_storage（纯 Python）
+    enrich     enrich_with_parent_tags（逐标签递归查询）与 load_tag_parent_index + expand_with_ancestors
+               （需要 DB_* 环境变量指向本地 Postgres，且 viba.tag_definitions 中有数据）
+    image      ImageValidator 在典型 JPEG/PNG 尺寸上的校验、压缩和缩放
+    embedding  EmbeddingService 单条与批量（需要 sentence-transformers 模型）
+    vector     384 维向量参数的编码/解析耗时和字节数（Python float 列表与 Vector 对比）；
+               可连接数据库且安装了 pgvector 时另测单行插入耗时
+
+结果写为 JSON（默认 benchmarks/results/<时间>_<commit>.json），--compare 与旧结果逐项对比中位数。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+SUITES = ('tags', 'payload', 'enrich', 'image', 'embedding', 'vector')
+
+
+class SkipSuite(Exception):
+    """套件依赖不可用（数据库、模型等），记录原因后跳过"""
+
+
+def measure(fn, repeat=5, number=1, warmup=1):
+    """
+    多次计时，返回单次调用耗时统计（毫秒）
+
+    Args:
+        fn: 无参函数
+        repeat: 计时轮数
+        number: 每轮调用次数
+        warmup: 预热调用次数（不计时）
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) * 1000 / number)
+    samples.sort()
+    return {
+        'repeat': repeat,
+        'number': number,
+        'min_ms': round(samples[0], 4),
+        'median_ms': round(statistics.median(samples), 4),
+        'mean_ms': round(statistics.fmean(samples), 4),
+        'max_ms': round(samples[-1], 4),
+        'stdev_ms': round(statistics.stdev(samples), 4) if len(samples) > 1 else 0.0
+    }
+
+
+def make_taxonomy(size, seed=42, branching=(20, 10, 8)):
+    """
+    生成与 viba.tag_definitions 查询结果同结构的合成四级标签体系
+
+    Args:
+        size: 标签总数
+        seed: 随机种子（保证可复现）
+        branching: 第 1/2/3 级节点的平均子节点数
+    """
+    rng = random.Random(seed)
+    tags = []
+    frontier = [None]
+    level = 1
+    while len(tags) < size and level <= 4:
+        next_frontier = []
+        for parent in frontier:
+            if level == 1:
+                children = max(size // 400, 10)
+            else:
+                children = max(1, int(rng.gauss(branching[level - 2], branching[level - 2] / 4)))
+            for _ in range(children):
+                if len(tags) >= size:
+                    break
+                tag_id = len(tags) + 1
+                tag = {
+                    'id': tag_id,
+                    'tag_type': 'bench',
+                    'tag_name': f'tag_{tag_id}',
+                    'tag_name_cn': f'标签{tag_id}',
+                    'parent_tag_id': parent['id'] if parent else None,
+                    'level': level,
+                    'full_code': f'{tag_id:014d}',
+                    'is_leaf': level == 4,
+                    'attributes': {}
+                }
+                if parent:
+                    parent['is_leaf'] = False
+                tags.append(tag)
+                next_frontier.append(tag)
+        frontier = next_frontier
+        level += 1
+    return tags
+
+
+def make_payload(tag_ids, rng):
+    """按前端提交格式构造一条标注的标签部分"""
+    pick = lambda n: rng.sample(tag_ids, min(n, len(tag_ids)))
+    return {
+        'style_tag_ids': pick(3),
+        'occasion_tag_ids': pick(2),
+        'pose_tag_ids': pick(2),
+        'composition_tag_ids': pick(1),
+        'model_attribute_tag_ids': pick(4),
+        'outfit_details': [
+            {
+                'product_type_tag_ids': pick(1),
+                'fabric_tag_id': pick(1)[0],
+                'silhouette_tag_id': pick(1)
+            }
+            for _ in range(2)
+        ]
+    }
+
+
+def bench_tags(app_module, args):
+    results = {}
+    for size in args.tag_sizes:
+        tags = make_taxonomy(size)
+        repeat = args.repeat if size <= 10000 else max(3, args.repeat // 2)
+        results[f'build_tree_structure[{size}]'] = measure(
+            lambda: app_module.build_tree_structure(tags), repeat=repeat)
+        results[f'build_flat_structure[{size}]'] = measure(
+            lambda: app_module.build_flat_structure(tags), repeat=repeat)
+    return results
+
+
+def bench_payload(app_module, args):
+    rng = random.Random(7)
+    tag_ids = [tag['id'] for tag in make_taxonomy(10000)]
+    payloads = [make_payload(tag_ids, rng) for _ in range(100)]
+
+    def run():
+        for payload in payloads:
+            app_module.collect_all_tag_ids(payload)
+            app_module.prepare_tag_data_for_storage(payload)
+
+    stats = measure(run, repeat=args.repeat, number=10)
+    # 折算为单条标注的耗时
+    for key in ('min_ms', 'median_ms', 'mean_ms', 'max_ms', 'stdev_ms'):
+        stats[key] = round(stats[key] / len(payloads), 6)
+    stats['unit'] = 'per payload'
+    return {'collect_and_prepare_tags': stats}
+
+
+def bench_enrich(app_module, args):
+    try:
+        rows = app_module.db.execute_query(
+            "SELECT id FROM viba.tag_definitions WHERE is_active = TRUE ORDER BY level DESC, id LIMIT 2000")
+    except Exception as e:
+        raise SkipSuite(f'database not available: {str(e).strip()}')
+    if not rows:
+        raise SkipSuite('viba.tag_definitions has no active tags')
+
+    rng = random.Random(11)
+    tag_ids = [row['id'] for row in rows]
+    payloads = [make_payload(tag_ids, rng) for _ in range(20)]
+    prepared = [app_module.prepare_tag_data_for_storage(payload) for payload in payloads]
+    tag_count = sum(len(ids) for fields in prepared for ids in fields.values()) / len(prepared)
+
+    def per_tag_queries():
+        for fields in prepared:
+            app_module.enrich_with_parent_tags(fields)
+
+    def in_memory_index():
+        parent_index = app_module.load_tag_parent_index()
+        for fields in prepared:
+            for ids in fields.values():
+                app_module.expand_with_ancestors(ids, parent_index)
+
+    results = {}
+    for name, fn in (('enrich_with_parent_tags', per_tag_queries),
+                     ('load_tag_parent_index+expand_with_ancestors', in_memory_index)):
+        stats = measure(fn, repeat=args.repeat)
+        for key in ('min_ms', 'median_ms', 'mean_ms', 'max_ms', 'stdev_ms'):
+            stats[key] = round(stats[key] / len(prepared), 4)
+        stats['unit'] = 'per payload'
+        stats['tags_per_payload'] = round(tag_count, 1)
+        results[name] = stats
+    return results
+
+
+def make_image(width, height, image_format, seed=3):
+    """生成带噪声（接近照片压缩率）的测试图片"""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    # 低分辨率噪声放大，得到平滑的色块 + 细节，而不是完全不可压缩的白噪声
+    base = rng.integers(0, 256, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((width, height), Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    if image_format == 'JPEG':
+        img.save(output, format=image_format, quality=90)
+    else:
+        img.save(output, format=image_format)
+    return output.getvalue()
+
+
+def bench_image(app_module, args):
+    from image_validator import ImageValidator
+
+    results = {}
+    for width, height in ((1080, 1440), (2160, 3840), (3000, 4000)):
+        for image_format in ('JPEG', 'PNG'):
+            data = make_image(width, height, image_format)
+            label = f'{image_format.lower()}_{width}x{height}'
+            results[f'validate_image[{label}]'] = dict(
+                measure(lambda: ImageValidator.validate_image(data), repeat=args.repeat, number=5),
+                bytes=len(data))
+            results[f'compress_image[{label}]'] = measure(
+                lambda: ImageValidator.compress_image(data, quality=85), repeat=args.repeat)
+            if width > ImageValidator.MAX_WIDTH or height > ImageValidator.MAX_HEIGHT:
+                results[f'resize_image_if_needed[{label}]'] = measure(
+                    lambda: ImageValidator.resize_image_if_needed(data), repeat=args.repeat)
+    return results
+
+
+def bench_embedding(app_module, args):
+    from embedding_service import embedding_service
+
+    if not embedding_service.available:
+        raise SkipSuite('embedding model not available')
+
+    rng = random.Random(5)
+    words = ['站立', '侧身', '街拍', '通勤', '连衣裙', 'outdoor', 'studio', 'casual', 'summer', '背光', '半身', 'smile']
+    texts = [' '.join(rng.choice(words) for _ in range(12)) for _ in range(args.embedding_batch)]
+
+    def single():
+        for text in texts:
+            embedding_service.generate_embedding(text)
+
+    stats_single = measure(single, repeat=args.repeat)
+    stats_batch = measure(lambda: embedding_service.generate_batch_embeddings(texts), repeat=args.repeat)
+    return {
+        f'generate_embedding_x{len(texts)}': stats_single,
+        f'generate_batch_embeddings[{len(texts)}]': stats_batch
+    }
+
+
+def per_item(stats, count, unit):
+    """把一轮处理 count 个对象的耗时折算为单个对象"""
+    for key in ('min_ms', 'median_ms', 'mean_ms', 'max_ms', 'stdev_ms'):
+        stats[key] = round(stats[key] / count, 6)
+    stats['unit'] = unit
+    return stats
+
+
+def bench_vector(app_module, args):
+    import numpy as np
+    from psycopg2.extensions import adapt
+    from vector_codec import Vector, format_vector, parse_vector
+
+    vectors = np.random.default_rng(13).standard_normal((200, 384)).astype(np.float32)
+    lists = [vector.tolist() for vector in vectors]
+    wrapped = [Vector(vector) for vector in vectors]
+    texts = [format_vector(vector) for vector in vectors]
+
+    # 参数编码：Python float 列表由 psycopg2 生成 ARRAY[...] 字面量，Vector 由 vector 适配器编码
+    results = {
+        'encode_param[list]': dict(
+            per_item(measure(lambda: [adapt(value).getquoted() for value in lists], repeat=args.repeat),
+                     len(lists), 'per vector'),
+            bytes=len(adapt(lists[0]).getquoted())),
+        'encode_param[Vector]': dict(
+            per_item(measure(lambda: [adapt(value).getquoted() for value in wrapped], repeat=args.repeat),
+                     len(wrapped), 'per vector'),
+            bytes=len(adapt(wrapped[0]).getquoted())),
+        'parse_vector[text]': per_item(
+            measure(lambda: [parse_vector(text) for text in texts], repeat=args.repeat), len(texts), 'per vector')
+    }
+
+    try:
+        conn = app_module.db.get_connection()
+    except Exception as e:
+        print(f"  insert benchmarks skipped: database not available: {str(e).strip()}")
+        return results
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regtype('vector') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                print("  insert benchmarks skipped: pgvector not installed")
+                return results
+            cursor.execute("CREATE TEMP TABLE bench_vectors (embedding vector(384))")
+            for name, values in (('list', lists), ('Vector', wrapped)):
+                def insert_rows(values=values):
+                    for value in values:
+                        cursor.execute("INSERT INTO bench_vectors (embedding) VALUES (%s::vector)", (value,))
+                results[f'insert_row[{name}]'] = per_item(
+                    measure(insert_rows, repeat=args.repeat), len(values), 'per row')
+    finally:
+        conn.rollback()
+        conn.close()
+    return results
+
+
+BENCHMARKS = {
+    'tags': bench_tags,
+    'payload': bench_payload,
+    'enrich': bench_enrich,
+    'image': bench_image,
+    'embedding': bench_embedding,
+    'vector': bench_vector
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def environment_info():
+    import numpy as np
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    按基准名称对比中位数
+
+    Returns:
+        是否存在超过阈值的退化
+    """
+    regressed = False
+    print(f"\n{'benchmark':<60} {'baseline':>12} {'current':>12} {'change':>9}")
+    for suite, benchmarks in current['suites'].items():
+        old_suite = baseline.get('suites', {}).get(suite, {})
+        for name, stats in benchmarks.get('results', {}).items():
+            old = old_suite.get('results', {}).get(name)
+            if not old:
+                continue
+            change = stats['median_ms'] / old['median_ms'] - 1 if old['median_ms'] else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            print(f"{suite + '/' + name:<60} {old['median_ms']:>10.3f}ms {stats['median_ms']:>10.3f}ms {change:>+8.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the annotation hot paths')
+    parser.add_argument('--suite', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--repeat', type=int, default=7, help='计时轮数')
+    parser.add_argument('--tag-sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--embedding-batch', type=int, default=32)
+    parser.add_argument('--output', help='结果文件路径（默认 benchmarks/results/<时间>_<commit>.json）')
+    parser.add_argument('--compare', help='对比的旧结果文件')
+    parser.add_argument('--threshold', type=float, default=0.10, help='判定退化的中位数增幅（默认 10%%）')
+    args = parser.parse_args()
+
+    # 导入 app 会初始化数据库配置和嵌入模型，放在参数解析之后
+    import app as app_module
+
+    report = {'environment': environment_info(), 'suites': {}}
+    for suite in args.suite:
+        print(f"Running {suite}...", flush=True)
+        try:
+            report['suites'][suite] = {'results': BENCHMARKS[suite](app_module, args)}
+        except SkipSuite as e:
+            print(f"  skipped: {e}")
+            report['suites'][suite] = {'skipped': str(e)}
+            continue
+        for name, stats in report['suites'][suite]['results'].items():
+            print(f"  {name:<58} median {stats['median_ms']:>10.3f}ms")
+
+    output = args.output or os.path.join(
+        ROOT_DIR, 'benchmarks', 'results',
+        f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{report['environment']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
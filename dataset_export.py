@@ -0,0 +1,257 @@
+# dataset_export.py - 参考图标注数据集的流式导出（NDJSON / Parquet）
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import numpy as np
+
+from tag_config import REFERENCE_TAG_FIELDS
+from vector_codec import parse_vector
+
+logger = logging.getLogger(__name__)
+
+# pyarrow 为可选依赖，仅 Parquet 导出需要
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    pa = None
+    pq = None
+    PARQUET_AVAILABLE = False
+
+EXPORT_FORMATS = ('ndjson', 'parquet')
+
+# 导出字段（search_text / search_tsv 为生成列，不导出）
+TEXT_COLUMNS = [
+    'unique_id',
+    'reference_image_url',
+    'gen_pose_description',
+    'gen_product_description',
+    'gen_occasion_description',
+    'gen_composition_description',
+    'gen_style_description',
+    'gen_content_prompt',
+    'gen_ml_model_source',
+    'pose_description',
+    'scene_description'
+]
+
+TEXT_ARRAY_COLUMNS = [
+    'gen_pose_images',
+    'gen_product_images',
+    'gen_occasion_images',
+    'gen_composition_images',
+    'gen_style_images',
+    'product_item_ids',
+    'theme_ids'
+]
+
+EMBEDDING_COLUMNS = [
+    'gen_content_embedding',
+    'gen_pose_embedding',
+    'gen_product_embedding',
+    'gen_occasion_embedding',
+    'gen_composition_embedding',
+    'pose_embedding',
+    'scene_embedding'
+]
+
+
+def tag_names_column(field: str) -> str:
+    """标签ID字段对应的名称字段，如 style_tag_ids -> style_tag_names"""
+    return field[:-len('_ids')] + '_names'
+
+
+def build_export_query(include_embeddings: bool = True) -> str:
+    """
+    构建导出查询，按 id 顺序读取全表，主题ID通过 LATERAL 聚合
+
+    Args:
+        include_embeddings: 是否导出向量字段
+
+    Returns:
+        SQL 文本
+    """
+    columns = ['ri.id', 'ri.reference_type', 'ri.can_be_used_for_face_switching',
+               'ri.outfit_details', 'ri.created_at', 'ri.updated_at']
+    for column in TEXT_COLUMNS:
+        columns.append(f'ri.{column}::text AS {column}' if column == 'unique_id' else f'ri.{column}')
+    for column in TEXT_ARRAY_COLUMNS:
+        if column == 'product_item_ids':
+            columns.append(f'ri.{column}::text[] AS {column}')
+        elif column != 'theme_ids':
+            columns.append(f'ri.{column}')
+    columns.extend(f'ri.{field}' for field in REFERENCE_TAG_FIELDS)
+    if include_embeddings:
+        columns.extend(f'ri.{column}' for column in EMBEDDING_COLUMNS)
+    columns.append('themes.theme_ids')
+
+    return f"""
+        SELECT {', '.join(columns)}
+        FROM viba.reference_images ri
+        LEFT JOIN LATERAL (
+            SELECT array_agg(rit.theme_id::text ORDER BY rit.theme_id) AS theme_ids
+            FROM viba.ref_images_to_themes rit
+            WHERE rit.ref_image_id = ri.unique_id
+        ) themes ON TRUE
+        ORDER BY ri.id
+    """
+
+
+def resolve_export_row(row: Dict[str, Any], tag_names: Dict[int, str],
+                       include_embeddings: bool = True) -> Dict[str, Any]:
+    """
+    把数据库行转换为导出记录：标签ID解析为名称，向量解析为 float32 数组
+
+    Args:
+        row: 数据库行
+        tag_names: {tag_id: tag_name}
+        include_embeddings: 是否包含向量字段
+
+    Returns:
+        导出记录（未知的标签ID对应名称为 None）
+    """
+    record = dict(row)
+    for field in REFERENCE_TAG_FIELDS:
+        tag_ids = record.get(field)
+        record[tag_names_column(field)] = (
+            [tag_names.get(tag_id) for tag_id in tag_ids] if tag_ids is not None else None
+        )
+    if include_embeddings:
+        for column in EMBEDDING_COLUMNS:
+            record[column] = parse_vector(record.get(column))
+    return record
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def iter_ndjson(records: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """逐行输出 NDJSON（向量输出为浮点数组）"""
+    for record in records:
+        yield (json.dumps(record, ensure_ascii=False, default=_json_default) + '\n').encode('utf-8')
+
+
+class _ChunkSink:
+    """供 ParquetWriter 写入的类文件对象，写入的字节由生成器随时取走"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def build_parquet_schema(embedding_dimensions: Optional[Dict[str, int]] = None,
+                         include_embeddings: bool = True):
+    """
+    构建导出的 Parquet schema
+
+    向量字段为 binary，内容是小端 float32 原始字节（numpy.frombuffer(value, '<f4') 即可还原），
+    维度记录在字段元数据中。
+    """
+    fields = [
+        pa.field('id', pa.int64()),
+        pa.field('reference_type', pa.int32()),
+        pa.field('can_be_used_for_face_switching', pa.bool_()),
+        pa.field('outfit_details', pa.string()),  # JSON 文本
+        pa.field('created_at', pa.timestamp('us')),
+        pa.field('updated_at', pa.timestamp('us'))
+    ]
+    fields.extend(pa.field(column, pa.string()) for column in TEXT_COLUMNS)
+    fields.extend(pa.field(column, pa.list_(pa.string())) for column in TEXT_ARRAY_COLUMNS)
+    for field in REFERENCE_TAG_FIELDS:
+        fields.append(pa.field(field, pa.list_(pa.int64())))
+        fields.append(pa.field(tag_names_column(field), pa.list_(pa.string())))
+    if include_embeddings:
+        for column in EMBEDDING_COLUMNS:
+            metadata = {'dtype': 'float32', 'byte_order': 'little'}
+            if embedding_dimensions and column in embedding_dimensions:
+                metadata['dimension'] = str(embedding_dimensions[column])
+            fields.append(pa.field(column, pa.binary(), metadata=metadata))
+    return pa.schema(fields)
+
+
+def _to_parquet_value(column: str, value: Any, embedding_columns: set):
+    if value is None:
+        return None
+    if column in embedding_columns:
+        return np.asarray(value, dtype='<f4').tobytes()
+    if column == 'outfit_details':
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def iter_parquet(records: Iterable[Dict[str, Any]], batch_size: int = 1000,
+                 embedding_dimensions: Optional[Dict[str, int]] = None,
+                 include_embeddings: bool = True) -> Iterator[bytes]:
+    """
+    流式输出 Parquet 文件，每 batch_size 行写一个 row group 并立即输出，内存占用与总行数无关
+
+    Args:
+        records: resolve_export_row 产出的导出记录
+        batch_size: 每个 row group 的行数
+        embedding_dimensions: {向量字段: 维度}，写入字段元数据
+        include_embeddings: 是否包含向量字段
+
+    Yields:
+        Parquet 文件的字节片段
+    """
+    if not PARQUET_AVAILABLE:
+        raise RuntimeError('Parquet export requires pyarrow')
+
+    schema = build_parquet_schema(embedding_dimensions, include_embeddings)
+    embedding_columns = set(EMBEDDING_COLUMNS) if include_embeddings else set()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+
+    def write_batch(batch):
+        columns = {
+            name: [_to_parquet_value(name, record.get(name), embedding_columns) for record in batch]
+            for name in schema.names
+        }
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+
+    try:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                write_batch(batch)
+                batch = []
+                data = sink.drain()
+                if data:
+                    yield data
+        if batch:
+            write_batch(batch)
+    finally:
+        writer.close()
+
+    data = sink.drain()
+    if data:
+        yield data
@@ -1,17 +1,27 @@
 # embedding_service.py
 import logging
-from typing import List, Optional
+import os
+from typing import Dict, List, Optional
 import numpy as np
 
+from metrics import timed_stage
+
 logger = logging.getLogger(__name__)
 
+# 模型原生输出维度（paraphrase-multilingual-MiniLM-L12-v2）
+NATIVE_DIMENSION = 384
+
 class EmbeddingService:
     """向量嵌入服务，用于生成文本的向量表示"""
     
-    def __init__(self):
+    def __init__(self, projection_path: Optional[str] = None):
         self.model = None
         self.available = False
+        self.native_dimension = NATIVE_DIMENSION
+        # 目标维度 -> {'components': (目标维度, 原生维度), 'mean': (原生维度,)}
+        self.projections: Dict[int, Dict[str, np.ndarray]] = {}
         self._load_model()
+        self._load_projection(projection_path or os.environ.get('EMBEDDING_PROJECTION_PATH'))
     
     def _load_model(self):
         """加载嵌入模型"""
@@ -19,22 +29,89 @@ class EmbeddingService:
             from sentence_transformers import SentenceTransformer
             # 使用多语言模型，支持中英文
             self.model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+            self.native_dimension = self.model.get_sentence_embedding_dimension() or NATIVE_DIMENSION
             self.available = True
             logger.info("Successfully loaded embedding model")
         except Exception as e:
             logger.warning(f"Failed to load embedding model: {str(e)}. Embeddings will be disabled.")
             self.available = False
     
-    def generate_embedding(self, text: str, dimension: int = 768) -> Optional[List[float]]:
+    def _load_projection(self, path: Optional[str]):
+        """加载随服务保存的降维投影矩阵（.npz，包含 components 和 mean）"""
+        if not path:
+            return
+        try:
+            with np.load(path) as data:
+                components = np.ascontiguousarray(data['components'], dtype=np.float32)
+                mean = np.ascontiguousarray(data['mean'], dtype=np.float32)
+            self.projections[components.shape[0]] = {'components': components, 'mean': mean}
+            logger.info(f"Loaded embedding projection {components.shape[1]}->{components.shape[0]} from {path}")
+        except Exception as e:
+            logger.warning(f"Failed to load embedding projection from {path}: {str(e)}")
+    
+    def fit_pca_projection(self, embeddings: np.ndarray, dimension: int) -> Dict[str, np.ndarray]:
+        """
+        基于样本向量拟合PCA投影，用于把原生向量降到更小的存储维度
+        
+        Args:
+            embeddings: 样本向量矩阵 (样本数, 原生维度)
+            dimension: 目标维度，必须小于原生维度
+        
+        Returns:
+            投影参数字典
+        """
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2 or dimension >= matrix.shape[1] or dimension > matrix.shape[0]:
+            raise ValueError(f"Cannot fit {matrix.shape} embeddings to {dimension} dimensions")
+        
+        mean = matrix.mean(axis=0)
+        # SVD的右奇异向量即主成分方向
+        _, _, vt = np.linalg.svd(matrix - mean, full_matrices=False)
+        projection = {
+            'components': np.ascontiguousarray(vt[:dimension], dtype=np.float32),
+            'mean': mean.astype(np.float32)
+        }
+        self.projections[dimension] = projection
+        return projection
+    
+    def save_projection(self, path: str, dimension: int):
+        """保存投影参数，服务启动时通过 EMBEDDING_PROJECTION_PATH 加载"""
+        projection = self.projections[dimension]
+        np.savez(path, components=projection['components'], mean=projection['mean'])
+    
+    def _fit_dimension(self, embedding: np.ndarray, dimension: int) -> np.ndarray:
+        """
+        将模型输出调整到目标维度
+        
+        维度一致时原样返回；不一致时只允许使用已加载的投影，
+        不再做零填充或截断（填充浪费存储和索引，截断会静默丢失信息）。
+        """
+        if len(embedding) == dimension:
+            return embedding
+        
+        projection = self.projections.get(dimension)
+        if projection is None or projection['components'].shape[1] != len(embedding):
+            raise ValueError(
+                f"No projection available from {len(embedding)} to {dimension} dimensions"
+            )
+        
+        projected = projection['components'] @ (embedding - projection['mean'])
+        norm = np.linalg.norm(projected)
+        return projected / norm if norm > 0 else projected
+    
+    def generate_embedding(self, text: str, dimension: int = NATIVE_DIMENSION) -> Optional[np.ndarray]:
         """
         生成文本的向量嵌入
         
         Args:
             text: 输入文本
-            dimension: 向量维度（768或384）
+            dimension: 向量维度（默认为模型原生的384维）
         
         Returns:
-            向量列表或None
+            float32向量或None（模型推理失败时）
+        
+        Raises:
+            ValueError: 目标维度与模型输出不一致且没有可用投影（配置错误，不静默存入空向量）
         """
         if not text or not text.strip():
             return None
@@ -42,26 +119,22 @@ class EmbeddingService:
         if not self.available:
             # 返回mock向量用于测试
             logger.debug("Embedding model not available, returning mock vector")
-            return [0.0] * dimension
+            return np.zeros(dimension, dtype=np.float32)
         
         try:
             # 生成嵌入
-            embedding = self.model.encode(text, normalize_embeddings=True)
-            
-            # 调整维度
-            if dimension == 384 and len(embedding) == 768:
-                # 通过简单截断降维
-                embedding = embedding[:384]
-            elif dimension == 768 and len(embedding) == 384:
-                # 填充到768维
-                embedding = np.pad(embedding, (0, 768 - 384), 'constant')
-            
-            return embedding.tolist()
+            with timed_stage('embedding'):
+                embedding = self.model.encode(text, normalize_embeddings=True)
         except Exception as e:
             logger.error(f"Error generating embedding: {str(e)}")
             return None
+        
+        # 调整维度
+        embedding = self._fit_dimension(embedding, dimension)
+        
+        return np.asarray(embedding, dtype=np.float32)
     
-    def generate_batch_embeddings(self, texts: List[str], dimension: int = 768) -> List[Optional[List[float]]]:
+    def generate_batch_embeddings(self, texts: List[str], dimension: int = NATIVE_DIMENSION) -> List[Optional[np.ndarray]]:
         """
         批量生成文本的向量嵌入
         
@@ -70,46 +143,47 @@ class EmbeddingService:
             dimension: 向量维度
         
         Returns:
-            向量列表
+            float32向量列表（空文本对应None，模型推理失败时全部为None）
+        
+        Raises:
+            ValueError: 目标维度与模型输出不一致且没有可用投影
         """
         if not texts:
             return []
         
         if not self.available:
             # 返回mock向量列表
-            return [[0.0] * dimension for _ in texts]
+            return [np.zeros(dimension, dtype=np.float32) for _ in texts]
+        
+        # 过滤空文本
+        valid_texts = [t for t in texts if t and t.strip()]
+        if not valid_texts:
+            return [None] * len(texts)
         
         try:
-            # 过滤空文本
-            valid_texts = [t for t in texts if t and t.strip()]
-            if not valid_texts:
-                return [None] * len(texts)
-            
             # 批量生成嵌入
-            embeddings = self.model.encode(valid_texts, normalize_embeddings=True, batch_size=32)
-            
-            # 创建结果映射
-            result = []
-            valid_idx = 0
-            for text in texts:
-                if text and text.strip():
-                    embedding = embeddings[valid_idx]
-                    
-                    # 调整维度
-                    if dimension == 384 and len(embedding) == 768:
-                        embedding = embedding[:384]
-                    elif dimension == 768 and len(embedding) == 384:
-                        embedding = np.pad(embedding, (0, 768 - 384), 'constant')
-                    
-                    result.append(embedding.tolist())
-                    valid_idx += 1
-                else:
-                    result.append(None)
-            
-            return result
+            with timed_stage('embedding'):
+                embeddings = self.model.encode(valid_texts, normalize_embeddings=True, batch_size=32)
         except Exception as e:
             logger.error(f"Error generating batch embeddings: {str(e)}")
             return [None] * len(texts)
+        
+        # 创建结果映射
+        result = []
+        valid_idx = 0
+        for text in texts:
+            if text and text.strip():
+                embedding = embeddings[valid_idx]
+                
+                # 调整维度
+                embedding = self._fit_dimension(embedding, dimension)
+                
+                result.append(np.asarray(embedding, dtype=np.float32))
+                valid_idx += 1
+            else:
+                result.append(None)
+        
+        return result
     
     def compute_similarity(self, embedding1: List[float], embedding2: List[float]) -> float:
         """
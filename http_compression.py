@@ -0,0 +1,176 @@
+# http_compression.py - 响应压缩：按 Accept-Encoding 协商 br / gzip，超过阈值的文本类响应才压缩
+import gzip
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 可压缩的响应类型（图片等已压缩格式不再压缩）
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+}
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """解析 Accept-Encoding，返回 {编码: q 值}"""
+    preferences = {}
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        preferences[coding] = q
+    return preferences
+
+
+class ResponseCompressor:
+    """
+    响应压缩器
+
+    br（需安装 brotli）优先于 gzip，客户端 q 值更高的编码优先。
+    带 ETag 的响应（静态文件、缓存的标签数据等）压缩结果按 (ETag, 编码) 缓存，相同内容只压缩一次；
+    压缩后 ETag 改为弱校验（内容编码不同，但 If-None-Match 按弱比较仍能命中）。
+    """
+
+    def __init__(self, min_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4,
+                 cache_size: int = 64):
+        """
+        Args:
+            min_size: 小于该字节数的响应不压缩（压缩收益抵不过开销）
+            gzip_level: gzip 压缩级别（1-9）
+            brotli_quality: brotli 质量（0-11，动态响应建议 4-5）
+            cache_size: 按 ETag 缓存的压缩结果条数
+        """
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+        self._cache: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def choose_encoding(self, accept_encoding: Optional[str]) -> Optional[str]:
+        """按 Accept-Encoding 选择编码，客户端不接受任何可用编码时返回 None"""
+        preferences = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for encoding in self.encodings:
+            q = preferences.get(encoding, preferences.get('*', 0.0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def is_compressible(self, mimetype: Optional[str]) -> bool:
+        return (mimetype or '').split(';')[0].strip().lower() in COMPRESSIBLE_MIMETYPES
+
+    def compress(self, data: bytes, encoding: str, etag: Optional[str] = None) -> bytes:
+        """
+        压缩数据
+
+        Args:
+            data: 原始响应体
+            encoding: 'br' 或 'gzip'
+            etag: 原始响应的 ETag，提供时缓存压缩结果
+
+        Returns:
+            压缩后的字节
+        """
+        key = (etag, encoding) if etag else None
+        if key is not None:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    return cached
+
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+        if key is not None:
+            with self._lock:
+                self._cache[key] = compressed
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return compressed
+
+    def encode(self, data: bytes, accept_encoding: Optional[str],
+               etag: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+        """
+        按协商结果压缩（供不经过 Flask 的异步路由使用）
+
+        Returns:
+            (响应体, Content-Encoding)，不压缩时编码为 None
+        """
+        if len(data) < self.min_size:
+            return data, None
+        encoding = self.choose_encoding(accept_encoding)
+        if encoding is None:
+            return data, None
+        return self.compress(data, encoding, etag), encoding
+
+    def init_app(self, app):
+        """注册 Flask after_request 钩子"""
+        from flask import request
+
+        @app.after_request
+        def compress_response(response):
+            try:
+                return self._compress_flask_response(response, request.headers.get('Accept-Encoding'))
+            except Exception as e:
+                logger.warning(f"Response compression skipped: {str(e)}")
+                return response
+
+    def _compress_flask_response(self, response, accept_encoding):
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return response
+        if 'Content-Encoding' in response.headers or not self.is_compressible(response.mimetype):
+            return response
+        # 流式响应（NDJSON/CSV 导出等）不缓冲；send_file 的文件响应可以读入
+        if response.is_streamed and not response.direct_passthrough:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding(accept_encoding)
+        if encoding is None:
+            return response
+        content_length = response.content_length
+        if content_length is not None and content_length < self.min_size:
+            return response
+
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        etag, _ = response.get_etag()
+        response.set_data(self.compress(data, encoding, etag))
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
@@ -4,6 +4,8 @@ import io
 import logging
 from typing import Tuple, Optional, Dict, Any
 
+from metrics import timed_stage
+
 logger = logging.getLogger(__name__)
 
 class ImageValidator:
@@ -22,19 +24,22 @@ class ImageValidator:
     MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
     
     @classmethod
-    def validate_image(cls, file_data: bytes) -> Dict[str, Any]:
+    @timed_stage('image_decode')
+    def validate_image(cls, file_data: bytes, file_size: Optional[int] = None) -> Dict[str, Any]:
         """
         验证图片是否符合要求
         
         Args:
-            file_data: 图片文件的二进制数据
+            file_data: 图片文件的二进制数据（只需文件头即可读出格式和尺寸，可为 ranged GET 读取的开头部分）
+            file_size: 文件总大小，file_data 不是完整文件时传入
             
         Returns:
             包含验证结果的字典
         """
         try:
             # 检查文件大小
-            file_size = len(file_data)
+            if file_size is None:
+                file_size = len(file_data)
             if file_size > cls.MAX_FILE_SIZE:
                 return {
                     'valid': False,
@@ -109,6 +114,7 @@ class ImageValidator:
             return None
     
     @classmethod
+    @timed_stage('image_encode')
     def compress_image(cls, file_data: bytes, quality: int = 85) -> bytes:
         """
         压缩图片
@@ -143,6 +149,7 @@ class ImageValidator:
             return file_data  # 返回原始数据
     
     @classmethod
+    @timed_stage('image_encode')
     def resize_image_if_needed(cls, file_data: bytes) -> bytes:
         """
         如果图片超过最大尺寸，按比例缩小
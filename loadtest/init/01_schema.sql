@@ -0,0 +1,196 @@
+-- 压测用数据库结构（合并了 tag_definitions.sql / reference_images.sql 中的建表和后续 ALTER，字段与线上一致）
+-- 仅供 docker-compose 的 loadtest profile 初始化空库使用
+-- 注：tag_definitions.search_text 未包含（array_to_string 不是 IMMUTABLE，无法作为生成列，且接口未使用）
+
+CREATE EXTENSION IF NOT EXISTS vector;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE SCHEMA IF NOT EXISTS viba;
+
+CREATE TABLE viba.tag_definitions (
+    id BIGSERIAL PRIMARY KEY,
+    tag_type VARCHAR(50) NOT NULL,
+    tag_name VARCHAR(100) NOT NULL,
+    tag_name_cn VARCHAR(100) NOT NULL,
+    aliases TEXT[],
+    parent_tag_id BIGINT,
+    level INTEGER NOT NULL DEFAULT 1,
+    path TEXT,
+    level1_code VARCHAR(2),
+    level2_code VARCHAR(2),
+    level3_code VARCHAR(2),
+    level4_code VARCHAR(8),
+    full_code VARCHAR(14) GENERATED ALWAYS AS (
+         COALESCE(level1_code, '00') ||
+         COALESCE(level2_code, '00') ||
+         COALESCE(level3_code, '00') ||
+         COALESCE(level4_code, '00000000')
+     ) STORED,
+    description TEXT,
+    embedding vector(384),
+    is_active BOOLEAN DEFAULT TRUE,
+    is_leaf BOOLEAN DEFAULT TRUE,
+    attributes JSONB,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE(tag_type, tag_name),
+    FOREIGN KEY (parent_tag_id) REFERENCES viba.tag_definitions(id)
+);
+
+CREATE INDEX idx_tag_def_type ON viba.tag_definitions(tag_type);
+CREATE INDEX idx_tag_def_parent ON viba.tag_definitions(parent_tag_id);
+CREATE INDEX idx_tag_def_active ON viba.tag_definitions(is_active) WHERE is_active = TRUE;
+
+CREATE TABLE viba.themes (
+    id BIGSERIAL PRIMARY KEY,
+    unique_id UUID DEFAULT gen_random_uuid() UNIQUE NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT,
+    cultural_insights TEXT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE viba.ref_images_to_themes (
+    ref_image_id UUID NOT NULL,
+    theme_id UUID NOT NULL,
+    PRIMARY KEY (ref_image_id, theme_id)
+);
+
+CREATE TABLE viba.reference_images (
+    id BIGSERIAL PRIMARY KEY,
+    unique_id UUID DEFAULT gen_random_uuid() UNIQUE NOT NULL,
+    reference_image_url TEXT NOT NULL,
+    reference_type INTEGER NOT NULL,
+    gen_pose_images TEXT[],
+    gen_pose_description TEXT,
+    gen_product_images TEXT[],
+    gen_product_description TEXT,
+    gen_occasion_images TEXT[],
+    gen_occasion_description TEXT,
+    gen_composition_images TEXT[],
+    gen_composition_description TEXT,
+    gen_style_images TEXT[],
+    gen_style_description TEXT,
+    gen_content_prompt TEXT,
+    gen_ml_model_source TEXT,
+    product_item_ids UUID[],
+    can_be_used_for_face_switching boolean,
+    pose_description TEXT,
+    scene_description TEXT,
+    product_type_tag_ids BIGINT[],
+    style_tag_ids BIGINT[],
+    occasion_tag_ids BIGINT[],
+    silhouette_tag_ids BIGINT[],
+    model_attribute_tag_ids BIGINT[],
+    fabric_tag_ids BIGINT[],
+    pose_tag_ids BIGINT[],
+    composition_tag_ids BIGINT[],
+    outfit_details JSONB,
+    gen_content_embedding vector(384),
+    gen_pose_embedding vector(384),
+    gen_product_embedding vector(384),
+    gen_occasion_embedding vector(384),
+    gen_composition_embedding vector(384),
+    pose_embedding vector(384),
+    scene_embedding vector(384),
+    search_text TEXT GENERATED ALWAYS AS (
+        COALESCE(gen_pose_description, '') || ' ' ||
+        COALESCE(gen_product_description, '') || ' ' ||
+        COALESCE(gen_occasion_description, '') || ' ' ||
+        COALESCE(gen_composition_description, '') || ' ' ||
+        COALESCE(gen_style_description, '') || ' ' ||
+        COALESCE(pose_description, '') || ' ' ||
+        COALESCE(scene_description, '') || ' ' ||
+        COALESCE(gen_content_prompt, '')
+    ) STORED,
+    search_tsv tsvector GENERATED ALWAYS AS (
+        to_tsvector('simple',
+            COALESCE(gen_pose_description, '') || ' ' ||
+            COALESCE(gen_product_description, '') || ' ' ||
+            COALESCE(gen_occasion_description, '') || ' ' ||
+            COALESCE(gen_composition_description, '') || ' ' ||
+            COALESCE(gen_style_description, '') || ' ' ||
+            COALESCE(pose_description, '') || ' ' ||
+            COALESCE(scene_description, '') || ' ' ||
+            COALESCE(gen_content_prompt, '')
+        )
+    ) STORED,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX idx_ref_content_embedding ON viba.reference_images USING ivfflat (gen_content_embedding vector_cosine_ops) WITH (lists = 100);
+CREATE INDEX idx_ref_pose_embedding ON viba.reference_images USING ivfflat (pose_embedding vector_cosine_ops) WITH (lists = 100);
+CREATE INDEX idx_ref_scene_embedding ON viba.reference_images USING ivfflat (scene_embedding vector_cosine_ops) WITH (lists = 100);
+
+CREATE INDEX idx_ref_pose_tags ON viba.reference_images USING GIN(pose_tag_ids);
+CREATE INDEX idx_ref_occasion_tags ON viba.reference_images USING GIN(occasion_tag_ids);
+CREATE INDEX idx_ref_product_type_tags ON viba.reference_images USING GIN(product_type_tag_ids);
+CREATE INDEX idx_ref_model_attr_tags ON viba.reference_images USING GIN(model_attribute_tag_ids);
+CREATE INDEX idx_ref_fabric_tags ON viba.reference_images USING GIN(fabric_tag_ids);
+CREATE INDEX idx_ref_silhouette_tags ON viba.reference_images USING GIN(silhouette_tag_ids);
+CREATE INDEX idx_ref_style_tags ON viba.reference_images USING GIN(style_tag_ids);
+CREATE INDEX idx_ref_composition_tags ON viba.reference_images USING GIN(composition_tag_ids);
+
+CREATE INDEX idx_ref_type ON viba.reference_images(reference_type);
+CREATE INDEX idx_ref_created_at_id ON viba.reference_images(created_at DESC, id DESC);
+CREATE INDEX idx_ref_search_tsv ON viba.reference_images USING GIN(search_tsv);
+CREATE INDEX idx_ref_search_text_trgm ON viba.reference_images USING GIN(search_text gin_trgm_ops);
+
+-- 标签/主题变更通知（同 tag_definitions.sql），压测时修改标签可观察缓存即时刷新
+CREATE OR REPLACE FUNCTION viba.notify_cache_invalidation() RETURNS trigger AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN
+        PERFORM pg_notify('viba_cache_invalidation', json_build_object('table', TG_TABLE_NAME)::text);
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('viba_cache_invalidation',
+            json_build_object('table', TG_TABLE_NAME, 'tag_type', OLD.tag_type)::text);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('viba_cache_invalidation',
+            json_build_object('table', TG_TABLE_NAME, 'tag_type', NEW.tag_type)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_tag_def_notify
+    AFTER INSERT OR UPDATE OR DELETE ON viba.tag_definitions
+    FOR EACH ROW EXECUTE FUNCTION viba.notify_cache_invalidation();
+CREATE TRIGGER trg_tag_def_truncate_notify
+    AFTER TRUNCATE ON viba.tag_definitions
+    FOR EACH STATEMENT EXECUTE FUNCTION viba.notify_cache_invalidation();
+CREATE TRIGGER trg_themes_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON viba.themes
+    FOR EACH STATEMENT EXECUTE FUNCTION viba.notify_cache_invalidation();
+
+CREATE OR REPLACE FUNCTION viba.touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_tag_def_touch_updated_at
+    BEFORE UPDATE ON viba.tag_definitions
+    FOR EACH ROW EXECUTE FUNCTION viba.touch_updated_at();
+
+CREATE TRIGGER trg_ref_touch_updated_at
+    BEFORE UPDATE ON viba.reference_images
+    FOR EACH ROW EXECUTE FUNCTION viba.touch_updated_at();
+
+CREATE TABLE viba.uploaded_images (
+    sha256 CHAR(64) NOT NULL,
+    image_type VARCHAR(50) NOT NULL,
+    url TEXT NOT NULL,
+    s3_key TEXT,
+    width INTEGER,
+    height INTEGER,
+    byte_size BIGINT,
+    content_type VARCHAR(100),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (sha256, image_type)
+);
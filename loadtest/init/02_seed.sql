@@ -0,0 +1,65 @@
+-- 压测用合成数据：标签体系、主题和一批已有标注（规模可按需调整）
+
+-- 多级标签：每种类型 10 个一级 × 8 个二级 × 5 个三级
+DO $$
+DECLARE
+    tag_type_name TEXT;
+    l1 INT; l2 INT; l3 INT;
+    l1_id BIGINT; l2_id BIGINT;
+BEGIN
+    FOREACH tag_type_name IN ARRAY ARRAY['occasion', 'style', 'product_type', 'silhouette'] LOOP
+        FOR l1 IN 1..10 LOOP
+            INSERT INTO viba.tag_definitions (tag_type, tag_name, tag_name_cn, level, level1_code, is_leaf)
+            VALUES (tag_type_name, format('%s_%s', tag_type_name, l1), format('%s%s', tag_type_name, l1), 1, lpad(l1::text, 2, '0'), FALSE)
+            RETURNING id INTO l1_id;
+            FOR l2 IN 1..8 LOOP
+                INSERT INTO viba.tag_definitions (tag_type, tag_name, tag_name_cn, parent_tag_id, level, level1_code, level2_code, is_leaf)
+                VALUES (tag_type_name, format('%s_%s_%s', tag_type_name, l1, l2), format('%s%s-%s', tag_type_name, l1, l2), l1_id, 2,
+                        lpad(l1::text, 2, '0'), lpad(l2::text, 2, '0'), FALSE)
+                RETURNING id INTO l2_id;
+                FOR l3 IN 1..5 LOOP
+                    INSERT INTO viba.tag_definitions (tag_type, tag_name, tag_name_cn, parent_tag_id, level, level1_code, level2_code, level3_code, is_leaf)
+                    VALUES (tag_type_name, format('%s_%s_%s_%s', tag_type_name, l1, l2, l3), format('%s%s-%s-%s', tag_type_name, l1, l2, l3), l2_id, 3,
+                            lpad(l1::text, 2, '0'), lpad(l2::text, 2, '0'), lpad(l3::text, 2, '0'), TRUE);
+                END LOOP;
+            END LOOP;
+        END LOOP;
+    END LOOP;
+END $$;
+
+-- 单级标签：每种类型 30 个
+INSERT INTO viba.tag_definitions (tag_type, tag_name, tag_name_cn, level, level1_code, is_leaf)
+SELECT tag_type_name, format('%s_%s', tag_type_name, n), format('%s%s', tag_type_name, n), 1, lpad(n::text, 2, '0'), TRUE
+FROM unnest(ARRAY[
+    'season', 'pose', 'model_race', 'model_age', 'model_gender', 'model_fit', 'model_attribute', 'gender',
+    'fabric', 'color', 'composition_angle', 'composition_shot', 'composition_position', 'composition_bodyratio'
+]) AS tag_type_name
+CROSS JOIN generate_series(1, 30) AS n;
+
+INSERT INTO viba.themes (title, description)
+SELECT format('主题 %s', n), format('压测主题 %s', n) FROM generate_series(1, 20) AS n;
+
+-- 已有标注：让搜索、分面和标签计数接口面对有规模的数据
+INSERT INTO viba.reference_images (
+    reference_image_url, reference_type, gen_content_prompt, gen_ml_model_source,
+    pose_description, scene_description, can_be_used_for_face_switching,
+    style_tag_ids, occasion_tag_ids, product_type_tag_ids, pose_tag_ids, fabric_tag_ids,
+    created_at
+)
+SELECT
+    format('https://loadtest.invalid/reference_images/%s.jpg', n),
+    CASE WHEN n % 2 = 0 THEN 1 ELSE 2 END,
+    CASE WHEN n % 2 = 0 THEN format('模特 街拍 %s 夏季 连衣裙', n) END,
+    CASE WHEN n % 2 = 0 THEN 'loadtest' END,
+    CASE WHEN n % 2 = 1 THEN format('站立 侧身 %s', n) END,
+    CASE WHEN n % 2 = 1 THEN format('城市 街道 %s', n) END,
+    CASE WHEN n % 2 = 1 THEN n % 3 = 0 END,
+    (SELECT array_agg(id) FROM (SELECT id FROM viba.tag_definitions WHERE tag_type = 'style' ORDER BY random() + n * 0 LIMIT 3) s),
+    (SELECT array_agg(id) FROM (SELECT id FROM viba.tag_definitions WHERE tag_type = 'occasion' ORDER BY random() + n * 0 LIMIT 3) s),
+    (SELECT array_agg(id) FROM (SELECT id FROM viba.tag_definitions WHERE tag_type = 'product_type' ORDER BY random() + n * 0 LIMIT 3) s),
+    (SELECT array_agg(id) FROM (SELECT id FROM viba.tag_definitions WHERE tag_type = 'pose' ORDER BY random() + n * 0 LIMIT 1) s),
+    (SELECT array_agg(id) FROM (SELECT id FROM viba.tag_definitions WHERE tag_type = 'fabric' ORDER BY random() + n * 0 LIMIT 2) s),
+    NOW() - (n || ' minutes')::interval
+FROM generate_series(1, 20000) AS n;
+
+ANALYZE;
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# run_loadtest.py - 回放标注员会话的端到端压测脚本（仅依赖标准库 + Pillow）
+"""
+用法:
+    python loadtest/run_loadtest.py --base-url http://localhost:5002 --users 20 --duration 120 --label w3t1
+    python loadtest/run_loadtest.py --summarize loadtest/results/*.json
+
+每个虚拟用户按真实标注流程循环:
+    1. 打开页面: GET /api/tags/all
+    2. 上传参考图（及若干张生成参考图）: POST /api/upload-image
+    3. 按返回的标签体系随机选标签，提交标注: POST /api/reference-images
+各步骤之间有随机思考时间（指数分布，均值 --think-time 秒）。
+
+结果按接口输出吞吐和 p50/p95/p99 延迟，写为 JSON（默认 loadtest/results/<时间>_<label>.json），
+--summarize 把多次运行（如不同 worker/thread 配置）汇总成一张表。
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ENDPOINTS = ('GET /api/tags/all', 'POST /api/upload-image', 'POST /api/reference-images')
+
+# 生成图的参考图类型（对应 s3_uploader.path_templates）
+PROMPT_IMAGE_TYPES = ('prompt_pose', 'prompt_outfit', 'prompt_scene', 'prompt_composition', 'prompt_style')
+
+
+def make_portrait_jpeg(width=1080, height=1440, seed=7):
+    """生成满足竖屏校验的 JPEG（低分辨率噪声放大，压缩率接近真实照片）"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    small_w, small_h = width // 16 + 1, height // 16 + 1
+    base = Image.frombytes('RGB', (small_w, small_h),
+                           bytes(rng.randrange(256) for _ in range(small_w * small_h * 3)))
+    img = base.resize((width, height), Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def encode_multipart(fields, files):
+    """
+    编码 multipart/form-data 请求体
+
+    Args:
+        fields: {name: value}
+        files: {name: (filename, content_type, bytes)}
+
+    Returns:
+        (body, content_type)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, (filename, content_type, data) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class Recorder:
+    """线程安全地收集每次请求的 (接口, 耗时, 是否成功)"""
+
+    def __init__(self):
+        self.samples = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.error_examples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok, detail=None):
+        with self._lock:
+            self.samples[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+                self.error_examples.setdefault(endpoint, detail)
+
+
+def percentile(sorted_values, pct):
+    """最近秩法百分位（输入需已排序）"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class AnnotatorSession:
+    """一个虚拟标注员：循环执行 打开页面 -> 上传图片 -> 提交标注"""
+
+    def __init__(self, args, image_data, recorder, stop_event, seed):
+        self.args = args
+        self.base_url = args.base_url.rstrip('/')
+        self.image_data = image_data
+        self.recorder = recorder
+        self.stop_event = stop_event
+        self.rng = random.Random(seed)
+        self.tag_pools = {}
+
+    def request(self, endpoint, path, body=None, content_type=None):
+        """发送请求并记录耗时，返回解析后的 JSON（失败时返回 None）"""
+        method = endpoint.split(' ', 1)[0]
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        if content_type:
+            req.add_header('Content-Type', content_type)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.args.timeout) as resp:
+                payload = resp.read()
+            elapsed = time.perf_counter() - start
+            result = json.loads(payload)
+            ok = bool(result.get('success'))
+            self.recorder.record(endpoint, elapsed, ok, None if ok else result.get('error'))
+            return result if ok else None
+        except urllib.error.HTTPError as e:
+            detail = e.read()[:300].decode('utf-8', 'replace')
+            self.recorder.record(endpoint, time.perf_counter() - start, False, f'HTTP {e.code}: {detail}')
+        except Exception as e:
+            self.recorder.record(endpoint, time.perf_counter() - start, False, str(e))
+        return None
+
+    def think(self):
+        if self.args.think_time > 0:
+            self.stop_event.wait(self.rng.expovariate(1 / self.args.think_time))
+
+    def load_tags(self):
+        result = self.request('GET /api/tags/all', '/api/tags/all')
+        if not result:
+            return
+        data = result['data']
+        pools = {}
+        # 多级标签只选叶子节点，与前端级联选择器一致
+        for tag_type, structure in data.get('multi_level', {}).items():
+            pools[tag_type] = [tag['id'] for tag in structure.get('flat', {}).values() if tag.get('is_leaf')]
+        for tag_type, structure in data.get('single_level', {}).items():
+            pools[tag_type] = [tag['id'] for tag in structure.get('list', [])]
+        self.tag_pools = pools
+
+    def pick(self, tag_type, count):
+        pool = self.tag_pools.get(tag_type) or []
+        return self.rng.sample(pool, min(count, len(pool)))
+
+    def upload(self, image_type):
+        body, content_type = encode_multipart(
+            {'image_type': image_type},
+            {'file': ('loadtest.jpg', 'image/jpeg', self.image_data)}
+        )
+        result = self.request('POST /api/upload-image', '/api/upload-image', body, content_type)
+        return result['data']['url'] if result else None
+
+    def build_annotation(self, reference_url, prompt_urls):
+        model_attribute_ids = []
+        for tag_type in ('model_race', 'model_age', 'model_gender', 'model_fit'):
+            model_attribute_ids.extend(self.pick(tag_type, 1))
+        composition_ids = []
+        for tag_type in ('composition_angle', 'composition_shot', 'composition_position', 'composition_bodyratio'):
+            composition_ids.extend(self.pick(tag_type, 1))
+
+        payload = {
+            'reference_image_url': reference_url,
+            'style_tag_ids': self.pick('style', 2),
+            'occasion_tag_ids': self.pick('occasion', 2),
+            'pose_tag_ids': self.pick('pose', 1),
+            'model_attribute_tag_ids': model_attribute_ids,
+            'composition_tag_ids': composition_ids,
+            'outfit_details': [
+                {
+                    'product_type_tag_ids': self.pick('product_type', 1),
+                    'fabric_tag_id': (self.pick('fabric', 1) or [None])[0],
+                    'silhouette_tag_id': self.pick('silhouette', 2)
+                }
+                for _ in range(self.rng.randint(1, 3))
+            ]
+        }
+        if prompt_urls:
+            # 生成图：带生成参考图和文字描述（触发向量嵌入）
+            payload.update({
+                'reference_type': 1,
+                'gen_content_prompt': f'压测 生成图 {uuid.uuid4().hex[:8]} 街拍 连衣裙',
+                'gen_ml_model_source': 'loadtest',
+                'gen_pose_images': prompt_urls[:1],
+                'gen_pose_description': '站立 侧身 双手自然下垂',
+                'gen_style_images': prompt_urls[1:],
+                'gen_style_description': '简约 通勤'
+            })
+        else:
+            payload.update({
+                'reference_type': 2,
+                'can_be_used_for_face_switching': self.rng.random() < 0.5,
+                'pose_description': '站立 正面',
+                'scene_description': '城市 街道 白天'
+            })
+        return payload
+
+    def run(self):
+        self.load_tags()
+        while not self.stop_event.is_set():
+            self.think()
+            reference_url = self.upload('reference_image')
+            prompt_urls = []
+            if self.rng.random() < self.args.generated_ratio:
+                for _ in range(self.args.prompt_images):
+                    url = self.upload(self.rng.choice(PROMPT_IMAGE_TYPES))
+                    if url:
+                        prompt_urls.append(url)
+            if self.stop_event.is_set() or not reference_url or not self.tag_pools:
+                if not self.tag_pools:
+                    self.load_tags()
+                continue
+            self.think()
+            self.request(
+                'POST /api/reference-images', '/api/reference-images',
+                json.dumps(self.build_annotation(reference_url, prompt_urls)).encode('utf-8'),
+                'application/json'
+            )
+            # 标注员偶尔刷新页面
+            if self.rng.random() < self.args.reload_ratio:
+                self.load_tags()
+
+
+def summarize_run(recorder, elapsed):
+    """按接口汇总吞吐、错误数和延迟百分位（毫秒）"""
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        values = sorted(recorder.samples[endpoint])
+        count = len(values)
+        endpoints[endpoint] = {
+            'count': count,
+            'errors': recorder.errors[endpoint],
+            'throughput_rps': round(count / elapsed, 3) if elapsed else 0.0,
+            'mean_ms': round(sum(values) / count * 1000, 2) if count else None,
+            'p50_ms': round(percentile(values, 50) * 1000, 2) if count else None,
+            'p95_ms': round(percentile(values, 95) * 1000, 2) if count else None,
+            'p99_ms': round(percentile(values, 99) * 1000, 2) if count else None,
+            'max_ms': round(values[-1] * 1000, 2) if count else None,
+            'first_error': recorder.error_examples.get(endpoint)
+        }
+    return endpoints
+
+
+def format_table(rows):
+    """rows: [(label, endpoint, stats)]"""
+    header = f"{'label':<14} {'endpoint':<28} {'count':>7} {'err':>5} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9}"
+    lines = [header, '-' * len(header)]
+
+    def fmt(value):
+        return f'{value:.1f}' if value is not None else '-'
+
+    for label, endpoint, stats in rows:
+        lines.append(
+            f"{label:<14} {endpoint:<28} {stats['count']:>7} {stats['errors']:>5} "
+            f"{stats['throughput_rps']:>8.2f} {fmt(stats['p50_ms']):>9} {fmt(stats['p95_ms']):>9} {fmt(stats['p99_ms']):>9}"
+        )
+    return '\n'.join(lines)
+
+
+def run(args):
+    if args.image:
+        with open(args.image, 'rb') as f:
+            image_data = f.read()
+    else:
+        image_data = make_portrait_jpeg()
+
+    recorder = Recorder()
+    stop_event = threading.Event()
+    sessions = [
+        AnnotatorSession(args, image_data, recorder, stop_event, seed=args.seed + i)
+        for i in range(args.users)
+    ]
+    threads = []
+    start = time.perf_counter()
+    for i, session in enumerate(sessions):
+        thread = threading.Thread(target=session.run, name=f'annotator-{i}', daemon=True)
+        thread.start()
+        threads.append(thread)
+        # 线性爬坡，避免所有用户同时打开页面
+        if args.ramp_up > 0 and i < len(sessions) - 1:
+            time.sleep(args.ramp_up / len(sessions))
+
+    time.sleep(max(args.duration - (time.perf_counter() - start), 0))
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'label': args.label,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'base_url': args.base_url,
+        'config': {
+            'users': args.users,
+            'duration': args.duration,
+            'ramp_up': args.ramp_up,
+            'think_time': args.think_time,
+            'generated_ratio': args.generated_ratio,
+            'prompt_images': args.prompt_images,
+            'image_bytes': len(image_data),
+            'seed': args.seed,
+            # 由 run_matrix.sh 传入，便于汇总时区分
+            'gunicorn_workers': os.environ.get('GUNICORN_WORKERS'),
+            'gunicorn_threads': os.environ.get('GUNICORN_THREADS'),
+            'gunicorn_app': os.environ.get('GUNICORN_APP')
+        },
+        'elapsed_seconds': round(elapsed, 3),
+        'endpoints': summarize_run(recorder, elapsed)
+    }
+
+    output = args.output or os.path.join(
+        LOADTEST_DIR, 'results', f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{args.label}.json"
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(format_table([(args.label, endpoint, stats) for endpoint, stats in result['endpoints'].items()]))
+    for endpoint, stats in result['endpoints'].items():
+        if stats['first_error']:
+            print(f"first error for {endpoint}: {stats['first_error']}")
+    print(f"\nresults written to {output}")
+    return result
+
+
+def summarize_files(paths):
+    rows = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            result = json.load(f)
+        for endpoint, stats in result['endpoints'].items():
+            rows.append((result.get('label') or os.path.basename(path), endpoint, stats))
+    rows.sort(key=lambda row: (row[1], row[0]))
+    print(format_table(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay annotator sessions against the backend')
+    parser.add_argument('--base-url', default=os.environ.get('LOADTEST_BASE_URL', 'http://localhost:5002'))
+    parser.add_argument('--users', type=int, default=10, help='并发虚拟标注员数')
+    parser.add_argument('--duration', type=float, default=60, help='运行时长（秒，含爬坡）')
+    parser.add_argument('--ramp-up', type=float, default=10, help='爬坡时长（秒）')
+    parser.add_argument('--think-time', type=float, default=1.0, help='步骤间平均思考时间（秒），0 表示不等待')
+    parser.add_argument('--generated-ratio', type=float, default=0.5, help='生成图（带生成参考图）占比')
+    parser.add_argument('--prompt-images', type=int, default=2, help='每张生成图附带的生成参考图数量')
+    parser.add_argument('--reload-ratio', type=float, default=0.1, help='提交后刷新页面（重新拉取标签）的概率')
+    parser.add_argument('--image', help='上传用的图片文件（默认生成 1080x1440 JPEG）')
+    parser.add_argument('--timeout', type=float, default=60, help='单次请求超时（秒）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='run', help='本次运行的标签（如 w3t4）')
+    parser.add_argument('--output', help='结果文件路径')
+    parser.add_argument('--summarize', nargs='+', metavar='RESULT', help='汇总已有结果文件，不发起请求')
+    args = parser.parse_args()
+
+    if args.summarize:
+        summarize_files(args.summarize)
+        return 0
+    run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
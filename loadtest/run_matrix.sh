@@ -0,0 +1,69 @@
+#!/usr/bin/env bash
+# run_matrix.sh - 按不同 gunicorn worker/thread 组合依次压测，最后汇总
+#
+# 用法:
+#   loadtest/run_matrix.sh                                   # 默认 WORKERS="1 2 4" THREADS="1 4"
+#   WORKERS="2 4 8" THREADS="1 2 4" USERS=40 DURATION=180 loadtest/run_matrix.sh
+#   MODES="wsgi asgi" WORKERS="1 3" loadtest/run_matrix.sh    # 同时对比异步（ASGI）模式
+#
+# 依赖 docker compose 的 loadtest profile（本地 pgvector Postgres + MinIO），
+# 每个组合都会重建 loadtest-app 容器，数据库和对象存储在组合之间保留。
+set -euo pipefail
+
+cd "$(dirname "$0")/.."
+
+WORKERS="${WORKERS:-1 2 4}"
+THREADS="${THREADS:-1 4}"
+MODES="${MODES:-wsgi}"
+USERS="${USERS:-20}"
+DURATION="${DURATION:-120}"
+RAMP_UP="${RAMP_UP:-15}"
+THINK_TIME="${THINK_TIME:-1.0}"
+BASE_URL="${LOADTEST_BASE_URL:-http://localhost:5002}"
+RUN_ID="$(date +%Y%m%d_%H%M%S)"
+RESULT_DIR="loadtest/results/${RUN_ID}"
+
+mkdir -p "${RESULT_DIR}"
+docker compose --profile loadtest up -d loadtest-db loadtest-s3 loadtest-s3-init
+
+run_case() {
+    local label="$1"
+    echo "==> ${label}: starting app (${GUNICORN_WORKERS} workers, ${GUNICORN_THREADS} threads, ${GUNICORN_APP})"
+    docker compose --profile loadtest up -d --force-recreate --no-deps loadtest-app
+
+    # 等待健康检查通过（模型加载可能较慢）
+    for _ in $(seq 1 120); do
+        if curl -fsS "${BASE_URL}/api/health" > /dev/null 2>&1; then
+            break
+        fi
+        sleep 2
+    done
+
+    python loadtest/run_loadtest.py \
+        --base-url "${BASE_URL}" \
+        --users "${USERS}" \
+        --duration "${DURATION}" \
+        --ramp-up "${RAMP_UP}" \
+        --think-time "${THINK_TIME}" \
+        --label "${label}" \
+        --output "${RESULT_DIR}/${label}.json"
+}
+
+for mode in ${MODES}; do
+    for workers in ${WORKERS}; do
+        export GUNICORN_WORKERS="${workers}"
+        if [ "${mode}" = "asgi" ]; then
+            # 异步 worker 不使用线程数
+            export GUNICORN_THREADS=1 GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker GUNICORN_APP=asgi_app:app
+            run_case "asgi_w${workers}"
+            continue
+        fi
+        for threads in ${THREADS}; do
+            export GUNICORN_THREADS="${threads}" GUNICORN_WORKER_CLASS=sync GUNICORN_APP=app:app
+            run_case "w${workers}t${threads}"
+        done
+    done
+done
+
+echo
+python loadtest/run_loadtest.py --summarize "${RESULT_DIR}"/*.json
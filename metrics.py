@@ -0,0 +1,321 @@
+# metrics.py - 轻量级耗时指标（Prometheus 文本格式，支持 gunicorn 多 worker 聚合）
+import atexit
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 默认直方图分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + body + '}'
+
+
+def _pid_alive(pid: int) -> bool:
+    """进程是否仍存在（无权限发信号也视为存在）"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    进程内的计数器和直方图
+
+    每个 worker 把自己的快照定期写到共享目录（{directory}/{pid}.json），
+    /metrics 由任一 worker 读取目录下所有快照求和后输出，因此结果覆盖全部 worker。
+    worker 正常退出时删除自己的快照；被强制杀掉的 worker 留下的快照在汇总时按 pid 判断并清理。
+    未配置目录时只输出当前进程的数据。
+    """
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._definitions: Dict[str, Dict] = {}
+        self._counters: Dict[Tuple[str, LabelKey], float] = {}
+        # (name, labels) -> [各分桶计数..., sum, count]
+        self._histograms: Dict[Tuple[str, LabelKey], List[float]] = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        # 已注册退出清理的进程（fork 出的 worker 需要各自注册）
+        self._cleanup_pid: Optional[int] = None
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name: str, help_text: str):
+        """声明计数器"""
+        self._definitions[name] = {'type': 'counter', 'help': help_text}
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """声明直方图"""
+        self._definitions[name] = {'type': 'histogram', 'help': help_text, 'buckets': list(buckets)}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """计数器累加"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """直方图记录一个观测值"""
+        buckets = self._definitions[name]['buckets']
+        key = (name, _label_key(labels))
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = [0] * (len(buckets) + 2)
+                self._histograms[key] = state
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self) -> Dict:
+        """当前进程数据的可序列化快照"""
+        with self._lock:
+            return {
+                'counters': [[name, list(map(list, labels)), value]
+                             for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(map(list, labels)), list(state)]
+                               for (name, labels), state in self._histograms.items()]
+            }
+
+    def flush(self, force: bool = False):
+        """把快照写到共享目录（按 flush_interval 节流，原子替换）"""
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        pid = os.getpid()
+        if self._cleanup_pid != pid:
+            self._cleanup_pid = pid
+            atexit.register(self.remove_snapshot)
+
+        path = os.path.join(self.directory, f"{pid}.json")
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to flush metrics: {str(e)}")
+
+    def remove_snapshot(self):
+        """删除当前进程的快照文件（进程退出时调用）"""
+        if not self.directory or self._cleanup_pid != os.getpid():
+            return
+        try:
+            os.remove(os.path.join(self.directory, f"{os.getpid()}.json"))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to remove metrics snapshot: {str(e)}")
+
+    def _collect_snapshots(self) -> List[Dict]:
+        if not self.directory:
+            return [self.snapshot()]
+
+        self.flush(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name.isdigit() and not _pid_alive(int(name)):
+                # 已退出（未能自行清理）的 worker，删除其快照
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, 'r') as f:
+                    snapshots.append(json.load(f))
+            except Exception as e:
+                # 其他 worker 正在替换文件等情况，跳过本次
+                logger.debug(f"Skipping metrics snapshot {path}: {str(e)}")
+        return snapshots
+
+    def render(self) -> str:
+        """聚合所有 worker 的快照并输出 Prometheus 文本格式"""
+        counters: Dict[Tuple[str, LabelKey], float] = {}
+        histograms: Dict[Tuple[str, LabelKey], List[float]] = {}
+
+        for snapshot in self._collect_snapshots():
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, state in snapshot.get('histograms', []):
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                if merged is None or len(merged) != len(state):
+                    histograms[key] = list(state)
+                else:
+                    histograms[key] = [a + b for a, b in zip(merged, state)]
+
+        lines = []
+        for name, definition in sorted(self._definitions.items()):
+            lines.append(f"# HELP {name} {definition['help']}")
+            lines.append(f"# TYPE {name} {definition['type']}")
+            if definition['type'] == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+            else:
+                bounds = definition['buckets'] + [float('inf')]
+                for (metric, labels), state in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    total_count = state[-1]
+                    for i, bound in enumerate(bounds):
+                        count = state[i] if i < len(bounds) - 1 else total_count
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_number(float(bound))))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(float(state[-2]))}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {total_count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(
+    directory=os.environ.get('METRICS_DIR') or None,
+    flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+)
+
+metrics.counter('viba_http_requests_total', 'HTTP requests by endpoint and status')
+metrics.histogram('viba_http_request_duration_seconds', 'HTTP request latency')
+metrics.histogram('viba_stage_duration_seconds', 'Time spent in each request stage (embedding, db, s3, image, ...)')
+metrics.counter('viba_db_queries_total', 'Database statements by operation')
+metrics.counter('viba_db_errors_total', 'Failed database statements by operation')
+metrics.histogram('viba_db_query_duration_seconds', 'Database statement latency by operation')
+metrics.histogram('viba_db_connect_duration_seconds', 'Database connection setup latency')
+metrics.counter('viba_s3_requests_total', 'S3 API calls by operation and HTTP status')
+metrics.counter('viba_s3_retries_total', 'S3 request retries by operation')
+metrics.histogram('viba_s3_request_duration_seconds', 'S3 API call latency by operation (including retries)')
+
+# 当前请求内各阶段的累计耗时 {stage: [seconds, count]}，不在请求内时为 None
+_request_timings: contextvars.ContextVar = contextvars.ContextVar('request_timings', default=None)
+# 阶段线程池中的线程会写同一个请求的耗时字典，读写都加锁
+_request_timings_lock = threading.Lock()
+
+
+def start_request():
+    """开始记录一个请求的阶段耗时，返回用于 finish_request 的 token"""
+    return _request_timings.set({})
+
+
+def finish_request(token) -> Dict[str, List[float]]:
+    """结束记录，返回 {stage: [seconds, count]}"""
+    timings = _request_timings.get() or {}
+    _request_timings.reset(token)
+    # 返回副本：被取消但仍在运行的阶段可能在请求结束后继续写入
+    with _request_timings_lock:
+        return {stage: list(entry) for stage, entry in timings.items()}
+
+
+def record_stage(stage: str, seconds: float):
+    """记录一次阶段耗时（直方图 + 当前请求的 Server-Timing）"""
+    metrics.observe('viba_stage_duration_seconds', seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        with _request_timings_lock:
+            entry = timings.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    """
+    统计代码块耗时
+
+    用法:
+        with timed_stage('embedding'):
+            model.encode(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def query_operation(query: str) -> str:
+    """SQL 的操作类型（首个关键字），用作指标标签"""
+    words = query.lstrip(' \t\n(').split(None, 1)
+    return words[0].lower() if words else 'unknown'
+
+
+def record_query(operation: str, seconds: float, error: bool = False):
+    """记录一次数据库语句"""
+    metrics.inc('viba_db_queries_total', operation=operation)
+    metrics.observe('viba_db_query_duration_seconds', seconds, operation=operation)
+    if error:
+        metrics.inc('viba_db_errors_total', operation=operation)
+    record_stage('db', seconds)
+
+
+def record_connect(seconds: float):
+    """记录一次数据库连接建立"""
+    metrics.observe('viba_db_connect_duration_seconds', seconds)
+    record_stage('db_connect', seconds)
+
+
+def record_s3_call(operation: str, seconds: float, status: str, retries: int = 0):
+    """记录一次 S3 API 调用（耗时包含重试和退避等待）"""
+    metrics.inc('viba_s3_requests_total', operation=operation, status=status)
+    metrics.observe('viba_s3_request_duration_seconds', seconds, operation=operation)
+    if retries:
+        metrics.inc('viba_s3_retries_total', retries, operation=operation)
+
+
+def format_server_timing(timings: Dict[str, List[float]], total_seconds: Optional[float] = None) -> str:
+    """
+    生成 Server-Timing 响应头，如 db;dur=12.3;desc="3 calls", total;dur=45.6
+
+    Args:
+        timings: finish_request 的返回值
+        total_seconds: 请求总耗时
+    """
+    parts = []
+    for stage, (seconds, count) in timings.items():
+        part = f"{stage};dur={seconds * 1000:.1f}"
+        if count > 1:
+            part += f';desc="{count} calls"'
+        parts.append(part)
+    if total_seconds is not None:
+        parts.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ', '.join(parts)
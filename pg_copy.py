@@ -0,0 +1,67 @@
+# pg_copy.py - PostgreSQL COPY 文本格式编码
+import json
+from typing import Any, List, Optional, Sequence
+
+from vector_codec import format_real_array, format_vector, pgvector_available
+
+# COPY 文本格式中的 NULL
+COPY_NULL = '\\N'
+
+
+def escape_copy_text(text: str) -> str:
+    """转义 COPY 文本格式中的特殊字符（反斜杠、制表符、换行）"""
+    return (text.replace('\\', '\\\\')
+                .replace('\t', '\\t')
+                .replace('\n', '\\n')
+                .replace('\r', '\\r'))
+
+
+def format_array_literal(values: Sequence[Any]) -> str:
+    """
+    将列表转换为 PostgreSQL 数组字面量，如 {"a","b"}
+
+    所有元素都加引号，由目标列类型（text[] / bigint[] / uuid[]）完成转换。
+    """
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append('NULL')
+        else:
+            text = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            elements.append(f'"{text}"')
+    return '{' + ','.join(elements) + '}'
+
+
+def format_copy_value(value: Any, kind: str = 'scalar') -> str:
+    """
+    将单个值编码为 COPY 文本格式的字段
+
+    Args:
+        value: Python值
+        kind: 'scalar' / 'array' / 'json' / 'vector'（vector 按 pgvector 或 real[] 文本编码）
+
+    Returns:
+        已转义的字段文本
+    """
+    if value is None:
+        return COPY_NULL
+
+    if kind == 'json':
+        text = json.dumps(value, ensure_ascii=False)
+    elif kind == 'vector':
+        # 未安装 pgvector 时向量列为 real[]
+        text = format_vector(value) if pgvector_available() else format_real_array(value)
+    elif kind == 'array':
+        text = format_array_literal(value)
+    elif isinstance(value, bool):
+        text = 't' if value else 'f'
+    else:
+        text = str(value)
+
+    return escape_copy_text(text)
+
+
+def format_copy_row(values: Sequence[Any], kinds: Optional[List[str]] = None) -> str:
+    """将一行数据编码为 COPY 文本格式（制表符分隔，换行结尾）"""
+    kinds = kinds or ['scalar'] * len(values)
+    return '\t'.join(format_copy_value(value, kind) for value, kind in zip(values, kinds)) + '\n'
@@ -0,0 +1,103 @@
+# pg_listener.py - PostgreSQL LISTEN/NOTIFY 监听线程（进程内缓存按数据库变更失效）
+import logging
+import os
+import select
+import threading
+from typing import Callable, Iterable, Optional
+
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+
+class PgNotifyListener:
+    """
+    后台线程 LISTEN 若干频道，收到 NOTIFY 后在本线程内调用 handler(channel, payload)
+
+    每个 gunicorn worker 各自持有一个专用连接（LISTEN 需要会话级连接，不能经过事务级连接池）。
+    连接断开后按 reconnect_delay 重连；断开期间的通知会丢失，所以每次（重新）连上后调用 on_connect，
+    由调用方整体失效缓存。start() 可重复调用，fork 后的子进程会重新启动自己的线程。
+    """
+
+    def __init__(self, connect: Callable, channels: Iterable[str],
+                 handler: Callable[[str, str], None],
+                 on_connect: Optional[Callable[[], None]] = None,
+                 reconnect_delay: float = 5.0, poll_timeout: float = 5.0):
+        """
+        Args:
+            connect: 返回新的 psycopg2 连接
+            channels: 监听的频道名
+            handler: 通知回调 handler(channel, payload)
+            on_connect: 每次连接（含重连）成功并开始监听后调用
+            reconnect_delay: 连接失败后的重试间隔（秒）
+            poll_timeout: 等待通知的超时（秒），也是 stop() 的最大响应延迟
+        """
+        self._connect = connect
+        self.channels = list(channels)
+        self._handler = handler
+        self._on_connect = on_connect
+        self._reconnect_delay = reconnect_delay
+        self._poll_timeout = poll_timeout
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self.connected = False
+
+    def start(self):
+        """启动监听线程（已在当前进程运行时不做任何事，可在每个请求前调用）"""
+        if self._running():
+            return
+        with self._lock:
+            if self._running():
+                return
+            self._pid = os.getpid()
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='pg-listener', daemon=True)
+            self._thread.start()
+
+    def _running(self) -> bool:
+        return self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                # connect 可能已执行过查询（如注册类型），先结束隐式事务再切换自动提交
+                conn.rollback()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    for channel in self.channels:
+                        cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                self.connected = True
+                logger.info(f"Listening for notifications on {', '.join(self.channels)}")
+                if self._on_connect:
+                    self._on_connect()
+                self._listen(conn)
+            except Exception as e:
+                logger.warning(f"Notification listener error: {str(e)}, reconnecting in {self._reconnect_delay}s")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop_event.wait(self._reconnect_delay)
+
+    def _listen(self, conn):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([conn], [], [], self._poll_timeout)
+            if not readable:
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                try:
+                    self._handler(notify.channel, notify.payload)
+                except Exception as e:
+                    logger.error(f"Notification handler error ({notify.channel}): {str(e)}")
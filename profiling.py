@@ -0,0 +1,226 @@
+# profiling.py - 慢查询记录与采样式性能分析（可在生产环境低采样率常开）
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('viba.slow_query')
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(query: str) -> str:
+    """
+    归一化 SQL，便于按语句模板聚合：折叠空白，字面量和参数占位符统一替换为 ?
+
+    Args:
+        query: 原始 SQL（参数化前的模板）
+
+    Returns:
+        归一化后的单行 SQL
+    """
+    text = _STRING_LITERAL.sub('?', query)
+    text = text.replace('%s', '?')
+    text = _NUMBER_LITERAL.sub('?', text)
+    text = _PLACEHOLDER_LIST.sub('?', text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def find_caller(skip_functions: Iterable[str] = ()) -> str:
+    """
+    查找发起查询的业务代码位置（跳过数据库封装层和 contextlib 的栈帧）
+
+    Returns:
+        'file.py:行号 in 函数名'
+    """
+    skip = set(skip_functions)
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        if filename not in ('profiling.py', 'contextlib.py') and code.co_name not in skip:
+            return f"{filename}:{frame.f_lineno} in {code.co_name}"
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryEvent:
+    """
+    一次数据库语句的观测数据，传给 Database 的 query observer
+
+    Attributes:
+        sql: 归一化后的 SQL
+        operation: 操作类型（select / insert / copy ...）
+        duration: 耗时（秒）
+        rows: 返回或影响的行数（未知时为 None）
+        error: 是否失败
+        caller: 发起查询的代码位置，首次读取时才遍历调用栈，
+            因此只能在观察者回调内（查询调用栈仍在时）读取
+    """
+
+    __slots__ = ('sql', 'operation', 'duration', 'rows', 'error', '_caller', '_skip_functions')
+
+    FIELDS = ('sql', 'operation', 'duration', 'rows', 'error', 'caller')
+
+    def __init__(self, sql: str, operation: str, duration: float, rows: Optional[int],
+                 error: bool, skip_functions: Tuple[str, ...] = ()):
+        self.sql = sql
+        self.operation = operation
+        self.duration = duration
+        self.rows = rows
+        self.error = error
+        self._caller: Optional[str] = None
+        self._skip_functions = skip_functions
+
+    @property
+    def caller(self) -> str:
+        if self._caller is None:
+            self._caller = find_caller(self._skip_functions)
+        return self._caller
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class SlowQueryLogger:
+    """记录超过阈值的查询（归一化 SQL、耗时、行数、调用位置，调用位置只对慢查询计算）"""
+
+    def __init__(self, threshold_ms: float):
+        self.threshold_ms = threshold_ms
+
+    def __call__(self, event: QueryEvent):
+        duration_ms = event.duration * 1000
+        if self.threshold_ms <= 0 or duration_ms < self.threshold_ms:
+            return
+        slow_query_logger.warning(
+            f"Slow query {duration_ms:.1f}ms rows={event.rows} caller={event.caller} "
+            f"error={event.error} sql={event.sql[:2000]}"
+        )
+
+
+def _fold_stack(frame) -> str:
+    """把栈帧转换为 flame graph 折叠格式（根在前，以 ; 分隔）"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    按请求的采样式性能分析器
+
+    按 sample_rate 抽取请求；被抽中的请求执行期间，后台线程每 interval 秒
+    采集一次该请求线程的调用栈。请求耗时超过 budget_ms 时把栈写为折叠格式文件
+    （{output_dir}/{时间}_{pid}_{标签}.folded），可直接用 flamegraph.pl / speedscope 打开。
+    未抽中的请求只有一次随机数判断的开销。
+    """
+
+    def __init__(self, output_dir: str, enabled: bool = False, sample_rate: float = 0.01,
+                 budget_ms: float = 1000, interval_ms: float = 10):
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.budget_ms = budget_ms
+        self.interval_ms = interval_ms
+        self._active: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        # 有新的采集请求时唤醒采样线程
+        self._wakeup = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+
+    def configure(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None,
+                  budget_ms: Optional[float] = None, interval_ms: Optional[float] = None):
+        """运行时调整参数（只影响当前进程）"""
+        if sample_rate is not None:
+            self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        if budget_ms is not None:
+            self.budget_ms = max(float(budget_ms), 0.0)
+        if interval_ms is not None:
+            self.interval_ms = max(float(interval_ms), 1.0)
+        if enabled is not None:
+            self.enabled = bool(enabled)
+
+    def status(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'budget_ms': self.budget_ms,
+            'interval_ms': self.interval_ms,
+            'output_dir': self.output_dir,
+            'active_requests': len(self._active)
+        }
+
+    def should_profile(self) -> bool:
+        return self.enabled and random.random() < self.sample_rate
+
+    def begin(self):
+        """开始采集当前线程"""
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def end(self, duration_seconds: float, label: str) -> Optional[str]:
+        """
+        结束采集当前线程，超过预算时写出折叠栈
+
+        Returns:
+            写出的文件路径，未超预算时返回 None
+        """
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+        if not stacks or duration_seconds * 1000 < self.budget_ms:
+            return None
+
+        safe_label = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_') or 'request'
+        filename = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{os.getpid()}_{safe_label}.folded"
+        path = os.path.join(self.output_dir, filename)
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"Profiled slow request {label} ({duration_seconds * 1000:.0f}ms) -> {path}")
+            return path
+        except Exception as e:
+            logger.warning(f"Failed to write profile {path}: {str(e)}")
+            return None
+
+    def _run(self):
+        """后台采样线程，没有被采集的请求时阻塞等待 begin 唤醒"""
+        own_id = threading.get_ident()
+        while True:
+            with self._wakeup:
+                while not self._active:
+                    self._wakeup.wait()
+            time.sleep(self.interval_ms / 1000)
+            with self._lock:
+                thread_ids = list(self._active)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+                stack = _fold_stack(frame)
+                with self._lock:
+                    counter = self._active.get(thread_id)
+                    if counter is not None:
+                        counter[stack] += 1
+            del frames
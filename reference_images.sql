@@ -137,4 +137,80 @@ ALTER TABLE viba.reference_images ADD COLUMN composition_tag_ids BIGINT[];
 
 ALTER INDEX idx_ref_scene_tags RENAME TO idx_ref_occasion_tags;
 ALTER INDEX idx_ref_outfit_type_tags RENAME TO idx_ref_product_type_tags;
-ALTER INDEX idx_ref_fit_tags RENAME TO idx_ref_silhouette_tags;
\ No newline at end of file
+ALTER INDEX idx_ref_fit_tags RENAME TO idx_ref_silhouette_tags;
+
+-- gen_content_embedding 改为原生 384 维存储（此前是把 384 维模型输出零填充到 768 维）
+-- 填充部分全为 0，截取前 384 维不会丢失任何信息，余弦距离也保持不变
+DROP INDEX IF EXISTS viba.idx_ref_content_embedding;
+ALTER TABLE viba.reference_images
+    ALTER COLUMN gen_content_embedding TYPE vector(384)
+    USING ((gen_content_embedding::real[])[1:384]::vector(384));
+CREATE INDEX idx_ref_content_embedding ON viba.reference_images 
+USING ivfflat (gen_content_embedding vector_cosine_ops) WITH (lists = 100);
+
+-- search 接口改为 (created_at, id) 键集分页，需要 created_at 非空并建立组合索引
+UPDATE viba.reference_images SET created_at = NOW() WHERE created_at IS NULL;
+ALTER TABLE viba.reference_images ALTER COLUMN created_at SET NOT NULL;
+CREATE INDEX idx_ref_created_at_id ON viba.reference_images(created_at DESC, id DESC);
+
+-- 全文搜索：原 to_tsvector('english', ...) 索引查询从未命中（接口用的是 ILIKE），且 english 配置不适合中文描述
+-- 1) search_tsv：'simple' 配置的 tsvector，不做英文词干化，适用于空格/标点分隔的中英文词
+-- 2) pg_trgm 三元组索引：支持中文（无需分词）的子串匹配和相似度排序，ILIKE '%...%' 也可以走索引
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+ALTER TABLE viba.reference_images ADD COLUMN search_tsv tsvector GENERATED ALWAYS AS (
+    to_tsvector('simple',
+        COALESCE(gen_pose_description, '') || ' ' ||
+        COALESCE(gen_product_description, '') || ' ' ||
+        COALESCE(gen_occasion_description, '') || ' ' ||
+        COALESCE(gen_composition_description, '') || ' ' || 
+        COALESCE(gen_style_description, '') || ' ' ||
+        COALESCE(pose_description, '') || ' ' || 
+        COALESCE(scene_description, '') || ' ' || 
+        COALESCE(gen_content_prompt, '')
+    )
+) STORED;
+DROP INDEX IF EXISTS viba.idx_ref_search_text;
+CREATE INDEX idx_ref_search_tsv ON viba.reference_images USING GIN(search_tsv);
+CREATE INDEX idx_ref_search_text_trgm ON viba.reference_images USING GIN(search_text gin_trgm_ops);
+
+-- 后加的 style_tag_ids / composition_tag_ids 缺少 GIN 索引，标签过滤（&& / @>）需要
+CREATE INDEX idx_ref_style_tags ON viba.reference_images USING GIN(style_tag_ids);
+CREATE INDEX idx_ref_composition_tags ON viba.reference_images USING GIN(composition_tag_ids);
+
+-- 详情接口的 Last-Modified 取 updated_at，任何 UPDATE 都需要刷新（函数同 tag_definitions.sql）
+CREATE OR REPLACE FUNCTION viba.touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_ref_touch_updated_at
+    BEFORE UPDATE ON viba.reference_images
+    FOR EACH ROW EXECUTE FUNCTION viba.touch_updated_at();
+
+-- 已上传图片登记：按内容 SHA-256（浏览器端预处理后的文件）去重，上传前可查询（/api/uploads/presign）
+CREATE TABLE viba.uploaded_images (
+    sha256 CHAR(64) NOT NULL,
+    image_type VARCHAR(50) NOT NULL,
+    url TEXT NOT NULL,
+    s3_key TEXT,
+    width INTEGER,
+    height INTEGER,
+    byte_size BIGINT,
+    content_type VARCHAR(100),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (sha256, image_type)
+);
+
+-- 无 pgvector 的环境（本地开发、测试）：向量列以 REAL[] 存储，不建 ivfflat 索引，
+-- 相似检索使用进程内索引（VECTOR_SEARCH_BACKEND=numpy）。建表时向量列改为：
+--     gen_content_embedding REAL[],
+--     gen_pose_embedding REAL[],
+--     gen_product_embedding REAL[],
+--     gen_occasion_embedding REAL[],
+--     gen_composition_embedding REAL[],
+--     pose_embedding REAL[],
+--     scene_embedding REAL[],
+-- 应用启动时检测 pgvector：未安装时向量参数按 '{...}'::real[] 发送、COPY 按数组文本编码，
+-- 进程内索引以 ::text 读出后解析，两种列类型共用同一套代码。
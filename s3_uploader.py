@@ -1,14 +1,88 @@
 # s3_uploader.py - 修复后的S3上传服务
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 import uuid
 import os
+import re
+import base64
+import io
+import time
 from datetime import datetime
 from typing import Optional, List, Dict
 import hashlib
 import logging
 
+from metrics import timed_stage, record_s3_call
+
 logger = logging.getLogger(__name__)
 
+# 直传对象上传时带此标签，确认后移除；存储桶按标签配置生命周期规则，过期删除从未确认的对象
+PENDING_UPLOAD_TAG = 'upload-state=pending'
+
+
+def s3_client_options(max_pool_connections: int = 10, retry_mode: str = 'adaptive',
+                      max_attempts: int = 5, tcp_keepalive: bool = True,
+                      connect_timeout: float = 5, read_timeout: float = 60) -> Dict:
+    """
+    S3 客户端的 botocore Config 参数（同步 BotoConfig 与 aiobotocore AioConfig 共用）
+    
+    Args:
+        max_pool_connections: 连接池大小，应不小于 并发上传数 × 分片上传并发数，否则请求排队等待连接
+        retry_mode: 重试模式；adaptive 在 standard 的基础上遇到限流响应时在客户端限速
+        max_attempts: 最大尝试次数（含首次请求）
+        tcp_keepalive: 开启 TCP keepalive，避免池中空闲连接被中间设备静默断开
+        connect_timeout: 连接超时（秒）
+        read_timeout: 读取超时（秒）
+    
+    Returns:
+        Config 关键字参数
+    """
+    return {
+        'max_pool_connections': max_pool_connections,
+        'retries': {'mode': retry_mode, 'total_max_attempts': max_attempts},
+        'tcp_keepalive': tcp_keepalive,
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout
+    }
+
+
+def instrument_s3_client(client):
+    """
+    注册 botocore 事件钩子，按操作记录 S3 调用数、耗时和重试次数（同步客户端和 aiobotocore 客户端通用）
+    
+    Args:
+        client: boto3 / aiobotocore 的 S3 客户端
+    """
+    events = client.meta.events
+    events.register('before-call.s3', _mark_s3_call_start)
+    events.register('after-call.s3', _record_s3_call)
+    events.register('after-call-error.s3', _record_s3_call_error)
+
+
+def _mark_s3_call_start(context, **kwargs):
+    context['viba_s3_start'] = time.perf_counter()
+
+
+def _finish_s3_call(operation: str, context: Dict, status: str):
+    start = context.get('viba_s3_start')
+    if start is None:
+        return
+    # context['retries']['attempt'] 为最后一次尝试的序号（从 1 开始）
+    attempts = context.get('retries', {}).get('attempt', 1)
+    record_s3_call(operation, time.perf_counter() - start, status, retries=max(attempts - 1, 0))
+
+
+def _record_s3_call(http_response, model, context, **kwargs):
+    _finish_s3_call(model.name, context, str(http_response.status_code))
+
+
+def _record_s3_call_error(context, event_name, **kwargs):
+    # 连接错误、超时等（重试用尽后）没有 HTTP 响应
+    _finish_s3_call(event_name.rsplit('.', 1)[-1], context, 'error')
+
+
 class S3Uploader:
     """
     简化的S3上传服务
@@ -17,7 +91,10 @@ class S3Uploader:
     
     def __init__(self, bucket_name: str, region: str, 
                  access_key_id: str, secret_access_key: str,
-                 cloudfront_domain: Optional[str] = None):
+                 cloudfront_domain: Optional[str] = None,
+                 endpoint_url: Optional[str] = None,
+                 client_options: Optional[Dict] = None,
+                 transfer_config: Optional[TransferConfig] = None):
         """
         初始化S3上传器
         
@@ -27,18 +104,35 @@ class S3Uploader:
             access_key_id: AWS访问密钥ID
             secret_access_key: AWS访问密钥
             cloudfront_domain: CloudFront域名（可选，用于CDN加速）
+            endpoint_url: S3兼容服务地址（可选，如本地压测用的 MinIO），设置后使用 path-style 访问
+            client_options: botocore Config 参数（连接池、重试、keepalive、超时），见 s3_client_options
+            transfer_config: 分片上传配置，不小于 multipart_threshold 的文件按分片并发上传
         """
         self.bucket_name = bucket_name
         self.region = region
         self.cloudfront_domain = cloudfront_domain
+        self.endpoint_url = endpoint_url.rstrip('/') if endpoint_url else None
+        self.client_options = client_options or s3_client_options()
+        self.transfer_config = transfer_config or TransferConfig()
         
         # 初始化S3客户端
+        # 预签名使用 SigV4（Content-Type / 校验和 / 元数据请求头才会签入URL）；
+        # 显式使用区域端点，预签名URL为 {bucket}.s3.{region}.amazonaws.com（全局端点对非 us-east-1 的桶会重定向，浏览器直传跨域失败）
+        if self.endpoint_url:
+            client_endpoint = self.endpoint_url
+            s3_options = {'addressing_style': 'path'}
+        else:
+            client_endpoint = f"https://s3.{region}.amazonaws.com"
+            s3_options = {'addressing_style': 'virtual'}
         self.s3_client = boto3.client(
             's3',
             aws_access_key_id=access_key_id,
             aws_secret_access_key=secret_access_key,
-            region_name=region
+            region_name=region,
+            endpoint_url=client_endpoint,
+            config=BotoConfig(signature_version='s3v4', s3=s3_options, **self.client_options)
         )
+        instrument_s3_client(self.s3_client)
         
         # 定义文件夹路径模板
         self.path_templates = {
@@ -78,6 +172,46 @@ class S3Uploader:
         
         return path
     
+    def is_upload_key(self, file_type: str, s3_key: str) -> bool:
+        """
+        判断 s3_key 是否符合 generate_s3_path(file_type) 的路径规则（确认直传上传时校验客户端提交的 key）
+        
+        Args:
+            file_type: 文件类型
+            s3_key: S3 key
+        
+        Returns:
+            是否匹配
+        """
+        template = self.path_templates.get(file_type)
+        if template is None or not s3_key:
+            return False
+        
+        pattern = re.escape(template)
+        for field, field_pattern in (('year', r'\d{4}'), ('month', r'\d{2}'), ('day', r'\d{2}'),
+                                     ('filename', r'[0-9a-f]{32}\.jpg')):
+            pattern = pattern.replace(re.escape('{%s}' % field), field_pattern)
+        return re.fullmatch(pattern, s3_key) is not None
+    
+    def build_object_url(self, s3_path: str) -> str:
+        """
+        生成对象的访问URL
+        
+        Args:
+            s3_path: S3 key
+        
+        Returns:
+            CloudFront / S3兼容服务 / S3 直接访问URL
+        """
+        if self.cloudfront_domain:
+            # 使用CloudFront CDN
+            return f"https://{self.cloudfront_domain}/{s3_path}"
+        if self.endpoint_url:
+            # S3兼容服务（path-style）
+            return f"{self.endpoint_url}/{self.bucket_name}/{s3_path}"
+        # 使用S3直接URL
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{s3_path}"
+    
     def upload_file(self, file_data: bytes, file_type: str,
                    content_type: str = 'image/jpeg') -> str:
         """
@@ -95,28 +229,36 @@ class S3Uploader:
             # 生成S3路径
             s3_path = self.generate_s3_path(file_type)
             
+            # 添加元数据
+            metadata = {
+                'upload_time': datetime.now().isoformat(),
+                'file_type': file_type
+            }
+            
             # 上传到S3
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=s3_path,
-                Body=file_data,
-                ContentType=content_type,
-                # 设置为公开读取（如果需要）
-                # ACL='public-read',
-                # 添加元数据
-                Metadata={
-                    'upload_time': datetime.now().isoformat(),
-                    'file_type': file_type
-                }
-            )
+            with timed_stage('s3'):
+                if len(file_data) < self.transfer_config.multipart_threshold:
+                    self.s3_client.put_object(
+                        Bucket=self.bucket_name,
+                        Key=s3_path,
+                        Body=file_data,
+                        ContentType=content_type,
+                        # 设置为公开读取（如果需要）
+                        # ACL='public-read',
+                        Metadata=metadata
+                    )
+                else:
+                    # 大文件分片并发上传
+                    self.s3_client.upload_fileobj(
+                        io.BytesIO(file_data),
+                        self.bucket_name,
+                        s3_path,
+                        ExtraArgs={'ContentType': content_type, 'Metadata': metadata},
+                        Config=self.transfer_config
+                    )
             
             # 生成访问URL
-            if self.cloudfront_domain:
-                # 使用CloudFront CDN
-                url = f"https://{self.cloudfront_domain}/{s3_path}"
-            else:
-                # 使用S3直接URL
-                url = f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{s3_path}"
+            url = self.build_object_url(s3_path)
             
             logger.info(f"Successfully uploaded file to S3: {s3_path}")
             return url
@@ -125,6 +267,111 @@ class S3Uploader:
             logger.error(f"Failed to upload file to S3: {str(e)}")
             raise
     
+    def create_presigned_upload(self, file_type: str, content_type: str = 'image/jpeg',
+                                sha256: Optional[str] = None, expires_in: int = 300) -> Dict:
+        """
+        生成浏览器直传S3的预签名 PUT 地址（文件不经过应用服务器）
+        
+        Args:
+            file_type: 文件类型，对象 key 按 generate_s3_path 规则生成
+            content_type: MIME类型
+            sha256: 文件内容的 SHA-256（十六进制）。作为 x-amz-checksum-sha256 签入，
+                    内容不一致时 S3 拒绝上传；同时写入对象元数据，确认上传时读取
+            expires_in: 过期时间（秒）
+        
+        预签名 PUT 无法限制对象大小：超限或无效的对象在确认时删除，
+        从未确认的对象带 PENDING_UPLOAD_TAG 标签，由存储桶生命周期规则清理。
+        
+        Returns:
+            {'key', 'upload_url', 'headers'（PUT 时必须原样携带的请求头）, 'expires_in'}
+        """
+        s3_path = self.generate_s3_path(file_type)
+        params = {
+            'Bucket': self.bucket_name,
+            'Key': s3_path,
+            'ContentType': content_type,
+            'Metadata': {'file_type': file_type},
+            'Tagging': PENDING_UPLOAD_TAG
+        }
+        headers = {
+            'Content-Type': content_type,
+            'x-amz-meta-file_type': file_type,
+            'x-amz-tagging': PENDING_UPLOAD_TAG
+        }
+        if sha256:
+            checksum = base64.b64encode(bytes.fromhex(sha256)).decode('ascii')
+            params['ChecksumSHA256'] = checksum
+            params['Metadata']['sha256'] = sha256
+            headers['x-amz-checksum-sha256'] = checksum
+            headers['x-amz-meta-sha256'] = sha256
+        
+        upload_url = self.s3_client.generate_presigned_url(
+            'put_object',
+            Params=params,
+            ExpiresIn=expires_in
+        )
+        
+        return {
+            'key': s3_path,
+            'upload_url': upload_url,
+            'headers': headers,
+            'expires_in': expires_in
+        }
+    
+    def read_object_head(self, s3_key: str, num_bytes: int) -> Optional[Dict]:
+        """
+        ranged GET 读取对象开头的若干字节（解析图片尺寸只需文件头，不下载整个文件）
+        
+        Args:
+            s3_key: S3 key
+            num_bytes: 读取的字节数
+        
+        Returns:
+            {'data', 'size'（对象总大小）, 'content_type', 'metadata'}，对象不存在时返回 None
+        """
+        try:
+            with timed_stage('s3'):
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=s3_key,
+                    Range=f"bytes=0-{num_bytes - 1}"
+                )
+                data = response['Body'].read()
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            if code == 'InvalidRange':
+                # 空对象
+                return {'data': b'', 'size': 0, 'content_type': None, 'metadata': {}}
+            raise
+        
+        # Content-Range 形如 'bytes 0-262143/5242880'
+        content_range = response.get('ContentRange')
+        size = int(content_range.rsplit('/', 1)[1]) if content_range else response.get('ContentLength', len(data))
+        return {
+            'data': data,
+            'size': size,
+            'content_type': response.get('ContentType'),
+            'metadata': response.get('Metadata') or {}
+        }
+    
+    def clear_pending_tag(self, s3_key: str):
+        """
+        移除直传对象的 PENDING_UPLOAD_TAG 标签（确认上传后调用，对象不再被生命周期规则删除）
+        
+        Args:
+            s3_key: S3 key
+        
+        Raises:
+            ClientError: 移除失败（对象仍会过期，调用方不应把它当作已上传）
+        """
+        with timed_stage('s3'):
+            self.s3_client.delete_object_tagging(
+                Bucket=self.bucket_name,
+                Key=s3_key
+            )
+    
     def upload_batch(self, files: List[Dict]) -> List[str]:
         """
         批量上传文件
@@ -165,11 +412,28 @@ class S3Uploader:
             if not s3_key:
                 return False
             
-            # 删除S3对象
-            self.s3_client.delete_object(
-                Bucket=self.bucket_name,
-                Key=s3_key
-            )
+            return self.delete_object(s3_key)
+            
+        except Exception as e:
+            logger.error(f"Failed to delete file: {str(e)}")
+            return False
+    
+    def delete_object(self, s3_key: str) -> bool:
+        """
+        删除S3对象
+        
+        Args:
+            s3_key: S3 key
+        
+        Returns:
+            是否删除成功
+        """
+        try:
+            with timed_stage('s3'):
+                self.s3_client.delete_object(
+                    Bucket=self.bucket_name,
+                    Key=s3_key
+                )
             
             logger.info(f"Successfully deleted file from S3: {s3_key}")
             return True
@@ -192,6 +456,9 @@ class S3Uploader:
             if self.cloudfront_domain and self.cloudfront_domain in url:
                 # CloudFront URL
                 return url.split(f"https://{self.cloudfront_domain}/")[1]
+            elif self.endpoint_url and url.startswith(f"{self.endpoint_url}/{self.bucket_name}/"):
+                # S3兼容服务 URL
+                return url[len(f"{self.endpoint_url}/{self.bucket_name}/"):]
             elif f"{self.bucket_name}.s3" in url:
                 # S3 URL
                 return url.split(f"{self.bucket_name}.s3.{self.region}.amazonaws.com/")[1]
@@ -0,0 +1,94 @@
+# stage_executor.py - 请求内互不依赖的处理阶段并发执行（嵌入推理与标签数据库查询重叠）
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StageCancelled(Exception):
+    """阶段在开始前或检查点处被取消"""
+
+
+class StageGroup:
+    """
+    一次请求内提交的一组阶段
+
+    阶段在共享线程池中运行，并继承调用方的 contextvars（阶段耗时照常计入 Server-Timing）。
+    cancel() 置位 cancel_event：尚未开始的阶段不再执行，运行中的阶段在自己的检查点
+    （接受 cancel_event 参数的函数）处停止。退出 with 块时若有异常也会自动取消。
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor):
+        self._executor = executor
+        self.cancel_event = threading.Event()
+        self._futures: Dict[str, Future] = {}
+
+    def submit(self, name: str, fn: Callable, *args, **kwargs) -> Future:
+        """
+        提交一个阶段
+
+        Args:
+            name: 阶段名（日志用）
+            fn: 阶段函数，需要响应取消时自行接收 cancel_event 参数
+
+        Returns:
+            Future，result() 返回 fn 的返回值；被取消时抛出 StageCancelled 或 CancelledError
+        """
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, self._run_stage, name, fn, args, kwargs)
+        self._futures[name] = future
+        return future
+
+    def _run_stage(self, name: str, fn: Callable, args, kwargs):
+        if self.cancel_event.is_set():
+            raise StageCancelled(name)
+        return fn(*args, **kwargs)
+
+    def cancel(self):
+        """取消所有未完成的阶段"""
+        self.cancel_event.set()
+        for name, future in self._futures.items():
+            if not future.done() and not future.cancel():
+                logger.debug(f"Stage {name} is running, will stop at its next checkpoint")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel()
+        return False
+
+
+class StageExecutor:
+    """进程内共享的阶段线程池"""
+
+    def __init__(self, max_workers: int = 4, name: str = 'stage'):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def group(self) -> StageGroup:
+        """
+        创建一组阶段
+
+        用法:
+            with stage_executor.group() as stages:
+                embedding = stages.submit('embedding', generate, data, cancel_event=stages.cancel_event)
+                if not validate(...):
+                    stages.cancel()
+                    return error
+                embeddings = embedding.result()
+        """
+        return StageGroup(self._executor)
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def check_cancelled(cancel_event: Optional[threading.Event], stage: str = 'stage'):
+    """阶段函数内的检查点：已取消时抛出 StageCancelled"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise StageCancelled(stage)
@@ -571,52 +571,22 @@ function showImageError(message) {
     }, 5000);
 }
 
-// 验证图片文件
-function validateMainImageFile(file) {
+// ==================== 上传预处理 ====================
+// 与后端 ImageValidator 的限制一致：超过最大尺寸的图片在浏览器端等比缩小后再上传
+const UPLOAD_MAX_WIDTH = 2160;
+const UPLOAD_MAX_HEIGHT = 3840;
+// 重新编码为 JPEG 的质量（后端只接受 PNG/JPEG，S3 路径统一为 .jpg）
+const UPLOAD_JPEG_QUALITY = 0.85;
+
+// 读取图片文件为 Image 对象
+function loadImageFile(file) {
     return new Promise((resolve, reject) => {
-        // 检查文件类型
-        if (!file.type.match('image/(png|jpeg)')) {
-            reject({
-                valid: false,
-                error: '请上传PNG或JPG格式的图片'
-            });
-            return;
-        }
-
-        // 检查文件大小（限制在10MB以内）
-        const maxSize = 10 * 1024 * 1024; // 10MB
-        if (file.size > maxSize) {
-            reject({
-                valid: false,
-                error: '图片文件大小不能超过10MB'
-            });
-            return;
-        }
-
-        // 创建图片对象来获取尺寸
         const img = new Image();
         const url = URL.createObjectURL(file);
 
         img.onload = function() {
-            const width = this.naturalWidth;
-            const height = this.naturalHeight;
-
-            // 释放对象URL
             URL.revokeObjectURL(url);
-
-            // 验证尺寸要求
-            const validationResult = validateImageDimensions(width, height);
-            
-            if (validationResult.valid) {
-                resolve({
-                    valid: true,
-                    file: file,
-                    width: width,
-                    height: height
-                });
-            } else {
-                reject(validationResult);
-            }
+            resolve(img);
         };
 
         img.onerror = function() {
@@ -631,6 +601,163 @@ function validateMainImageFile(file) {
     });
 }
 
+function canvasToBlob(canvas, type, quality) {
+    return new Promise(resolve => canvas.toBlob(resolve, type, quality));
+}
+
+// 上传前预处理：缩小到最大尺寸以内并重新编码为 JPEG（PNG 透明区域填充白色）
+// 未缩放且重新编码后不比原文件小时保留原文件
+async function preprocessImageFile(file) {
+    const img = await loadImageFile(file);
+    const width = img.naturalWidth;
+    const height = img.naturalHeight;
+    const scale = Math.min(1, UPLOAD_MAX_WIDTH / width, UPLOAD_MAX_HEIGHT / height);
+    const targetWidth = Math.round(width * scale);
+    const targetHeight = Math.round(height * scale);
+
+    let blob = null;
+    try {
+        const canvas = document.createElement('canvas');
+        canvas.width = targetWidth;
+        canvas.height = targetHeight;
+        const ctx = canvas.getContext('2d');
+        ctx.fillStyle = '#ffffff';
+        ctx.fillRect(0, 0, targetWidth, targetHeight);
+        ctx.imageSmoothingQuality = 'high';
+        ctx.drawImage(img, 0, 0, targetWidth, targetHeight);
+        blob = await canvasToBlob(canvas, 'image/jpeg', UPLOAD_JPEG_QUALITY);
+    } catch (error) {
+        console.warn('图片预处理失败，使用原文件上传:', error);
+    }
+
+    if (!blob || (scale === 1 && blob.size >= file.size)) {
+        return { blob: file, filename: file.name, width: width, height: height, processed: false };
+    }
+
+    const filename = file.name.replace(/\.[^.]*$/, '') + '.jpg';
+    return { blob: blob, filename: filename, width: targetWidth, height: targetHeight, processed: true };
+}
+
+// 计算文件内容的 SHA-256（小写十六进制）；非安全上下文没有 crypto.subtle 时返回 null
+async function computeSha256(blob) {
+    if (!window.crypto || !window.crypto.subtle) {
+        return null;
+    }
+    try {
+        const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return Array.from(new Uint8Array(digest))
+            .map(b => b.toString(16).padStart(2, '0'))
+            .join('');
+    } catch (error) {
+        console.warn('计算图片哈希失败，跳过查重:', error);
+        return null;
+    }
+}
+
+function postJson(url, payload) {
+    return fetch(url, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload)
+    }).then(response => response.json());
+}
+
+// 直传S3：获取预签名地址（已上传过的内容直接返回已有地址），PUT 后由服务端确认
+// 返回 null 表示无法直传（未开启、存储桶未配置跨域等），由调用方改为经服务端上传
+async function uploadDirectToS3(processed, sha256, imageType) {
+    const presign = await postJson('/api/v1/annot-image/uploads/presign', {
+        sha256: sha256,
+        image_type: imageType,
+        content_type: processed.blob.type || 'image/jpeg'
+    });
+    if (!presign.success) {
+        throw new Error(presign.error);
+    }
+    if (presign.data.exists) {
+        return presign;
+    }
+    if (!presign.data.upload_url) {
+        return null;
+    }
+
+    const putResponse = await fetch(presign.data.upload_url, {
+        method: 'PUT',
+        headers: presign.data.headers,
+        body: processed.blob
+    });
+    if (!putResponse.ok) {
+        console.warn('直传S3失败，改为经服务端上传:', putResponse.status);
+        return null;
+    }
+
+    return await postJson('/api/v1/annot-image/uploads/confirm', {
+        key: presign.data.key,
+        image_type: imageType,
+        token: presign.data.token
+    });
+}
+
+// 上传预处理后的图片：优先直传S3（含按内容哈希查重），不可用时经服务端上传
+async function uploadProcessedImage(processed, imageType) {
+    const sha256 = await computeSha256(processed.blob);
+    if (sha256) {
+        try {
+            const result = await uploadDirectToS3(processed, sha256, imageType);
+            if (result) {
+                return result;
+            }
+        } catch (error) {
+            console.warn('直传S3失败，改为经服务端上传:', error);
+        }
+    }
+
+    const formData = new FormData();
+    formData.append('file', processed.blob, processed.filename);
+    formData.append('image_type', imageType);
+
+    const response = await fetch('/api/v1/annot-image/upload-image', {
+        method: 'POST',
+        body: formData
+    });
+
+    return await response.json();
+}
+
+// 验证图片文件（预处理后的尺寸和大小）
+async function validateMainImageFile(file) {
+    // 检查文件类型
+    if (!file.type.match('image/(png|jpeg)')) {
+        throw {
+            valid: false,
+            error: '请上传PNG或JPG格式的图片'
+        };
+    }
+
+    // 超过最大尺寸的图片已被缩小，验证的是实际上传的尺寸
+    const processed = await preprocessImageFile(file);
+    const validationResult = validateImageDimensions(processed.width, processed.height);
+    if (!validationResult.valid) {
+        throw validationResult;
+    }
+
+    // 检查上传文件大小（限制在10MB以内）
+    const maxSize = 10 * 1024 * 1024; // 10MB
+    if (processed.blob.size > maxSize) {
+        throw {
+            valid: false,
+            error: '图片文件大小不能超过10MB'
+        };
+    }
+
+    return {
+        valid: true,
+        file: file,
+        processed: processed,
+        width: processed.width,
+        height: processed.height
+    };
+}
+
 // 处理主图文件（带验证）
 async function handleMainImageFile(file) {
     // 清除之前的错误信息
@@ -643,17 +770,8 @@ async function handleMainImageFile(file) {
         // 先验证图片
         const validationResult = await validateMainImageFile(file);
         
-        // 验证通过，继续上传
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('image_type', 'reference_image');
-
-        const response = await fetch('/api/v1/annot-image/upload-image', {
-            method: 'POST',
-            body: formData
-        });
-
-        const result = await response.json();
+        // 验证通过，继续上传（内容已上传过时跳过上传）
+        const result = await uploadProcessedImage(validationResult.processed, 'reference_image');
 
         if (result.success) {
             mainImage = {
@@ -1830,16 +1948,8 @@ window.handleReferenceImageSelect = async function(event, type, itemId) {
     }
     
     try {
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('image_type', 'prompt_' + type);
-        
-        const response = await fetch('/api/v1/annot-image/upload-image', {
-            method: 'POST',
-            body: formData
-        });
-        
-        const result = await response.json();
+        const processed = await preprocessImageFile(file);
+        const result = await uploadProcessedImage(processed, 'prompt_' + type);
         
         if (result.success) {
             const imageData = {
@@ -1868,7 +1978,7 @@ window.handleReferenceImageSelect = async function(event, type, itemId) {
         }
     } catch (error) {
         console.error('上传失败:', error);
-        alert('上传失败: ' + error.message);
+        alert('上传失败: ' + (error.error || error.message));
     }
 }
 
@@ -0,0 +1,153 @@
+# static_assets.py - 静态资源内容哈希指纹：static/app.js -> static/app.<hash>.js，指纹文件可永久缓存
+"""
+页面（index.html）中对 static/ 的引用改写为带内容哈希的文件名，内容变化即换 URL，
+因此指纹文件可以使用 immutable 长缓存，页面本身每次协商（no-cache）。
+
+两种使用方式:
+    1. Flask（本地开发）：app.py 的 index 和 static 路由运行时改写与解析
+    2. nginx 前端镜像：构建时生成带指纹的文件、预压缩的 .gz 和改写后的 index.html
+           python static_assets.py --static-dir static --html templates/index.html --out dist
+
+只依赖标准库（前端镜像的构建阶段不安装项目依赖）。
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+# 指纹文件使用一年且不再验证；页面与未带指纹的文件每次验证（配合 ETag 返回 304）
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+HASH_LENGTH = 10
+HASHED_NAME = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[A-Za-z0-9]+)$' % HASH_LENGTH)
+# 页面中的 src="static/..." / href="./static/..."（相对路径，兼容 nginx 子路径部署）
+STATIC_REFERENCE = re.compile(r'''(?P<prefix>(?:src|href)=["'](?:\./)?static/)(?P<path>[^"'?#]+)(?P<suffix>["'])''')
+
+# 构建时预压缩的文件类型（nginx gzip_static）
+PRECOMPRESS_EXTENSIONS = ('.js', '.css', '.html', '.svg', '.json', '.txt')
+
+
+class StaticAssetManifest:
+    """静态目录的内容哈希表，按文件 mtime/大小缓存哈希"""
+
+    def __init__(self, static_dir: str):
+        self.static_dir = static_dir
+        self._hashes: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, filename: str) -> Optional[str]:
+        path = os.path.normpath(os.path.join(self.static_dir, filename))
+        if not path.startswith(os.path.normpath(self.static_dir) + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def content_hash(self, filename: str) -> Optional[str]:
+        """返回文件内容哈希（前 HASH_LENGTH 位），文件不存在时返回 None"""
+        path = self._path(filename)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._hashes.get(filename)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+        with self._lock:
+            self._hashes[filename] = (signature, digest)
+        return digest
+
+    def hashed_name(self, filename: str) -> Optional[str]:
+        """app.js -> app.<hash>.js，文件不存在时返回 None"""
+        digest = self.content_hash(filename)
+        if digest is None:
+            return None
+        stem, ext = os.path.splitext(filename)
+        return f"{stem}.{digest}{ext}"
+
+    def resolve(self, requested: str) -> Tuple[str, bool]:
+        """
+        解析请求的静态文件名
+
+        Args:
+            requested: static/ 之后的路径，可能带指纹
+
+        Returns:
+            (实际文件名, 指纹是否与当前内容一致)；旧指纹返回当前文件但不可长缓存
+        """
+        match = HASHED_NAME.match(requested)
+        if match is None or self._path(requested) is not None:
+            return requested, False
+        original = match.group('stem') + match.group('ext')
+        return original, self.content_hash(original) == match.group('hash')
+
+    def rewrite_html(self, html: str) -> str:
+        """把页面中的 static/ 引用改写为带指纹的文件名（找不到的文件保持原样）"""
+        def replace(match):
+            hashed = self.hashed_name(match.group('path'))
+            if hashed is None:
+                return match.group(0)
+            return match.group('prefix') + hashed + match.group('suffix')
+        return STATIC_REFERENCE.sub(replace, html)
+
+    def build(self, out_dir: str, html_files: Iterable[str]) -> Dict[str, str]:
+        """
+        生成部署用的静态目录
+
+        out_dir/static/ 下同时保留原文件名和带指纹的文件，文本类文件附带 .gz；
+        html_files 改写引用后写入 out_dir 根目录。
+
+        Returns:
+            {原文件名: 指纹文件名}
+        """
+        manifest = {}
+        static_out = os.path.join(out_dir, 'static')
+        for root, _, files in os.walk(self.static_dir):
+            for name in sorted(files):
+                filename = os.path.relpath(os.path.join(root, name), self.static_dir)
+                hashed = self.hashed_name(filename)
+                manifest[filename] = hashed
+                for target in (filename, hashed):
+                    target_path = os.path.join(static_out, target)
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    shutil.copyfile(os.path.join(root, name), target_path)
+                    _precompress(target_path)
+
+        for html_file in html_files:
+            with open(html_file, encoding='utf-8') as f:
+                html = self.rewrite_html(f.read())
+            target_path = os.path.join(out_dir, os.path.basename(html_file))
+            with open(target_path, 'w', encoding='utf-8') as f:
+                f.write(html)
+            _precompress(target_path)
+        return manifest
+
+
+def _precompress(path: str):
+    if not path.endswith(PRECOMPRESS_EXTENSIONS):
+        return
+    with open(path, 'rb') as src, open(path + '.gz', 'wb') as dst:
+        dst.write(gzip.compress(src.read(), compresslevel=9, mtime=0))
+    shutil.copystat(path, path + '.gz')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成带内容哈希指纹的静态资源目录（nginx 前端镜像使用）')
+    parser.add_argument('--static-dir', default='static')
+    parser.add_argument('--html', action='append', default=[], help='需要改写 static/ 引用的页面，可重复')
+    parser.add_argument('--out', required=True, help='输出目录')
+    args = parser.parse_args()
+
+    manifest = StaticAssetManifest(args.static_dir).build(args.out, args.html or ['templates/index.html'])
+    for original, hashed in sorted(manifest.items()):
+        print(f"static/{original} -> static/{hashed}")
+
+
+if __name__ == '__main__':
+    main()
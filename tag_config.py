@@ -45,6 +45,18 @@ FIELD_MAPPING = {
     'color_tag_ids': 'color_tag_ids',
 }
 
+# reference_images 表中的标签ID数组字段（均建有GIN索引，存储时已包含所有父级标签）
+REFERENCE_TAG_FIELDS = [
+    'product_type_tag_ids',
+    'style_tag_ids',
+    'occasion_tag_ids',
+    'silhouette_tag_ids',
+    'model_attribute_tag_ids',
+    'fabric_tag_ids',
+    'pose_tag_ids',
+    'composition_tag_ids'
+]
+
 # 模特属性相关字段
 MODEL_ATTRIBUTE_FIELDS = [
     'model_age',
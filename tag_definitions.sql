@@ -61,4 +61,48 @@ CREATE INDEX idx_tag_def_aliases ON viba.tag_definitions USING GIN(aliases);
 CREATE INDEX idx_tag_search_text ON viba.tag_definitions USING GIN(to_tsvector('simple', search_text));
 
 -- 向量索引
-CREATE INDEX idx_tag_def_embedding ON viba.tag_definitions USING ivfflat (embedding vector_cosine_ops) WITH (lists = 50); 
\ No newline at end of file
+CREATE INDEX idx_tag_def_embedding ON viba.tag_definitions USING ivfflat (embedding vector_cosine_ops) WITH (lists = 50); 
+
+-- 标签/主题变更通知：应用的每个 worker 进程 LISTEN viba_cache_invalidation（与 CACHE_NOTIFY_CHANNEL 一致），
+-- 收到后只重新查询受影响的 tag_type，标签缓存因此可以保留数小时。
+-- 行级通知的 payload 为 {"table": "tag_definitions", "tag_type": "..."}，同一事务内相同的 payload 会被合并，
+-- 批量修改同一类型只通知一次；TRUNCATE 和 themes 表的语句级通知不带 tag_type（整体失效）。
+CREATE OR REPLACE FUNCTION viba.notify_cache_invalidation() RETURNS trigger AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN
+        PERFORM pg_notify('viba_cache_invalidation', json_build_object('table', TG_TABLE_NAME)::text);
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('viba_cache_invalidation',
+            json_build_object('table', TG_TABLE_NAME, 'tag_type', OLD.tag_type)::text);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('viba_cache_invalidation',
+            json_build_object('table', TG_TABLE_NAME, 'tag_type', NEW.tag_type)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_tag_def_notify
+    AFTER INSERT OR UPDATE OR DELETE ON viba.tag_definitions
+    FOR EACH ROW EXECUTE FUNCTION viba.notify_cache_invalidation();
+CREATE TRIGGER trg_tag_def_truncate_notify
+    AFTER TRUNCATE ON viba.tag_definitions
+    FOR EACH STATEMENT EXECUTE FUNCTION viba.notify_cache_invalidation();
+CREATE TRIGGER trg_themes_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON viba.themes
+    FOR EACH STATEMENT EXECUTE FUNCTION viba.notify_cache_invalidation();
+
+-- 标签结构按 tag_type 缓存，版本取 (启用标签数, MAX(updated_at))，修改（含停用、重命名）时需要刷新 updated_at
+CREATE OR REPLACE FUNCTION viba.touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_tag_def_touch_updated_at
+    BEFORE UPDATE ON viba.tag_definitions
+    FOR EACH ROW EXECUTE FUNCTION viba.touch_updated_at();
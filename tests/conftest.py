@@ -0,0 +1,5 @@
+# tests/conftest.py - 测试从仓库根目录导入模块（仓库本身不是包）
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,69 @@
+# tests/test_pg_copy.py - COPY 文本格式的转义和编码
+import numpy as np
+
+import pg_copy
+from pg_copy import COPY_NULL, escape_copy_text, format_array_literal, format_copy_row, format_copy_value
+
+
+def test_escape_copy_text_escapes_backslash_first():
+    assert escape_copy_text('a\\b') == 'a\\\\b'
+    assert escape_copy_text('a\tb\nc\rd') == 'a\\tb\\nc\\rd'
+    # 原文中的 "\t" 两个字符不能与真正的制表符混淆
+    assert escape_copy_text('\\t\t') == '\\\\t\\t'
+
+
+def test_format_array_literal_quotes_every_element():
+    assert format_array_literal([]) == '{}'
+    assert format_array_literal([1, 2, 3]) == '{"1","2","3"}'
+    assert format_array_literal(['a', None, 'b']) == '{"a",NULL,"b"}'
+    assert format_array_literal(['NULL']) == '{"NULL"}'
+
+
+def test_format_array_literal_escapes_quotes_and_backslashes():
+    assert format_array_literal(['say "hi"']) == '{"say \\"hi\\""}'
+    assert format_array_literal(['a\\b']) == '{"a\\\\b"}'
+    assert format_array_literal(['a,b', '{x}']) == '{"a,b","{x}"}'
+
+
+def test_format_copy_value_scalars():
+    assert format_copy_value(None) == COPY_NULL
+    assert format_copy_value(None, 'json') == COPY_NULL
+    assert format_copy_value(True) == 't'
+    assert format_copy_value(False) == 'f'
+    assert format_copy_value(42) == '42'
+    assert format_copy_value('line1\nline2\ttab') == 'line1\\nline2\\ttab'
+
+
+def test_format_copy_value_array_is_escaped_for_copy():
+    # 数组字面量里的反斜杠在 COPY 层再转义一次
+    assert format_copy_value(['a\\b'], 'array') == '{"a\\\\\\\\b"}'
+    assert format_copy_value(['x\ty'], 'array') == '{"x\\ty"}'
+
+
+def test_format_copy_value_json_keeps_unicode_and_escapes_newlines():
+    value = {'title': '连衣裙', 'note': 'a\nb'}
+    assert format_copy_value(value, 'json') == '{"title": "连衣裙", "note": "a\\\\nb"}'
+
+
+def test_format_copy_value_vector_follows_column_type(monkeypatch):
+    vector = np.array([0.5, -1.0, 2.0], dtype=np.float32)
+
+    monkeypatch.setattr(pg_copy, 'pgvector_available', lambda: True)
+    assert format_copy_value(vector, 'vector') == '[0.5,-1.0,2.0]'
+
+    # 未安装 pgvector 时向量列为 real[]
+    monkeypatch.setattr(pg_copy, 'pgvector_available', lambda: False)
+    assert format_copy_value(vector, 'vector') == '{0.5,-1.0,2.0}'
+
+
+def test_format_copy_row_tabs_and_newline():
+    row = format_copy_row(
+        ['id-1', None, ['a', 'b'], {'k': 1}, 'x\ty'],
+        ['scalar', 'scalar', 'array', 'json', 'scalar']
+    )
+    assert row == 'id-1\t\\N\t{"a","b"}\t{"k": 1}\tx\\ty\n'
+    assert row.count('\t') == 4
+
+
+def test_format_copy_row_defaults_to_scalars():
+    assert format_copy_row([1, True, None]) == '1\tt\t\\N\n'
@@ -0,0 +1,76 @@
+# tests/test_upload_token.py - 直传确认令牌的签发与校验
+import time
+
+import pytest
+
+import app as app_module
+from app import read_secret_env, sign_upload_token, verify_upload_token
+
+KEY = 'reference-images/2026/10/ab/abcdef.jpg'
+
+
+@pytest.fixture(autouse=True)
+def upload_secret(monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'UPLOAD_TOKEN_SECRET', 'test-secret')
+
+
+def future(seconds=300):
+    return int(time.time()) + seconds
+
+
+def test_token_verifies_for_the_issued_key_and_type():
+    token = sign_upload_token(KEY, 'reference_image', future())
+
+    assert verify_upload_token(token, KEY, 'reference_image')
+
+
+def test_token_is_bound_to_key_and_image_type():
+    token = sign_upload_token(KEY, 'reference_image', future())
+
+    assert not verify_upload_token(token, KEY.replace('abcdef', 'abcdee'), 'reference_image')
+    assert not verify_upload_token(token, KEY, 'gen_pose_image')
+
+
+def test_expired_token_is_rejected():
+    token = sign_upload_token(KEY, 'reference_image', future(-1))
+
+    assert not verify_upload_token(token, KEY, 'reference_image')
+
+
+def test_tampered_expiry_is_rejected():
+    token = sign_upload_token(KEY, 'reference_image', future(-1))
+    signature = token.split('.', 1)[1]
+
+    assert not verify_upload_token(f'{future(3600)}.{signature}', KEY, 'reference_image')
+
+
+def test_token_signed_with_another_secret_is_rejected(monkeypatch):
+    token = sign_upload_token(KEY, 'reference_image', future())
+    monkeypatch.setitem(app_module.app.config, 'UPLOAD_TOKEN_SECRET', 'rotated-secret')
+
+    assert not verify_upload_token(token, KEY, 'reference_image')
+
+
+@pytest.mark.parametrize('token', [None, '', 'garbage', 'abc.def', 12345])
+def test_malformed_tokens_are_rejected(token):
+    assert not verify_upload_token(token, KEY, 'reference_image')
+
+
+def test_no_secret_rejects_every_token(monkeypatch):
+    token = sign_upload_token(KEY, 'reference_image', future())
+    monkeypatch.setitem(app_module.app.config, 'UPLOAD_TOKEN_SECRET', None)
+
+    assert not verify_upload_token(token, KEY, 'reference_image')
+
+
+@pytest.mark.parametrize('value', ['', '   ', 'change_me_to_a_random_string', 'CHANGE_ME', 'changeme'])
+def test_placeholder_secrets_are_treated_as_unset(monkeypatch, value):
+    monkeypatch.setenv('UPLOAD_TOKEN_SECRET', value)
+
+    assert read_secret_env('UPLOAD_TOKEN_SECRET') is None
+
+
+def test_real_secret_is_read(monkeypatch):
+    monkeypatch.setenv('UPLOAD_TOKEN_SECRET', ' 3f9c2e7a ')
+
+    assert read_secret_env('UPLOAD_TOKEN_SECRET') == '3f9c2e7a'
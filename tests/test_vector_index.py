@@ -0,0 +1,100 @@
+# tests/test_vector_index.py - EmbeddingMatrixIndex 的检索与追加
+import numpy as np
+import pytest
+
+from vector_index import EmbeddingMatrixIndex
+
+
+def make_index(vectors, capacity=1024):
+    index = EmbeddingMatrixIndex(dimension=len(next(iter(vectors.values()))), capacity=capacity)
+    for unique_id, vector in vectors.items():
+        assert index.append(unique_id, vector)
+    return index
+
+
+def test_search_returns_top_k_by_cosine_similarity():
+    index = make_index({
+        'a': [1.0, 0.0, 0.0],
+        'b': [1.0, 1.0, 0.0],
+        'c': [0.0, 1.0, 0.0],
+        'd': [0.0, 0.0, 1.0],
+    })
+
+    results = index.search([2.0, 0.1, 0.0], k=2)
+
+    assert [unique_id for unique_id, _ in results] == ['a', 'b']
+    assert results[0][1] == pytest.approx(2.0 / np.linalg.norm([2.0, 0.1]), rel=1e-6)
+    assert results[0][1] > results[1][1]
+
+
+def test_search_k_larger_than_index_returns_all_sorted():
+    index = make_index({'a': [1.0, 0.0], 'b': [0.0, 1.0], 'c': [1.0, 1.0]})
+
+    results = index.search([1.0, 0.0], k=10)
+
+    assert [unique_id for unique_id, _ in results] == ['a', 'c', 'b']
+
+
+def test_search_excludes_query_image():
+    index = make_index({'a': [1.0, 0.0], 'b': [0.9, 0.1], 'c': [0.0, 1.0]})
+
+    results = index.search(index.get_vector('a'), k=2, exclude='a')
+
+    assert [unique_id for unique_id, _ in results] == ['b', 'c']
+
+
+def test_search_zero_query_or_empty_index_returns_nothing():
+    assert EmbeddingMatrixIndex(dimension=3).search([1.0, 0.0, 0.0], k=5) == []
+    assert make_index({'a': [1.0, 0.0]}).search([0.0, 0.0], k=5) == []
+
+
+def test_append_normalizes_and_ignores_zero_vectors():
+    index = EmbeddingMatrixIndex(dimension=2)
+
+    assert index.append('a', [3.0, 4.0])
+    assert not index.append('zero', [0.0, 0.0])
+
+    assert len(index) == 1
+    np.testing.assert_allclose(index.get_vector('a'), [0.6, 0.8], rtol=1e-6)
+    assert index.get_vector('zero') is None
+
+
+def test_append_existing_id_replaces_vector_in_place():
+    index = make_index({'a': [1.0, 0.0], 'b': [0.0, 1.0]})
+
+    index.append('a', [0.0, 2.0])
+
+    assert len(index) == 2
+    np.testing.assert_allclose(index.get_vector('a'), [0.0, 1.0])
+    assert {unique_id for unique_id, _ in index.search([0.0, 1.0], k=2)} == {'a', 'b'}
+
+
+def test_append_grows_beyond_initial_capacity():
+    rng = np.random.default_rng(0)
+    vectors = {f'id-{i}': rng.standard_normal(8) for i in range(50)}
+    index = make_index(vectors, capacity=4)
+
+    assert len(index) == 50
+    for unique_id, vector in vectors.items():
+        assert index.search(vector, k=1)[0][0] == unique_id
+
+
+def test_append_rejects_wrong_dimension():
+    index = EmbeddingMatrixIndex(dimension=3)
+
+    with pytest.raises(ValueError):
+        index.append('a', [1.0, 0.0])
+
+
+def test_append_after_loading_read_only_snapshot(tmp_path):
+    index = make_index({'a': [1.0, 0.0], 'b': [0.0, 1.0]})
+    path = str(tmp_path / 'style_embedding')
+    index.save(path)
+
+    loaded = EmbeddingMatrixIndex.load(path, mmap=True)
+    assert loaded.append('c', [1.0, 1.0])
+
+    assert len(loaded) == 3
+    assert loaded.search([1.0, 1.0], k=1)[0][0] == 'c'
+    # 追加时复制到内存，快照文件不受影响
+    assert len(EmbeddingMatrixIndex.load(path)) == 2
@@ -0,0 +1,194 @@
+# vector_codec.py - pgvector 向量的文本编解码
+import base64
+import logging
+import threading
+from typing import Optional, Sequence, Union
+import numpy as np
+from psycopg2.extensions import AsIs, new_type, register_adapter, register_type
+
+logger = logging.getLogger(__name__)
+
+VectorLike = Union[Sequence[float], np.ndarray]
+
+
+def _format_values(vector: VectorLike) -> str:
+    """
+    float32 数组的逗号分隔文本，直接由 numpy 按 float32 缓冲区格式化（不生成 Python float 列表）
+
+    使用 float32 的最短往返表示，比 '%.9g' 短约 12%，解析回 float32 时无损。
+    """
+    return ','.join(np.asarray(vector, dtype=np.float32).astype(str))
+
+
+def format_vector(vector: Optional[VectorLike]) -> Optional[str]:
+    """
+    将向量转换为 pgvector 的文本格式 '[x1,x2,...]'
+
+    Args:
+        vector: 浮点数列表或numpy数组
+
+    Returns:
+        pgvector文本，输入为None时返回None
+    """
+    if vector is None:
+        return None
+    if isinstance(vector, str):
+        # 已经是pgvector文本（例如直接从数据库读出）
+        return vector
+    return '[' + _format_values(vector) + ']'
+
+
+def format_real_array(vector: Optional[VectorLike]) -> Optional[str]:
+    """
+    将向量转换为 PostgreSQL real[] 的文本格式 '{x1,x2,...}'（未安装 pgvector 时向量列的存储格式）
+
+    Args:
+        vector: 浮点数列表或numpy数组
+
+    Returns:
+        数组文本，输入为None时返回None
+    """
+    if vector is None:
+        return None
+    if isinstance(vector, str):
+        return '{' + vector.strip('[]{}') + '}'
+    return '{' + _format_values(vector) + '}'
+
+
+def parse_vector(text: Optional[Union[str, VectorLike]]) -> Optional[np.ndarray]:
+    """
+    将 pgvector 文本 '[x1,x2,...]'（或 real[] 文本 '{x1,x2,...}'）解析为 float32 数组
+
+    Args:
+        text: 数据库返回的向量文本；已是数组或列表时直接转换
+
+    Returns:
+        float32数组，输入为None时返回None
+    """
+    if text is None:
+        return None
+    if not isinstance(text, str):
+        return np.asarray(text, dtype=np.float32)
+    # 文本直接解析进 float32 缓冲区，不经过 Python float 列表
+    return np.fromstring(text.strip('[]{}'), dtype=np.float32, sep=',')
+
+
+def encode_vector_base64(vector: Optional[Union[VectorLike, str]]) -> Optional[str]:
+    """
+    将向量编码为 base64 字符串（小端 float32 原始字节），比 JSON 浮点数组紧凑约 3 倍
+
+    Args:
+        vector: 向量（列表、数组或 pgvector 文本）
+
+    Returns:
+        base64 字符串，输入为None时返回None
+    """
+    if vector is None:
+        return None
+    array = parse_vector(vector) if isinstance(vector, str) else np.asarray(vector)
+    return base64.b64encode(array.astype('<f4', copy=False).tobytes()).decode('ascii')
+
+
+def decode_vector_base64(text: Optional[str]) -> Optional[np.ndarray]:
+    """将 encode_vector_base64 的结果还原为 float32 数组"""
+    if text is None:
+        return None
+    return np.frombuffer(base64.b64decode(text), dtype='<f4').astype(np.float32)
+
+
+class Vector:
+    """
+    标记为 pgvector 参数的向量
+
+    只有包装成 Vector 的参数才按 '[...]'::vector 发送，其他 numpy 数组（例如 ANY(%s) 的ID数组）
+    仍走 psycopg2 的默认适配，不受影响。
+    """
+
+    __slots__ = ('array',)
+
+    def __init__(self, vector: VectorLike):
+        self.array = np.asarray(vector, dtype=np.float32)
+
+    def __repr__(self) -> str:
+        return f"Vector(dim={self.array.shape[0]})"
+
+
+def to_vector_param(vector: Optional[Union[VectorLike, str]]):
+    """
+    将嵌入向量包装为 SQL 参数
+
+    Args:
+        vector: 向量（列表、数组），None 或已是 pgvector 文本时原样返回
+
+    Returns:
+        Vector 实例或原值
+    """
+    if vector is None or isinstance(vector, (str, Vector)):
+        return vector
+    return Vector(vector)
+
+
+def adapt_vector(vector: Vector) -> AsIs:
+    """
+    psycopg2 参数适配：Vector 直接生成 '[...]'::vector 字面量，不经过 Python float 列表和数组字面量
+
+    数据库未安装 pgvector 时（向量列为 real[]）生成 '{...}'::real[]。
+    """
+    if _vector_registered:
+        return AsIs("'" + format_vector(vector.array) + "'::vector")
+    return AsIs("'" + format_real_array(vector.array) + "'::real[]")
+
+
+def cast_vector(value: Optional[str], cursor=None) -> Optional[np.ndarray]:
+    """psycopg2 结果转换：vector 列直接解析为 float32 数组"""
+    return parse_vector(value)
+
+
+_registration_lock = threading.Lock()
+_vector_registered = False
+_vector_checked = False
+
+
+def pgvector_available() -> bool:
+    """数据库是否安装了 pgvector（register_vector 执行后有效）"""
+    return _vector_registered
+
+
+def register_vector(conn) -> bool:
+    """
+    检测 pgvector 并注册 vector 列的转换器（读），全进程只需执行一次
+
+    注册后 Vector 参数按 pgvector 文本发送，vector 列读出即为 float32 数组；
+    未安装 pgvector 时 Vector 参数按 real[] 发送。
+    psycopg2 只支持文本协议，无法使用 pgvector 的二进制格式。
+
+    Args:
+        conn: 数据库连接（用于查询 vector 类型的 OID）
+
+    Returns:
+        是否已注册（数据库未安装 pgvector 时返回 False）
+    """
+    global _vector_registered, _vector_checked
+    if _vector_checked:
+        return _vector_registered
+
+    with _registration_lock:
+        if _vector_checked:
+            return _vector_registered
+
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regtype('vector')::oid")
+            oid = cursor.fetchone()[0]
+        _vector_checked = True
+        if not oid:
+            logger.warning("pgvector extension not found, vectors are sent as real[]")
+            return False
+
+        register_type(new_type((oid,), 'VECTOR', cast_vector))
+        _vector_registered = True
+        logger.info(f"Registered pgvector adapter (oid={oid})")
+        return True
+
+
+# Vector 的适配器与 pgvector 是否安装无关，始终注册（未安装时按 real[] 发送）
+register_adapter(Vector, adapt_vector)
@@ -0,0 +1,355 @@
+# vector_index.py - 进程内向量近邻索引（pgvector 不可用时的后备方案）
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingMatrixIndex:
+    """
+    基于 numpy 的向量矩阵索引
+
+    所有向量归一化后存放在一块连续的 float32 矩阵中，行号与 unique_id 一一对应。
+    top-k 余弦检索只需一次矩阵-向量乘法加 argpartition。
+    """
+
+    def __init__(self, dimension: int, capacity: int = 1024):
+        self.dimension = dimension
+        self._matrix = np.zeros((capacity, dimension), dtype=np.float32)
+        self._size = 0
+        self._ids: List[str] = []
+        self._row_by_id: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        # 已从数据库同步到的最大 updated_at（None 表示尚未从数据库加载过）
+        self.watermark: Optional[datetime] = None
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'EmbeddingMatrixIndex':
+        """
+        从快照加载索引
+
+        Args:
+            path: 快照路径前缀（{path}.npy 为矩阵，{path}.ids.json 为行号映射，{path}.meta.json 为同步位置）
+            mmap: 是否以只读内存映射方式加载矩阵（首次追加时才复制到内存）
+
+        Returns:
+            索引实例
+        """
+        matrix = np.load(f"{path}.npy", mmap_mode='r' if mmap else None)
+        with open(f"{path}.ids.json", 'r', encoding='utf-8') as f:
+            ids = json.load(f)
+
+        if matrix.ndim != 2 or matrix.shape[0] != len(ids):
+            raise ValueError(f"Corrupted vector index snapshot: {path}")
+
+        index = cls(matrix.shape[1], capacity=0)
+        index._matrix = matrix if matrix.dtype == np.float32 else matrix.astype(np.float32)
+        index._size = len(ids)
+        index._ids = list(ids)
+        index._row_by_id = {unique_id: row for row, unique_id in enumerate(ids)}
+        if os.path.exists(f"{path}.meta.json"):
+            with open(f"{path}.meta.json", 'r', encoding='utf-8') as f:
+                watermark = json.load(f).get('watermark')
+            index.watermark = datetime.fromisoformat(watermark) if watermark else None
+        return index
+
+    def save(self, path: str):
+        """原子地写出快照（先写临时文件再替换）"""
+        with self._lock:
+            matrix = np.ascontiguousarray(self._matrix[:self._size])
+            ids = list(self._ids)
+            watermark = self.watermark
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # np.save 会自动追加 .npy 后缀，临时文件名需要以 .npy 结尾
+        # 临时文件带 pid，多个 worker 同时保存时互不覆盖半成品
+        pid = os.getpid()
+        tmp_matrix = f"{path}.{pid}.tmp.npy"
+        tmp_ids = f"{path}.ids.json.{pid}.tmp"
+        tmp_meta = f"{path}.meta.json.{pid}.tmp"
+        np.save(tmp_matrix, matrix)
+        with open(tmp_ids, 'w', encoding='utf-8') as f:
+            json.dump(ids, f)
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump({'watermark': watermark.isoformat() if watermark else None}, f)
+        os.replace(tmp_matrix, f"{path}.npy")
+        os.replace(tmp_ids, f"{path}.ids.json")
+        os.replace(tmp_meta, f"{path}.meta.json")
+
+    def _ensure_writable_capacity(self, rows: int):
+        """保证矩阵可写且容量足够，按倍数扩容以摊销复制成本"""
+        capacity = self._matrix.shape[0]
+        if self._matrix.flags.writeable and self._size + rows <= capacity:
+            return
+
+        new_capacity = max(capacity, 1024)
+        while new_capacity < self._size + rows:
+            new_capacity *= 2
+        matrix = np.zeros((new_capacity, self.dimension), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+
+    def append(self, unique_id: str, vector) -> bool:
+        """
+        追加或更新一个向量
+
+        Args:
+            unique_id: 参考图ID
+            vector: 向量（列表或数组）
+
+        Returns:
+            是否写入成功（零向量会被忽略）
+        """
+        vec = np.asarray(vector, dtype=np.float32)
+        if vec.shape != (self.dimension,):
+            raise ValueError(f"Expected vector of dimension {self.dimension}, got {vec.shape}")
+
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return False
+        vec = vec / norm
+
+        unique_id = str(unique_id)
+        with self._lock:
+            self._ensure_writable_capacity(1)
+            row = self._row_by_id.get(unique_id)
+            if row is None:
+                row = self._size
+                self._ids.append(unique_id)
+                self._row_by_id[unique_id] = row
+                self._size += 1
+            self._matrix[row] = vec
+        return True
+
+    def get_vector(self, unique_id: str) -> Optional[np.ndarray]:
+        """获取已索引的（归一化后的）向量"""
+        with self._lock:
+            row = self._row_by_id.get(str(unique_id))
+            if row is None:
+                return None
+            return np.array(self._matrix[row])
+
+    def search(self, query, k: int, exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        """
+        top-k 余弦相似度检索
+
+        Args:
+            query: 查询向量
+            k: 返回数量
+            exclude: 需要排除的 unique_id（以图搜图时排除自身）
+
+        Returns:
+            [(unique_id, similarity), ...]，按相似度降序
+        """
+        q = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm == 0 or k <= 0:
+            return []
+        q = q / norm
+
+        with self._lock:
+            size = self._size
+            if size == 0:
+                return []
+            scores = self._matrix[:size] @ q
+            ids = self._ids
+
+            exclude_row = self._row_by_id.get(str(exclude)) if exclude else None
+            if exclude_row is not None:
+                scores[exclude_row] = -np.inf
+                size -= 1
+
+            k = min(k, size)
+            if k <= 0:
+                return []
+            if k < len(scores):
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            return [(ids[row], float(scores[row])) for row in top]
+
+
+# row_loader(field, since) 返回 since 之后更新过的 (unique_id, vector, updated_at)；since 为 None 时返回全部
+RowLoader = Callable[[str, Optional[datetime]], Iterable[Tuple[str, object, datetime]]]
+
+
+class VectorIndexRegistry:
+    """
+    按向量字段管理多个索引，快照存放在同一目录下
+
+    数据库是唯一的数据来源：索引首次使用时从快照（或数据库全量）加载，之后每隔 refresh_interval
+    按 updated_at 增量拉取其他 worker 写入的行，因此各 worker 最终一致，快照只是加速启动的缓存。
+    快照由 `flask build-vector-index` 生成；开启 autosave 时在后台线程中按 autosave_interval 限频保存，
+    不在请求内写盘。
+    """
+
+    def __init__(self, directory: str, dimensions: Dict[str, int], mmap: bool = True,
+                 row_loader: Optional[RowLoader] = None, refresh_interval: float = 60.0,
+                 refresh_overlap: float = 60.0, autosave_interval: Optional[float] = None):
+        """
+        Args:
+            directory: 快照目录
+            dimensions: {字段: 维度}
+            mmap: 快照矩阵是否以内存映射方式加载
+            row_loader: 从数据库读取向量的函数，None 时只使用快照和本进程写入的数据
+            refresh_interval: 增量同步间隔（秒）
+            refresh_overlap: 增量同步时把 watermark 往前回退的秒数（覆盖提交较晚的长事务）
+            autosave_interval: 后台保存快照的最小间隔（秒），None 表示不自动保存
+        """
+        self.directory = directory
+        self.dimensions = dimensions
+        self.mmap = mmap
+        self.row_loader = row_loader
+        self.refresh_interval = refresh_interval
+        self.refresh_overlap = timedelta(seconds=refresh_overlap)
+        self.autosave_interval = autosave_interval
+        self._indexes: Dict[str, EmbeddingMatrixIndex] = {}
+        self._lock = threading.Lock()
+        self._refresh_locks: Dict[str, threading.Lock] = {field: threading.Lock() for field in dimensions}
+        self._refreshed_at: Dict[str, float] = {}
+        self._saved_at: Dict[str, float] = {}
+        self._saving: set = set()
+
+    def _snapshot_path(self, field: str) -> str:
+        return os.path.join(self.directory, field)
+
+    def _load(self, field: str) -> EmbeddingMatrixIndex:
+        with self._lock:
+            index = self._indexes.get(field)
+            if index is not None:
+                return index
+
+            path = self._snapshot_path(field)
+            index = None
+            if os.path.exists(f"{path}.npy"):
+                try:
+                    index = EmbeddingMatrixIndex.load(path, mmap=self.mmap)
+                    logger.info(f"Loaded vector index {field} with {len(index)} rows")
+                except Exception as e:
+                    logger.warning(f"Failed to load vector index {field}: {str(e)}")
+            if index is None:
+                index = EmbeddingMatrixIndex(self.dimensions[field])
+            self._indexes[field] = index
+            return index
+
+    def get(self, field: str) -> EmbeddingMatrixIndex:
+        """获取字段对应的索引，首次访问时加载快照并从数据库补齐，之后按间隔增量同步"""
+        index = self._load(field)
+        if self.row_loader is None:
+            return index
+
+        refreshed_at = self._refreshed_at.get(field)
+        if refreshed_at is None:
+            # 首次同步前索引可能缺数据，等待同步完成
+            with self._refresh_locks[field]:
+                if self._refreshed_at.get(field) is None:
+                    self._refresh(field, index)
+        elif time.monotonic() - refreshed_at >= self.refresh_interval:
+            # 已有可用数据时只由一个线程同步，其余请求直接使用当前索引
+            if self._refresh_locks[field].acquire(blocking=False):
+                try:
+                    self._refresh(field, index)
+                finally:
+                    self._refresh_locks[field].release()
+        return index
+
+    def refresh(self, field: str) -> int:
+        """立即从数据库增量同步一个字段，返回写入索引的行数（零向量不计入）"""
+        index = self._load(field)
+        with self._refresh_locks[field]:
+            return self._refresh(field, index)
+
+    def rebuild(self, field: str) -> int:
+        """丢弃快照，从数据库全量重建一个字段的索引，返回写入索引的行数"""
+        index = EmbeddingMatrixIndex(self.dimensions[field])
+        with self._lock:
+            self._indexes[field] = index
+        with self._refresh_locks[field]:
+            return self._refresh(field, index)
+
+    def _refresh(self, field: str, index: EmbeddingMatrixIndex) -> int:
+        since = index.watermark - self.refresh_overlap if index.watermark else None
+        latest = index.watermark
+        count = 0
+        try:
+            for unique_id, vector, updated_at in self.row_loader(field, since):
+                if vector is not None and index.append(unique_id, vector):
+                    count += 1
+                if updated_at is not None and (latest is None or updated_at > latest):
+                    latest = updated_at
+        except Exception as e:
+            logger.warning(f"Failed to refresh vector index {field}: {str(e)}")
+        else:
+            index.watermark = latest
+            if count:
+                logger.info(f"Synced {count} rows into vector index {field}")
+                self._schedule_save(field)
+        # 失败时同样推迟下次同步，避免数据库异常时每个请求都重试
+        self._refreshed_at[field] = time.monotonic()
+        return count
+
+    def add(self, unique_id: str, embeddings: Dict[str, Optional[List[float]]]) -> List[str]:
+        """
+        把一条参考图的各字段向量追加到对应索引（本进程写入后立即可查，其他 worker 在下次同步时拉取）
+
+        Returns:
+            实际写入的字段列表
+        """
+        updated = []
+        for field, vector in embeddings.items():
+            if field in self.dimensions and vector is not None:
+                try:
+                    if self.get(field).append(unique_id, vector):
+                        updated.append(field)
+                except Exception as e:
+                    logger.warning(f"Failed to index {field} for {unique_id}: {str(e)}")
+        for field in updated:
+            self._schedule_save(field)
+        return updated
+
+    def _schedule_save(self, field: str):
+        """开启 autosave 时在后台线程保存快照，同一字段至多每 autosave_interval 秒一次"""
+        if self.autosave_interval is None:
+            return
+        with self._lock:
+            if field in self._saving:
+                return
+            if time.monotonic() - self._saved_at.get(field, float('-inf')) < self.autosave_interval:
+                return
+            self._saving.add(field)
+        threading.Thread(target=self._save_in_background, args=(field,),
+                         name=f'vector-index-save-{field}', daemon=True).start()
+
+    def _save_in_background(self, field: str):
+        try:
+            self.save(field)
+        except Exception as e:
+            logger.warning(f"Failed to save vector index {field}: {str(e)}")
+        finally:
+            with self._lock:
+                self._saved_at[field] = time.monotonic()
+                self._saving.discard(field)
+
+    def save(self, field: str):
+        """保存单个字段的索引快照"""
+        self._load(field).save(self._snapshot_path(field))
+
+    def save_all(self):
+        """保存所有已加载的索引快照"""
+        with self._lock:
+            fields = list(self._indexes)
+        for field in fields:
+            self.save(field)